@@ -1,8 +1,14 @@
 import os
-import json
+import time
+import uuid
+import asyncio
 import tempfile
 import streamlit as st
 from main import InvoiceProcessor
+from config import load_job_queue_settings
+from job_queue import JobQueue
+from tracing import traced
+from utils import enforce_json_structure, get_minimal_data_structure, save_output
 import base64
 import shutil
 from copy import deepcopy
@@ -189,46 +195,76 @@ if 'last_saved_file' not in st.session_state:
     st.session_state.last_saved_file = None
 if 'last_save_time' not in st.session_state:
     st.session_state.last_save_time = None
+if 'job_batch_id' not in st.session_state:
+    st.session_state.job_batch_id = None
+if 'document_texts' not in st.session_state:
+    st.session_state.document_texts = {}
 
-# Define the desired order of fields for the output JSON
-JSON_FIELD_ORDER = [
-    "inventory_arrival_date",
-    "stock_number",
-    "vin",
-    "condition",
-    "model_year",
-    "make",
-    "model",
-    "body_type",
-    "body_line",
-    "body_manufacturer",
-    "body_model",
-    "distributor",
-    "distributor_location",
-    "invoice_date",
-    "components",
-    "documents"
-]
-
-def enforce_json_structure(data):
-    # Create a new dictionary to enforce the predefined JSON field order
-    structured_data = {}
-    for field in JSON_FIELD_ORDER:
-        # Populate fields, providing default empty string or list for missing ones
-        structured_data[field] = data.get(field, "" if field != "components" else [])
-    
-    # Ensure the "documents" array is properly structured with current date and path
-    current_date = datetime.now().strftime('%Y-%m-%d')
-    if "documents" not in structured_data or not structured_data["documents"]:
-        structured_data["documents"] = [{
-            "date": current_date,
-            "type": "Invoice",
-            "path": f"img/invoices/bodyinvoices/-/{data.get('filename', '')}"
-        }]
-    
-    return structured_data
+# Fields offered for re-extraction, with their labels in the editor
+REEXTRACT_FIELD_LABELS = {
+    "inventory_arrival_date": "Inventory Arrival Date",
+    "stock_number": "Stock Number",
+    "vin": "VIN",
+    "condition": "Condition",
+    "model_year": "Model Year",
+    "make": "Make",
+    "model": "Model",
+    "body_type": "Body Type",
+    "body_line": "Body Line",
+    "body_manufacturer": "Body Manufacturer",
+    "body_model": "Body Model",
+    "distributor": "Distributor",
+    "distributor_location": "Distributor Location",
+    "invoice_date": "Invoice Date",
+}
+
+def clear_field_widgets(filename, fields, component_index=None):
+    # Drop the widget state of re-extracted inputs so they show the new values after the rerun
+    for field in fields:
+        widget_key = "arrival_date" if field == "inventory_arrival_date" else field
+        st.session_state.pop(f"{filename}_{widget_key}", None)
+    if component_index is not None:
+        prefix = f"{filename}_comp_{component_index}_"
+        for key in [key for key in st.session_state.keys() if str(key).startswith(prefix)]:
+            del st.session_state[key]
+
+def display_reextract_controls(edited_data, filename, processor, pdf_path):
+    # Re-extract selected fields or one component from the cached document text instead of the whole invoice
+    with st.expander("🔄 Re-extract Fields"):
+        selected_fields = st.multiselect(
+            "Fields",
+            list(REEXTRACT_FIELD_LABELS),
+            format_func=REEXTRACT_FIELD_LABELS.get,
+            key=f"{filename}_reextract_fields"
+        )
+        components = edited_data.get('components', [])
+        selected_component = st.selectbox(
+            "Component",
+            [None] + list(range(len(components))),
+            format_func=lambda i: "None" if i is None else f"Component {i+1}: {components[i].get('name', 'Unnamed')}",
+            key=f"{filename}_reextract_component"
+        )
+        # The document text kept from the processing run, so only a small LLM call is made
+        document_content = st.session_state.document_texts.get(filename)
+        if not document_content:
+            st.caption("The document text of this file was not kept (queued or failed processing), so it is "
+                       "loaded again first; this runs OCR when the OCR cache does not hold it.")
+        if st.button("Re-extract", key=f"{filename}_reextract"):
+            try:
+                with st.spinner("Re-extracting..."):
+                    if not document_content:
+                        document_content = processor.load_document_intelligence_data(pdf_path)
+                        st.session_state.document_texts[filename] = document_content
+                    updated = processor.reextract(document_content, filename, edited_data,
+                                                  fields=selected_fields, component_index=selected_component)
+                edited_data.update(updated)
+                clear_field_widgets(filename, selected_fields, selected_component)
+                st.session_state.files_to_save.add(filename)
+                st.rerun()
+            except Exception as e:
+                st.error(f"Re-extraction failed: {e}")
 
-def display_extracted_data(data, filename):
+def display_extracted_data(data, filename, processor=None, pdf_path=None):
     # Initialize edited_data for the current file if not already present in session state
     if filename not in st.session_state.edited_data:
         st.session_state.edited_data[filename] = enforce_json_structure({**data, "filename": filename})
@@ -236,6 +272,9 @@ def display_extracted_data(data, filename):
     edited_data = st.session_state.edited_data[filename]
     
     st.subheader("Extracted Data")
+
+    if processor is not None and pdf_path:
+        display_reextract_controls(edited_data, filename, processor, pdf_path)
     
     # Use a container to group input fields
     with st.container():
@@ -408,18 +447,12 @@ def display_extracted_data(data, filename):
     
     return edited_data
 
+@traced()
 def save_data(filename, edited_data):
     # Save the processed and edited data to a JSON file
     try:
-        output_dir = "processed_output"
-        # Create output directory if it doesn't exist
-        os.makedirs(output_dir, exist_ok=True)
-        # Construct the output file path
-        output_path = os.path.join(output_dir, f"{os.path.splitext(filename)[0]}.json")
-        
-        # Write the data to the JSON file with pretty printing
-        with open(output_path, "w") as f:
-            json.dump(enforce_json_structure({**edited_data, "filename": filename}), f, indent=2)
+        # Write the data to processed_output/<name>.json
+        output_path = save_output("processed_output", filename, edited_data)
         
         # Update session state to track saved files and last save info
         st.session_state.saved_files.append(output_path)
@@ -443,6 +476,7 @@ def reset_processing():
     st.session_state.current_file_index = 0
     st.session_state.processing_status = {}
     st.session_state.edited_data = {}
+    st.session_state.document_texts = {}
     st.session_state.files_to_save = set()
     st.session_state.last_saved_file = None
     st.session_state.last_save_time = None
@@ -451,6 +485,87 @@ def reset_processing():
         shutil.rmtree(st.session_state.temp_dir)
     st.session_state.temp_dir = None
     st.session_state.processing_completed = False
+    # Forget the queued batch, including the link that restores it
+    st.session_state.job_batch_id = None
+    st.query_params.clear()
+
+def enqueue_uploads(job_queue, upload_dir, uploaded_files, force_reextract):
+    # Copy the uploads to the folder shared with the workers and queue one job per file
+    batch_id = f"ui-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    batch_dir = os.path.join(upload_dir, batch_id)
+    os.makedirs(batch_dir, exist_ok=True)
+    for file in uploaded_files:
+        path = os.path.abspath(os.path.join(batch_dir, file.name))
+        with open(path, "wb") as f:
+            f.write(file.getbuffer())
+        job_queue.enqueue(batch_id, path, file.name, force_reextract)
+    return batch_id
+
+def restore_queued_batch(job_queue, upload_dir):
+    # Pick the batch up again from the page link after a refresh or in a new tab
+    batch_id = st.query_params.get("batch")
+    # Only names of known batches are accepted, since the upload folder is removed on reset
+    if not batch_id or batch_id != os.path.basename(batch_id) or not job_queue.batch_jobs(batch_id):
+        return
+    st.session_state.job_batch_id = batch_id
+    st.session_state.temp_dir = os.path.join(upload_dir, batch_id)
+
+def job_status(job):
+    # Status, message and CSS class of a queued job, in the terms of the inline processing
+    if job['status'] == 'done':
+        message = 'Extraction successful'
+        if (job['usage'] or {}).get('llm_truncated'):
+            message += ' (response truncated, check for missing components)'
+        return 'Completed', message, 'success'
+    if job['status'] == 'dead':
+        return 'Error', f"Processing failed after {job['attempts']} attempt(s): {job['error']}", 'error'
+    if job['status'] == 'leased':
+        return 'Processing', f"Attempt {job['attempts']} of {job['max_attempts']} in progress", 'processing'
+    if job['attempts']:
+        return 'Processing', f"Attempt {job['attempts']} failed ({job['error']}), retry scheduled", 'processing'
+    return 'Processing', 'Queued for processing', 'processing'
+
+def show_queued_batch(job_queue, poll_seconds):
+    # Follow a batch processed by the queue workers; the results are loaded for review once every job is finished
+    batch_id = st.session_state.job_batch_id
+    jobs = job_queue.batch_jobs(batch_id)
+    if not jobs:
+        st.warning(f"Batch {batch_id} is no longer in the job queue.")
+        st.session_state.job_batch_id = None
+        st.query_params.clear()
+        return
+    finished = [job for job in jobs if job['status'] in ('done', 'dead')]
+
+    st.header("1. Invoice Processing")
+    st.progress(int(len(finished) / len(jobs) * 100) if jobs else 100)
+    st.caption(f"Batch {batch_id}: {len(finished)} of {len(jobs)} invoice(s) finished. "
+               "Processing continues if this page is closed; reopen this link to come back to the batch.")
+    for job in jobs:
+        status, message, status_class = job_status(job)
+        st.session_state.processing_status[job['filename']] = {'status': status, 'message': message}
+        st.markdown(f"""
+        <div class="file-card">
+            <strong>{job['filename']}</strong> - 
+            <span class="{status_class}">{status}</span>
+            <br><small>{message}</small>
+        </div>
+        """, unsafe_allow_html=True)
+
+    if len(finished) < len(jobs):
+        # Poll the queue until the workers are done
+        time.sleep(poll_seconds)
+        st.rerun()
+
+    # Store the results in upload order, with a minimal structure for dead-lettered jobs
+    results = {}
+    for job in jobs:
+        data = job['result'] if job['status'] == 'done' else get_minimal_data_structure(job['filename'])
+        results[job['filename']] = enforce_json_structure({**data, "filename": job['filename']})
+    st.session_state.processed_data = results
+    st.session_state.files_to_save = set(results.keys())
+    st.session_state.edited_data = {k: deepcopy(v) for k, v in results.items()}
+    st.session_state.current_file_index = 0
+    st.rerun()
 
 def show_completion_screen():
     # Display the completion message and a button to start new processing
@@ -475,6 +590,16 @@ def main():
         show_completion_screen()
         return # Exit main function to prevent further processing logic
 
+    # With the job queue enabled, the queue workers process the invoices and this page only follows them
+    (queue_enabled, queue_path, upload_dir, lease_seconds, max_attempts,
+     retry_delay_seconds, poll_seconds) = load_job_queue_settings()
+    job_queue = JobQueue(queue_path, lease_seconds, max_attempts, retry_delay_seconds) if queue_enabled else None
+    if job_queue and st.session_state.job_batch_id is None and not st.session_state.processed_data:
+        restore_queued_batch(job_queue, upload_dir)
+    if job_queue and st.session_state.job_batch_id and not st.session_state.processed_data:
+        show_queued_batch(job_queue, poll_seconds)
+        return
+
     # Initialize the InvoiceProcessor
     processor = InvoiceProcessor()
 
@@ -517,8 +642,23 @@ def main():
                     </div>
                     """, unsafe_allow_html=True)
 
+        # Option to ignore cached LLM responses and extract the invoices again
+        force_reextract = st.checkbox(
+            "Force re-extraction",
+            key="force_reextract",
+            help="Ignore cached extraction results and call the model again"
+        )
+
         # Button to start the processing of uploaded files
         if st.button("Start Processing", key="process_btn"):
+            if job_queue:
+                # Hand the files to the queue workers; the page link restores the batch after a refresh
+                batch_id = enqueue_uploads(job_queue, upload_dir, uploaded_files, force_reextract)
+                st.session_state.job_batch_id = batch_id
+                st.session_state.temp_dir = os.path.join(upload_dir, batch_id)
+                st.query_params["batch"] = batch_id
+                st.rerun()
+
             # Create a temporary directory to store uploaded PDFs
             if not st.session_state.temp_dir:
                 st.session_state.temp_dir = tempfile.mkdtemp()
@@ -531,19 +671,13 @@ def main():
                     f.write(file.getbuffer())
                 file_paths.append(path)
             
-            # Process files one by one with a progress bar
-            results = {}
-            progress_bar = st.progress(0)
-            for i, path in enumerate(file_paths):
+            # Mark every file as queued before the batch starts
+            for path in file_paths:
                 filename = os.path.basename(path)
-                
-                # Update status to "Processing" and refresh UI
                 st.session_state.processing_status[filename] = {
                     'status': 'Processing',
-                    'message': f'Processing file {i+1} of {len(file_paths)}'
+                    'message': 'Queued for processing'
                 }
-                progress_bar.progress(int((i+1)/len(file_paths)*100))
-                
                 with status_container:
                     with status_placeholders[filename]:
                         status = st.session_state.processing_status[filename]
@@ -554,30 +688,35 @@ def main():
                             <br><small>{status['message']}</small>
                         </div>
                         """, unsafe_allow_html=True)
-                
-                try:
-                    # Call the invoice processor for the current file
-                    file_results = processor.process_invoices([path])
-                    if file_results and filename in file_results:
-                        # Store processed data, ensuring consistent structure
-                        results[filename] = enforce_json_structure({
-                            **file_results[filename],
-                            "filename": filename
-                        })
-                        # Update status to "Completed" on success
-                        st.session_state.processing_status[filename] = {
-                            'status': 'Completed',
-                            'message': 'Extraction successful'
-                        }
-                    else:
-                        raise Exception("No results returned")
-                except Exception as e:
+
+            progress_bar = st.progress(0)
+
+            def update_progress(completed, total, result):
+                filename = result.filename
+                if result.succeeded:
+                    # Update status to "Completed" on success
+                    message = f'Extraction successful in {result.elapsed_seconds:.1f}s'
+                    # A response cut off at max_tokens may be missing fields or components
+                    if result.usage.get('llm_truncated'):
+                        message += ' (response truncated, check for missing components)'
+                    st.session_state.processing_status[filename] = {
+                        'status': 'Completed',
+                        'message': message
+                    }
+                elif result.throttled:
+                    # Quota exhaustion is worth a retry later, unlike a document that cannot be processed
+                    st.session_state.processing_status[filename] = {
+                        'status': 'Error',
+                        'message': f'Throttled by the Azure quota, retry later: {result.error}'
+                    }
+                else:
                     # Update status to "Error" if processing fails
                     st.session_state.processing_status[filename] = {
                         'status': 'Error',
-                        'message': f'Processing failed: {str(e)}'
+                        'message': f'Processing failed: {result.error}'
                     }
-                
+                progress_bar.progress(int(completed/total*100))
+
                 # Update UI with final status for the current file
                 with status_container:
                     with status_placeholders[filename]:
@@ -590,9 +729,26 @@ def main():
                             <br><small>{status['message']}</small>
                         </div>
                         """, unsafe_allow_html=True)
+
+            # Process the files concurrently, updating the UI as each one finishes
+            batch_results = asyncio.run(processor.process_invoices_async(
+                file_paths,
+                progress_callback=update_progress,
+                force_reextract=force_reextract
+            ))
+            # Store processed data in upload order, ensuring consistent structure
+            results = {
+                filename: enforce_json_structure({**result.data, "filename": filename})
+                for filename, result in batch_results.items()
+            }
             
             # Store all processed data in session state
             st.session_state.processed_data = results
+            # Keep the document text of each file for re-extraction
+            st.session_state.document_texts = {
+                filename: result.document_content for filename, result in batch_results.items()
+                if result.document_content
+            }
             # Keep track of files that need saving
             st.session_state.files_to_save = set(results.keys())
             # Create a deep copy for editable data
@@ -658,7 +814,7 @@ def main():
         with col_right:
             st.subheader("Extracted Data")
             # Display and allow editing of the extracted data
-            edited_data = display_extracted_data(current_data, current_file)
+            edited_data = display_extracted_data(current_data, current_file, processor, pdf_path)
             
             # Show last save confirmation if the current file was recently saved
             if st.session_state.last_saved_file == current_file and st.session_state.last_save_time:
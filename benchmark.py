@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+import statistics
+from typing import List, Dict, Optional
+
+from main import InvoiceProcessor
+from packing import plan_packs, split_counts
+from usage_ledger import new_usage_record
+from utils import estimate_tokens
+
+# Scalar fields scored against the reference outputs
+SCORED_FIELDS = ["stock_number", "vin", "model_year", "make", "model", "body_type", "body_manufacturer",
+                 "body_model", "distributor", "distributor_location", "invoice_date"]
+
+
+def list_pdf_files(folder: str) -> List[str]:
+    # Collect the PDF files of the folder in a stable order
+    return sorted(
+        os.path.join(folder, name) for name in os.listdir(folder) if name.lower().endswith(".pdf")
+    )
+
+
+def count_prompt_tokens(messages: List[Dict]) -> int:
+    # Sum the token estimate of every message in the prompt
+    return sum(estimate_tokens(message["content"]) for message in messages)
+
+
+def benchmark_body_model_modes(processor: InvoiceProcessor, file_paths: List[str], call_llm: bool) -> List[Dict]:
+    rows = []
+    original_mode = processor.body_model_prompt_mode
+    for file_path in file_paths:
+        filename = os.path.basename(file_path)
+        # Run OCR once per invoice so every mode sees the same document text
+        document_content = processor.load_document_intelligence_data(file_path)
+
+        for mode in ("full", "retrieval", "none"):
+            processor.body_model_prompt_mode = mode
+            row = {
+                "filename": filename,
+                "mode": mode,
+                "prompt_tokens": count_prompt_tokens(processor.build_messages(document_content, filename)),
+                "latency_seconds": None,
+            }
+            if call_llm:
+                # Time the full chat completion for this prompt variant
+                start = time.perf_counter()
+                processor.extract_invoice_data_with_llm(document_content, filename, bypass_cache=True)
+                row["latency_seconds"] = round(time.perf_counter() - start, 3)
+            rows.append(row)
+            print(f"{filename} [{mode}] prompt_tokens={row['prompt_tokens']} latency={row['latency_seconds']}")
+
+    processor.body_model_prompt_mode = original_mode
+    return rows
+
+
+def load_reference(folder: Optional[str], filename: str) -> Optional[Dict]:
+    # Reviewed outputs are stored by save_data as <stem>.json
+    if not folder:
+        return None
+    path = os.path.join(folder, f"{os.path.splitext(filename)[0]}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def normalize_value(value) -> str:
+    return " ".join(str(value or "").lower().split())
+
+
+def score_against_reference(data: Dict, reference: Dict) -> Dict:
+    # Share of scored fields matching the reference, and how far the component count is off
+    matched = sum(normalize_value(data.get(name)) == normalize_value(reference.get(name)) for name in SCORED_FIELDS)
+    return {
+        "field_accuracy": round(matched / len(SCORED_FIELDS), 3),
+        "component_count_error": abs(len(data.get("components") or []) - len(reference.get("components") or [])),
+    }
+
+
+def benchmark_content_modes(processor: InvoiceProcessor, file_paths: List[str], call_llm: bool,
+                            reference_folder: Optional[str] = None) -> List[Dict]:
+    rows = []
+    original_mode = processor.content_mode
+    for file_path in file_paths:
+        filename = os.path.basename(file_path)
+        reference = load_reference(reference_folder, filename)
+
+        for mode in ("flat", "structured"):
+            # Each mode runs its own analysis, as the OCR cache is keyed by content mode
+            processor.content_mode = mode
+            document_content = processor.load_document_intelligence_data(file_path)
+            row = {
+                "filename": filename,
+                "mode": mode,
+                "document_tokens": estimate_tokens(document_content),
+                "prompt_tokens": count_prompt_tokens(processor.build_messages(document_content, filename)),
+                "latency_seconds": None,
+                "components": None,
+                "field_accuracy": None,
+                "component_count_error": None,
+            }
+            if call_llm:
+                start = time.perf_counter()
+                raw_response = processor.extract_invoice_data_with_llm(document_content, filename, bypass_cache=True)
+                row["latency_seconds"] = round(time.perf_counter() - start, 3)
+                data = processor.parse_llm_response(raw_response, filename)
+                row["components"] = len(data["components"])
+                if reference is not None:
+                    row.update(score_against_reference(data, reference))
+            rows.append(row)
+            print(f"{filename} [{mode}] document_tokens={row['document_tokens']} "
+                  f"prompt_tokens={row['prompt_tokens']} latency={row['latency_seconds']} "
+                  f"field_accuracy={row['field_accuracy']}")
+
+    processor.content_mode = original_mode
+    return rows
+
+
+def benchmark_output_formats(processor: InvoiceProcessor, file_paths: List[str], call_llm: bool) -> List[Dict]:
+    rows = []
+    original_format = processor.output_format
+    for file_path in file_paths:
+        filename = os.path.basename(file_path)
+        document_content = processor.load_document_intelligence_data(file_path)
+
+        for output_format in ("full", "compact"):
+            processor.output_format = output_format
+            row = {
+                "filename": filename,
+                "mode": output_format,
+                "prompt_tokens": count_prompt_tokens(processor.build_messages(document_content, filename)),
+                "max_tokens": processor.sampling_params_for(document_content)["max_tokens"],
+                "completion_tokens": None,
+                "latency_seconds": None,
+                "components": None,
+            }
+            if call_llm:
+                # Completion tokens come from the API's usage report
+                usage = new_usage_record()
+                start = time.perf_counter()
+                raw_response = processor.extract_invoice_data_with_llm(document_content, filename, bypass_cache=True,
+                                                                       usage=usage)
+                row["latency_seconds"] = round(time.perf_counter() - start, 3)
+                row["completion_tokens"] = usage["completion_tokens"]
+                row["components"] = len(processor.parse_llm_response(raw_response, filename)["components"])
+            rows.append(row)
+            print(f"{filename} [{output_format}] prompt_tokens={row['prompt_tokens']} max_tokens={row['max_tokens']} "
+                  f"completion_tokens={row['completion_tokens']} latency={row['latency_seconds']}")
+
+    processor.output_format = original_format
+    return rows
+
+
+def benchmark_packing(processor: InvoiceProcessor, file_paths: List[str], call_llm: bool) -> List[Dict]:
+    # Prompt tokens per invoice sent alone and in the planned packs; with --call-llm, both batch modes are run
+    documents = {}
+    for file_path in file_paths:
+        content, di_fields = processor.load_document(file_path, new_usage_record())
+        documents[os.path.basename(file_path)] = {
+            "filename": os.path.basename(file_path), "document_content": content,
+            "pinned_fields": processor.select_pinned_fields(content, di_fields, None),
+        }
+    document_tokens = {filename: estimate_tokens(document["document_content"])
+                       for filename, document in documents.items()}
+    packs, _ = plan_packs(document_tokens, processor.pack_max_document_tokens, processor.pack_token_budget,
+                          processor.pack_max_invoices)
+    # A packed prompt is charged to its invoices in proportion to their document size, as in the ledger
+    packed_tokens = {}
+    for pack in packs:
+        prompt_tokens = count_prompt_tokens(processor.build_packed_messages([documents[name] for name in pack]))
+        for name, tokens in zip(pack, split_counts(prompt_tokens, [document_tokens[name] for name in pack])):
+            packed_tokens[name] = tokens
+
+    rows = []
+    for filename, document in documents.items():
+        single_tokens = count_prompt_tokens(processor.build_messages(
+            document["document_content"], filename, pinned_fields=document["pinned_fields"]))
+        for mode, prompt_tokens in (("single", single_tokens), ("packed", packed_tokens.get(filename, single_tokens))):
+            rows.append({"filename": filename, "mode": mode, "document_tokens": document_tokens[filename],
+                         "prompt_tokens": prompt_tokens, "latency_seconds": None})
+    print(f"{len(documents)} invoices, {sum(len(pack) for pack in packs)} in {len(packs)} packs")
+
+    if call_llm:
+        # Measured tokens per invoice come from the usage ledger records of each batch
+        original_mode = processor.processing_mode
+        for processing_mode, mode in (("concurrent", "single"), ("packed", "packed")):
+            processor.processing_mode = processing_mode
+            start = time.perf_counter()
+            results = asyncio.run(processor.process_invoices_async(file_paths, force_reextract=True))
+            elapsed = time.perf_counter() - start
+            print(f"[{mode}] {len(results)} invoices in {elapsed:.1f}s "
+                  f"({len(results) / elapsed if elapsed else 0.0:.2f} invoices/s)")
+            for row in rows:
+                result = results.get(row["filename"])
+                if row["mode"] == mode and result is not None:
+                    row["measured_prompt_tokens"] = result.usage.get("prompt_tokens")
+                    row["completion_tokens"] = result.usage.get("completion_tokens")
+                    row["latency_seconds"] = round(result.elapsed_seconds, 3)
+        processor.processing_mode = original_mode
+    return rows
+
+
+def mean_of(rows: List[Dict], key: str, digits: int) -> Optional[float]:
+    values = [row[key] for row in rows if row.get(key) is not None]
+    return round(statistics.mean(values), digits) if values else None
+
+
+def summarize(rows: List[Dict]) -> Dict[str, Dict]:
+    # Aggregate token counts and latencies per mode
+    summary = {}
+    for mode in sorted({row["mode"] for row in rows}):
+        mode_rows = [row for row in rows if row["mode"] == mode]
+        summary[mode] = {
+            "invoices": len(mode_rows),
+            "mean_prompt_tokens": mean_of(mode_rows, "prompt_tokens", 1),
+            "mean_latency_seconds": mean_of(mode_rows, "latency_seconds", 3),
+        }
+        # Only reported by the comparisons that collect them
+        for key in ("document_tokens", "field_accuracy", "component_count_error", "max_tokens", "completion_tokens",
+                    "components", "measured_prompt_tokens"):
+            value = mean_of(mode_rows, key, 3)
+            if value is not None:
+                summary[mode][f"mean_{key}"] = value
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare prompt tokens and latency of invoice extraction variants.")
+    parser.add_argument("folder", nargs="?", default="Training-pdf", help="Folder containing the PDF invoices")
+    parser.add_argument("--compare", choices=["body-model", "content", "output-format", "packing"],
+                        default="body-model",
+                        help="Compare body model prompt modes, flat and structured document content, "
+                             "full and compact response formats, or single and packed requests")
+    parser.add_argument("--call-llm", action="store_true", help="Also time the LLM call for each variant")
+    parser.add_argument("--reference", help="Folder of reviewed JSON outputs used to score the content modes")
+    parser.add_argument("--output", help="Optional path of a JSON report")
+    args = parser.parse_args()
+
+    processor = InvoiceProcessor()
+    file_paths = list_pdf_files(args.folder)
+    if args.compare == "content":
+        rows = benchmark_content_modes(processor, file_paths, args.call_llm, args.reference)
+    elif args.compare == "output-format":
+        rows = benchmark_output_formats(processor, file_paths, args.call_llm)
+    elif args.compare == "packing":
+        rows = benchmark_packing(processor, file_paths, args.call_llm)
+    else:
+        rows = benchmark_body_model_modes(processor, file_paths, args.call_llm)
+    summary = summarize(rows)
+
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"rows": rows, "summary": summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import math
+import re
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple
+
+# Tokens are runs of letters/digits; single characters ("x", "w", "h") carry no signal
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+MIN_TOKEN_LENGTH = 2
+# Only longer tokens are matched fuzzily, short ones produce too many false positives
+FUZZY_MIN_TOKEN_LENGTH = 5
+FUZZY_MIN_SIMILARITY = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    # Lowercase the text and split it into alphanumeric tokens
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) >= MIN_TOKEN_LENGTH]
+
+
+def char_ngrams(token: str, n: int = 3) -> Set[str]:
+    # Pad the token so prefixes and suffixes produce their own n-grams
+    padded = f"#{token}#"
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+class BodyModelIndex:
+    def __init__(self, body_models: List[str], ngram_size: int = 3):
+        self.body_models = body_models
+        self.ngram_size = ngram_size
+
+        # Tokenize every catalog entry once
+        self.entry_tokens: List[Set[str]] = [set(tokenize(model)) for model in body_models]
+
+        # Inverted index: token -> ids of the catalog entries containing it
+        self.postings: Dict[str, List[int]] = defaultdict(list)
+        for entry_id, tokens in enumerate(self.entry_tokens):
+            for token in tokens:
+                self.postings[token].append(entry_id)
+
+        # Inverse document frequency of each token, rare tokens (model codes) weigh the most
+        entry_count = max(len(body_models), 1)
+        self.idf: Dict[str, float] = {
+            token: math.log(1 + entry_count / len(ids)) for token, ids in self.postings.items()
+        }
+        # Total token weight of each entry, used to normalise scores to 0-1
+        self.entry_weight: List[float] = [
+            sum(self.idf[token] for token in tokens) for tokens in self.entry_tokens
+        ]
+
+        # Character n-gram index over the vocabulary, used to match OCR-damaged tokens
+        self.vocabulary_ngrams: Dict[str, Set[str]] = {}
+        self.ngram_postings: Dict[str, List[str]] = defaultdict(list)
+        for token in self.postings:
+            if len(token) >= FUZZY_MIN_TOKEN_LENGTH:
+                grams = char_ngrams(token, ngram_size)
+                self.vocabulary_ngrams[token] = grams
+                for gram in grams:
+                    self.ngram_postings[gram].append(token)
+
+    def fuzzy_vocabulary_matches(self, token: str) -> List[Tuple[str, float]]:
+        # Find vocabulary tokens whose n-gram Jaccard similarity to the given token is high enough
+        grams = char_ngrams(token, self.ngram_size)
+        overlap: Dict[str, int] = defaultdict(int)
+        for gram in grams:
+            for candidate in self.ngram_postings.get(gram, ()):
+                overlap[candidate] += 1
+
+        matches = []
+        for candidate, shared in overlap.items():
+            similarity = shared / (len(grams) + len(self.vocabulary_ngrams[candidate]) - shared)
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                matches.append((candidate, similarity))
+        return matches
+
+    def search(self, text: str, top_k: int) -> List[Tuple[str, float]]:
+        # Collect the distinct tokens of the document and map them to vocabulary weights
+        document_tokens = set(tokenize(text))
+        token_weights: Dict[str, float] = {}
+        for token in document_tokens:
+            if token in self.postings:
+                token_weights[token] = 1.0
+            elif len(token) >= FUZZY_MIN_TOKEN_LENGTH:
+                # Tolerate OCR noise in long tokens by matching them to their nearest vocabulary tokens
+                for candidate, similarity in self.fuzzy_vocabulary_matches(token):
+                    token_weights[candidate] = max(token_weights.get(candidate, 0.0), similarity)
+
+        # Accumulate the matched token weight per catalog entry
+        matched_weight: Dict[int, float] = defaultdict(float)
+        for token, weight in token_weights.items():
+            token_idf = self.idf[token] * weight
+            for entry_id in self.postings[token]:
+                matched_weight[entry_id] += token_idf
+
+        # Score each entry by the fraction of its token weight found in the document
+        scored = []
+        for entry_id, weight in matched_weight.items():
+            coverage = weight / self.entry_weight[entry_id] if self.entry_weight[entry_id] else 0.0
+            scored.append((coverage, weight, entry_id))
+
+        # Rank by coverage weighted by the matched token weight so specific entries beat generic ones
+        scored.sort(key=lambda item: (item[0] * item[1], item[0]), reverse=True)
+        return [(self.body_models[entry_id], round(coverage, 4)) for coverage, _, entry_id in scored[:top_k]]
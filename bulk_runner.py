@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from cache import hash_file
+from config import load_bulk_settings, load_environment_variables, load_usage_settings
+from usage_ledger import UsageLedger
+from utils import save_output
+
+# Processor of each worker process, created once by init_worker
+_processor = None
+
+
+def list_pdf_files_recursive(folder: str) -> List[str]:
+    # Every PDF under the folder, in a stable order
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(folder)
+                  for name in names if name.lower().endswith(".pdf"))
+
+
+def load_manifest(manifest_path: str) -> Dict[str, Dict]:
+    # Latest checkpoint entry per file hash; the manifest is append-only, so a run stopped at any point
+    # leaves it readable
+    entries = {}
+    if not os.path.exists(manifest_path):
+        return entries
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut off by an interrupted write
+                continue
+            entries[entry["hash"]] = entry
+    return entries
+
+
+def append_manifest(manifest_path: str, entry: Dict) -> None:
+    directory = os.path.dirname(manifest_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(manifest_path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def init_worker() -> None:
+    # Imported here so the parent process never builds the Azure clients
+    from main import InvoiceProcessor
+
+    global _processor
+    _processor = InvoiceProcessor()
+
+
+def process_file(file_path: str, batch_id: str, force_reextract: bool) -> Dict:
+    result = _processor.process_invoice(file_path, os.path.basename(file_path), force_reextract, batch_id=batch_id)
+    return {"data": result.data, "error": result.error, "elapsed_seconds": result.elapsed_seconds,
+            "usage": result.usage}
+
+
+def run(folder: str, output_dir: str, manifest_path: str, workers: int, force_reextract: bool = False,
+        retry_failed: bool = True) -> Dict:
+    file_paths = list_pdf_files_recursive(folder)
+    manifest = load_manifest(manifest_path)
+    batch_id = f"bulk-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+
+    # Skip files whose content was already processed, including copies under another name
+    pending: Dict[str, str] = {}
+    skipped = 0
+    for file_path in file_paths:
+        file_hash = hash_file(file_path)
+        status = manifest.get(file_hash, {}).get("status")
+        if status == "done" or (status == "failed" and not retry_failed) or file_hash in pending:
+            skipped += 1
+            continue
+        pending[file_hash] = file_path
+    print(f"{len(file_paths)} PDFs under {folder}: {skipped} already processed, {len(pending)} to process "
+          f"with {workers} workers")
+
+    start = time.perf_counter()
+    usage_entries: List[Dict] = []
+    seconds: List[float] = []
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        futures = {executor.submit(process_file, file_path, batch_id, force_reextract): file_hash
+                   for file_hash, file_path in pending.items()}
+        for completed, future in enumerate(as_completed(futures), start=1):
+            file_hash = futures[future]
+            file_path = pending[file_hash]
+            relative_path = os.path.relpath(file_path, folder)
+            entry = {"hash": file_hash, "path": relative_path, "timestamp": datetime.now().isoformat(timespec="seconds")}
+            try:
+                outcome = future.result()
+            except Exception as e:
+                # The worker process itself failed
+                outcome = {"error": str(e), "elapsed_seconds": 0.0, "usage": None}
+            if outcome["error"] is None:
+                # Mirror the folder layout so invoices with the same name in different folders do not collide
+                entry["output"] = save_output(os.path.join(output_dir, os.path.dirname(relative_path)),
+                                              os.path.basename(file_path), outcome["data"])
+                entry["status"] = "done"
+            else:
+                entry["status"] = "failed"
+                entry["error"] = outcome["error"]
+                failed += 1
+            entry["elapsed_seconds"] = round(outcome["elapsed_seconds"], 3)
+            seconds.append(outcome["elapsed_seconds"])
+            if outcome["usage"]:
+                usage_entries.append(outcome["usage"])
+            # Checkpoint each file as soon as it finishes
+            append_manifest(manifest_path, entry)
+            print(f"[{completed}/{len(pending)}] {relative_path}: {entry['status']} "
+                  f"({entry['elapsed_seconds']:.1f}s)")
+
+    elapsed = time.perf_counter() - start
+    processed = len(pending)
+    summary = {
+        "files": len(file_paths),
+        "skipped": skipped,
+        "processed": processed,
+        "succeeded": processed - failed,
+        "failed": failed,
+        "elapsed_seconds": round(elapsed, 1),
+        "invoices_per_minute": round(processed / elapsed * 60, 2) if elapsed and processed else 0.0,
+        "mean_seconds_per_invoice": round(sum(seconds) / len(seconds), 3) if seconds else None,
+        "usage": UsageLedger("", "", load_usage_settings()[2]).summarize(usage_entries),
+    }
+    return summary
+
+
+def main():
+    workers, output_dir, manifest_path = load_bulk_settings()
+    training_folder = load_environment_variables()[6]
+
+    parser = argparse.ArgumentParser(description="Process every PDF invoice under a folder, resuming interrupted runs.")
+    parser.add_argument("folder", nargs="?", default=training_folder,
+                        help="Folder searched recursively for PDF invoices (default: TRAINING_FOLDER)")
+    parser.add_argument("--workers", type=int, default=workers, help="Number of worker processes")
+    parser.add_argument("--output-dir", default=output_dir, help="Folder of the JSON outputs")
+    parser.add_argument("--manifest", help="Checkpoint manifest path (default: BULK_MANIFEST_PATH)")
+    parser.add_argument("--force", action="store_true", help="Bypass the LLM response cache")
+    parser.add_argument("--skip-failed", action="store_true", help="Do not retry files that failed in a previous run")
+    args = parser.parse_args()
+
+    # The manifest follows --output-dir unless it is set explicitly
+    manifest: Optional[str] = args.manifest
+    if manifest is None:
+        manifest = manifest_path if args.output_dir == output_dir else os.path.join(args.output_dir, "manifest.jsonl")
+    summary = run(args.folder, args.output_dir, manifest, max(1, args.workers), args.force, not args.skip_failed)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
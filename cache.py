@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+
+def hash_bytes(data: bytes) -> str:
+    # SHA-256 hex digest of raw bytes
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(file_path: str) -> str:
+    # SHA-256 hex digest of a file, read in chunks so large PDFs don't load at once
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_cache_key(*parts: Any) -> str:
+    # Combine the key parts into one stable digest
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    def __init__(self, db_path: str, max_bytes: int, ttl_seconds: Optional[float] = None):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        # Entries older than the TTL are treated as misses; None keeps them until evicted
+        self.ttl_seconds = ttl_seconds
+        # Serialise writers within this process; SQLite handles locking across processes
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    expires_at REAL
+                )
+            """)
+            # Caches created before TTL support lack the expiry column
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(entries)").fetchall()]
+            if "expires_at" not in columns:
+                conn.execute("ALTER TABLE entries ADD COLUMN expires_at REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_last_access ON entries (last_access)")
+            # Hit/miss counters persist so they cover every session sharing the cache
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # A short-lived connection per operation keeps the cache safe to use from several threads
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _increment(self, conn: sqlite3.Connection, name: str):
+        conn.execute(
+            "INSERT INTO stats (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        # Return the cached value for the key, or None on a miss
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT value, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] is not None and row[1] <= now:
+                # Drop the expired entry and report a miss
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._increment(conn, "expirations")
+                row = None
+            if row is None:
+                self._increment(conn, "misses")
+                return None
+            # Refresh the access time so eviction is least-recently-used
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+            self._increment(conn, "hits")
+            return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        # Store the value and evict the least recently used entries beyond the size budget
+        payload = json.dumps(value)
+        now = time.time()
+        expires_at = now + self.ttl_seconds if self.ttl_seconds else None
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, created_at, last_access, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, payload, len(payload.encode("utf-8")), now, now, expires_at),
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        # Expired entries go first regardless of the size budget
+        conn.execute("DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        # Walk entries from least to most recently used until the cache fits again
+        evicted = 0
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access ASC").fetchall():
+            if total_size <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total_size -= size
+            evicted += 1
+        conn.execute(
+            "INSERT INTO stats (name, value) VALUES ('evictions', ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (evicted,),
+        )
+
+    def stats(self) -> Dict[str, int]:
+        # Report hit/miss/eviction counters along with the current size of the cache
+        with self._connect() as conn:
+            counters = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "evictions": counters.get("evictions", 0),
+            "expirations": counters.get("expirations", 0),
+            "entries": entries,
+            "size_bytes": size,
+        }
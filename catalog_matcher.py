@@ -0,0 +1,87 @@
+import re
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+# Collapse punctuation and whitespace so "PVMXT-263C" and "PVMXT 263C" normalise alike
+NORMALIZE_PATTERN = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_catalog_text(text: str) -> str:
+    # Lowercase and reduce every non-alphanumeric run to a single space
+    return NORMALIZE_PATTERN.sub(" ", text.lower()).strip()
+
+
+def text_trigrams(text: str) -> Set[str]:
+    # Trigrams over the space-padded normalised string
+    padded = f" {normalize_catalog_text(text)} "
+    if len(padded) < 3:
+        return set()
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CatalogMatcher:
+    def __init__(self, entries: List[str]):
+        self.entries = entries
+        # Precompute the trigram set of every entry and the exact-match lookup
+        self.entry_trigrams: List[Set[str]] = [text_trigrams(entry) for entry in entries]
+        self.normalized_lookup: Dict[str, int] = {}
+        for entry_id, entry in enumerate(entries):
+            normalized = normalize_catalog_text(entry)
+            self.normalized_lookup.setdefault(normalized, entry_id)
+            # Also index the space-free form so "KUV 129 SL RP" finds "KUV129SL-RP"
+            self.normalized_lookup.setdefault(normalized.replace(" ", ""), entry_id)
+
+        # Inverted index: trigram -> ids of the entries containing it
+        self.postings: Dict[str, List[int]] = defaultdict(list)
+        for entry_id, grams in enumerate(self.entry_trigrams):
+            for gram in grams:
+                self.postings[gram].append(entry_id)
+
+    def match(self, value: str) -> Tuple[Optional[str], float]:
+        # Return the best catalog entry for the value with a Dice similarity score in 0-1
+        if not value or not self.entries:
+            return None, 0.0
+
+        # Exact matches after normalisation short-circuit the similarity search
+        normalized = normalize_catalog_text(value)
+        for key in (normalized, normalized.replace(" ", "")):
+            if key in self.normalized_lookup:
+                return self.entries[self.normalized_lookup[key]], 1.0
+
+        query_grams = text_trigrams(value)
+        if not query_grams:
+            return None, 0.0
+
+        # Count shared trigrams per entry through the inverted index
+        shared: Dict[int, int] = defaultdict(int)
+        for gram in query_grams:
+            for entry_id in self.postings.get(gram, ()):
+                shared[entry_id] += 1
+
+        best_id, best_score = None, 0.0
+        for entry_id, count in shared.items():
+            score = 2.0 * count / (len(query_grams) + len(self.entry_trigrams[entry_id]))
+            if score > best_score:
+                best_id, best_score = entry_id, score
+
+        if best_id is None:
+            return None, 0.0
+        return self.entries[best_id], round(best_score, 4)
+
+
+def canonicalize_body_fields(data: dict, body_model_matcher: CatalogMatcher,
+                             manufacturer_matcher: Optional[CatalogMatcher], min_score: float) -> Dict[str, Dict]:
+    # Replace body_model (and body_manufacturer when a catalog exists) with their canonical catalog entries
+    matches = {}
+    for field, matcher in (("body_model", body_model_matcher), ("body_manufacturer", manufacturer_matcher)):
+        value = data.get(field)
+        if matcher is None or not isinstance(value, str) or not value.strip():
+            continue
+
+        canonical, score = matcher.match(value)
+        # Only overwrite the extracted value when the match is confident enough
+        applied = canonical is not None and score >= min_score
+        matches[field] = {"original": value, "canonical": canonical, "score": score, "applied": applied}
+        if applied:
+            data[field] = canonical
+    return matches
@@ -0,0 +1,74 @@
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from catalog_matcher import normalize_catalog_text
+from wire_schema import BASE_COMPONENT_ID, WIRE_FIELDS
+
+
+def plan_chunks(page_count: int, pages_per_chunk: int) -> List[Tuple[int, int]]:
+    # Consecutive page ranges [start, end) of at most pages_per_chunk pages; a short last range joins the previous
+    # one so no chunk is left with a lone trailing page
+    pages_per_chunk = max(1, pages_per_chunk)
+    ranges = [(start, min(start + pages_per_chunk, page_count)) for start in range(0, page_count, pages_per_chunk)]
+    if len(ranges) > 1 and ranges[-1][1] - ranges[-1][0] < max(2, pages_per_chunk // 2):
+        ranges[-2:] = [(ranges[-2][0], ranges[-1][1])]
+    return ranges
+
+
+def reconcile_field(values: List[str]) -> str:
+    # The value most chunks agree on; ties go to the earliest chunk, which usually holds the invoice header
+    candidates = [value.strip() for value in values if isinstance(value, str) and value.strip()]
+    if not candidates:
+        return ""
+    counts = Counter(normalize_catalog_text(value) for value in candidates)
+    best = max(counts.values())
+    return next(value for value in candidates if counts[normalize_catalog_text(value)] == best)
+
+
+def attribute_map(component: Dict) -> Dict[str, str]:
+    return {normalize_catalog_text(str(attribute.get("name", ""))): str(attribute.get("value", ""))
+            for attribute in component.get("attributes", []) if isinstance(attribute, dict)}
+
+
+def is_duplicate_component(component: Dict, other: Dict) -> bool:
+    # Same name and no attribute stated with a different value: the same component seen by two chunks, e.g. a
+    # component listed across a page break or repeated in a summary
+    if normalize_catalog_text(str(component.get("name", ""))) != normalize_catalog_text(str(other.get("name", ""))):
+        return False
+    attributes, other_attributes = attribute_map(component), attribute_map(other)
+    return all(normalize_catalog_text(attributes[name]) == normalize_catalog_text(other_attributes[name])
+               for name in set(attributes) & set(other_attributes))
+
+
+def merge_components(records: List[Dict]) -> List[Dict]:
+    # Components of all chunks in page order; duplicates found by a later chunk add their missing attributes
+    merged: List[Dict] = []
+    for record in records:
+        # Within one chunk, components with the same name are distinct
+        chunk_start = len(merged)
+        for component in record.get("components") or []:
+            if not isinstance(component, dict):
+                continue
+            duplicate = next((existing for existing in merged[:chunk_start]
+                              if is_duplicate_component(existing, component)), None)
+            if duplicate is None:
+                merged.append({"name": component.get("name", ""),
+                               "attributes": [dict(attribute) for attribute in component.get("attributes", [])
+                                              if isinstance(attribute, dict)]})
+                continue
+            known = attribute_map(duplicate)
+            duplicate["attributes"] += [dict(attribute) for attribute in component.get("attributes", [])
+                                        if isinstance(attribute, dict)
+                                        and normalize_catalog_text(str(attribute.get("name", ""))) not in known]
+    # Number the merged components and their attributes as a single response would
+    return [{"id": BASE_COMPONENT_ID + index, "name": component["name"],
+             "attributes": [{**attribute, "id": position} for position, attribute in enumerate(component["attributes"])]}
+            for index, component in enumerate(merged)]
+
+
+def merge_chunk_records(records: List[Dict]) -> Dict:
+    # One record from the per-chunk records: header fields reconciled, components merged and de-duplicated
+    merged = {name: reconcile_field([record.get(name, "") for record in records]) for name in WIRE_FIELDS.values()}
+    merged["components"] = merge_components(records)
+    merged["documents"] = next((record["documents"] for record in records if record.get("documents")), [])
+    return merged
@@ -19,8 +19,10 @@ def load_environment_variables():
 
     # Set the training folder path, defaulting if not found
     training_folder = os.getenv("TRAINING_FOLDER", "../Training-pdf/")
-    # Define analysis features for document intelligence, here using high-resolution OCR
-    analysis_features = ["ocrHighResolution"]
+    # Additional analysis features for document intelligence (comma separated);
+    # high-resolution OCR is applied according to the OCR policy instead of always
+    analysis_features = [feature.strip() for feature in os.getenv("DI_ANALYSIS_FEATURES", "").split(",")
+                         if feature.strip()]
 
     # Return all loaded environment variables as a tuple
     return (
@@ -34,6 +36,334 @@ def load_environment_variables():
         analysis_features,
     )
 
+def get_bool_env(name: str, default: bool) -> bool:
+    # Interpret common truthy strings ("true", "1", "yes", "on") from an environment variable
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("true", "1", "yes", "on")
+
+def load_body_model_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # "retrieval" injects only the top-K catalog candidates into the prompt, "full" injects the whole catalog,
+    # "none" omits the catalog and relies on local canonicalization after extraction
+    prompt_mode = os.getenv("BODY_MODEL_PROMPT_MODE", "retrieval").strip().lower()
+    # Number of candidate body models to inject when retrieval is enabled
+    top_k = int(os.getenv("BODY_MODEL_TOP_K", "40"))
+    # Minimum candidate score (0-1) required to trust the retrieved list
+    min_score = float(os.getenv("BODY_MODEL_MIN_SCORE", "0.5"))
+    # Fall back to the full catalog when no candidate reaches the minimum score
+    full_list_fallback = get_bool_env("BODY_MODEL_FULL_LIST_FALLBACK", False)
+
+    return prompt_mode, top_k, min_score, full_list_fallback
+
+def load_canonicalization_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Match the extracted body_model/body_manufacturer against the catalogs after extraction
+    enabled = get_bool_env("BODY_MODEL_CANONICALIZE", True)
+    # Minimum similarity (0-1) required before an extracted value is replaced by its catalog entry
+    min_score = float(os.getenv("BODY_MODEL_CANONICAL_MIN_SCORE", "0.75"))
+    # Optional catalog of body manufacturer names, one per line
+    manufacturer_catalog_path = os.getenv("BODY_MANUFACTURER_CATALOG", "")
+
+    return enabled, min_score, manufacturer_catalog_path
+
+def load_ocr_cache_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Persist Document Intelligence results keyed by the PDF hash, model and analysis features
+    enabled = get_bool_env("OCR_CACHE_ENABLED", True)
+    # SQLite file shared by every session and worker on this machine
+    cache_path = os.getenv("OCR_CACHE_PATH", ".cache/ocr_cache.sqlite")
+    # Size budget before least-recently-used results are evicted
+    max_bytes = int(float(os.getenv("OCR_CACHE_MAX_MB", "512")) * 1024 * 1024)
+
+    return enabled, cache_path, max_bytes
+
+def load_llm_cache_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Reuse LLM responses for unchanged document text, prompt version, deployment and sampling parameters
+    enabled = get_bool_env("LLM_CACHE_ENABLED", True)
+    cache_path = os.getenv("LLM_CACHE_PATH", ".cache/llm_cache.sqlite")
+    max_bytes = int(float(os.getenv("LLM_CACHE_MAX_MB", "128")) * 1024 * 1024)
+    # Responses older than this are re-extracted
+    ttl_seconds = float(os.getenv("LLM_CACHE_TTL_HOURS", "168")) * 3600
+
+    return enabled, cache_path, max_bytes, ttl_seconds
+
+def load_batch_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Maximum number of LLM extractions running at the same time in a concurrent batch
+    concurrency = max(1, int(os.getenv("PROCESSING_CONCURRENCY", "4")))
+    # "concurrent" runs whole invoices in parallel, "pipelined" overlaps the OCR, LLM and validation stages,
+    # "packed" sends several small invoices in one LLM request
+    processing_mode = os.getenv("PROCESSING_MODE", "concurrent").strip().lower()
+    # Worker pool size of each pipeline stage, sized to the quota of the service it calls
+    stage_workers = {
+        "ocr": max(1, int(os.getenv("PIPELINE_OCR_WORKERS", "4"))),
+        "llm": max(1, int(os.getenv("PIPELINE_LLM_WORKERS", "4"))),
+        "validate": max(1, int(os.getenv("PIPELINE_VALIDATE_WORKERS", "1"))),
+    }
+    # Capacity of the bounded queue in front of each stage
+    queue_size = max(1, int(os.getenv("PIPELINE_QUEUE_SIZE", "4")))
+
+    return concurrency, processing_mode, stage_workers, queue_size
+
+def load_rate_limit_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Retry policy shared by both services
+    retry_settings = {
+        "max_retries": int(os.getenv("RATE_LIMIT_MAX_RETRIES", "5")),
+        "base_delay": float(os.getenv("RATE_LIMIT_BASE_DELAY_SECONDS", "1")),
+        "max_delay": float(os.getenv("RATE_LIMIT_MAX_DELAY_SECONDS", "60")),
+    }
+    # Azure OpenAI deployment quota; 0 disables a limit
+    openai_limits = {
+        "requests_per_minute": float(os.getenv("AZURE_OPENAI_RPM", "0")),
+        "tokens_per_minute": float(os.getenv("AZURE_OPENAI_TPM", "0")),
+        **retry_settings,
+    }
+    # Document Intelligence analyze request quota
+    doc_intelligence_limits = {
+        "requests_per_minute": float(os.getenv("AZURE_DOC_INTELLIGENCE_RPM", "0")),
+        **retry_settings,
+    }
+
+    return openai_limits, doc_intelligence_limits
+
+def load_usage_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # JSONL ledger with one usage entry per invoice, and a Prometheus textfile with the running totals; each
+    # process writes its own metrics file, named after the path with the process id appended
+    ledger_path = os.getenv("USAGE_LEDGER_PATH", "usage/ledger.jsonl")
+    metrics_path = os.getenv("USAGE_METRICS_PATH", "usage/metrics.prom")
+    # Prices used for the cost estimate (USD)
+    prices = {
+        "prompt_per_1k": float(os.getenv("PRICE_PROMPT_PER_1K_TOKENS", "0.0025")),
+        "cached_prompt_per_1k": float(os.getenv("PRICE_CACHED_PROMPT_PER_1K_TOKENS", "0.00125")),
+        "completion_per_1k": float(os.getenv("PRICE_COMPLETION_PER_1K_TOKENS", "0.01")),
+        "di_per_page": float(os.getenv("PRICE_DI_PER_PAGE", "0.016")),
+        # Add-on per high-resolution page; 0 by default, since PRICE_DI_PER_PAGE has always been the
+        # high-resolution rate and existing cost reports stay comparable
+        "di_high_res_per_page": float(os.getenv("PRICE_DI_HIGH_RES_PER_PAGE", "0")),
+    }
+
+    return ledger_path, metrics_path, prices
+
+def load_tracing_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Record timing spans for each pipeline stage; off by default since the span file is never rotated
+    enabled = get_bool_env("TRACING_ENABLED", False)
+    # JSONL file the spans are appended to; empty keeps them in memory only
+    export_path = os.getenv("TRACE_EXPORT_PATH", "traces/spans.jsonl")
+
+    return enabled, export_path
+
+def load_text_layer_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Extract pages that have an embedded text layer locally and send only scanned pages to Document Intelligence
+    enabled = get_bool_env("TEXT_LAYER_FAST_PATH", True)
+    # Minimum visible characters for a page's text layer to count as usable
+    min_chars = int(os.getenv("TEXT_LAYER_MIN_CHARS", "50"))
+
+    return enabled, min_chars
+
+def load_ocr_policy_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # "adaptive" escalates low-confidence pages to ocrHighResolution, "high_resolution" always uses it,
+    # "standard" never does
+    mode = os.getenv("OCR_POLICY", "adaptive").strip().lower()
+    # Pages whose mean word confidence falls below this are re-analyzed in high resolution
+    min_confidence = float(os.getenv("OCR_ESCALATION_MIN_CONFIDENCE", "0.9"))
+    # Added to the threshold when the standard pass found neither a VIN-like token nor a total
+    key_field_margin = float(os.getenv("OCR_KEY_FIELD_MARGIN", "0.05"))
+
+    return mode, min_confidence, key_field_margin
+
+def load_doc_intelligence_scheduler_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Analyze operations outstanding at once across the batch, and the pooled connections serving them
+    max_in_flight = max(1, int(os.getenv("DI_MAX_IN_FLIGHT", "16")))
+    # Bounds of the adaptive interval between polls of one operation
+    min_poll_interval = float(os.getenv("DI_MIN_POLL_SECONDS", "0.5"))
+    max_poll_interval = float(os.getenv("DI_MAX_POLL_SECONDS", "5"))
+
+    return max_in_flight, min_poll_interval, max_poll_interval
+
+def load_content_mode_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # "flat" sends the page text as laid out; "structured" sends DI tables as delimited rows and
+    # key-value pairs as "key: value" lines
+    return os.getenv("CONTENT_MODE", "flat").strip().lower()
+
+def load_compaction_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Strip boilerplate pages and repeated headers/footers before the LLM call; disable to debug extraction
+    enabled = get_bool_env("DOCUMENT_COMPACTION", True)
+    # A line repeated on at least this share of the pages is treated as a header or footer
+    min_page_share = float(os.getenv("COMPACTION_REPEATED_LINE_SHARE", "0.6"))
+    # Legal-vocabulary hits needed before a page without a VIN or amounts is dropped as boilerplate
+    min_boilerplate_keywords = int(os.getenv("COMPACTION_BOILERPLATE_KEYWORDS", "8"))
+
+    return enabled, min_page_share, min_boilerplate_keywords
+
+def load_hybrid_extraction_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Take distributor, distributor_location and invoice_date from the prebuilt-invoice fields instead of the LLM
+    enabled = get_bool_env("HYBRID_EXTRACTION", True)
+    # Minimum DI field confidence for a value to be used as is
+    min_confidence = float(os.getenv("DI_FIELD_MIN_CONFIDENCE", "0.8"))
+
+    return enabled, min_confidence
+
+def load_fast_path_extractor_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Pin VIN, model year, stock number and invoice date found by the local rule-based extractors
+    return get_bool_env("FAST_PATH_EXTRACTORS", True)
+
+def load_output_format_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # "compact" asks for short keys and positional attribute pairs expanded locally; "full" for the verbose structure
+    output_format = os.getenv("LLM_OUTPUT_FORMAT", "compact").strip().lower()
+    # The compact response's max_tokens: a fixed allowance for the header fields plus a share of the document tokens
+    base_tokens = int(os.getenv("WIRE_MAX_TOKENS_BASE", "400"))
+    tokens_per_document_token = float(os.getenv("WIRE_MAX_TOKENS_PER_DOCUMENT_TOKEN", "0.35"))
+
+    return output_format, base_tokens, tokens_per_document_token
+
+def load_response_format_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # "json_schema" constrains the response to a schema of the requested fields, "json_object" only to valid
+    # JSON, "none" leaves it unconstrained; deployments without schema support fall back to json_object
+    return os.getenv("LLM_RESPONSE_FORMAT", "json_schema").strip().lower()
+
+def load_packing_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Documents up to this many tokens are packed together in PROCESSING_MODE=packed; larger ones go alone
+    max_document_tokens = int(os.getenv("PACK_MAX_DOCUMENT_TOKENS", "1500"))
+    # Total document tokens and number of invoices per packed request
+    token_budget = int(os.getenv("PACK_TOKEN_BUDGET", "6000"))
+    max_invoices = max(1, int(os.getenv("PACK_MAX_INVOICES", "8")))
+    # Upper bound of a packed request's max_tokens, the sum of its invoices' allowances otherwise
+    max_output_tokens = int(os.getenv("PACK_MAX_OUTPUT_TOKENS", "16000"))
+
+    return max_document_tokens, token_budget, max_invoices, max_output_tokens
+
+def load_prompt_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Locally counted prompt tokens allowed per request; optional sections are dropped to fit, 0 disables the limit
+    input_token_budget = int(os.getenv("PROMPT_INPUT_TOKEN_BUDGET", "0"))
+    # Remove the instructions of pinned fields from the prompt and leave them out of the requested output. On by
+    # default for the prompt and completion tokens it saves; the static prefix then differs between invoices, so
+    # the provider's prompt cache is only shared by invoices with the same pinned fields
+    trim_pinned_fields = get_bool_env("PROMPT_TRIM_PINNED_FIELDS", True)
+
+    return input_token_budget, trim_pinned_fields
+
+def load_cascade_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Deployments tried in order, cheapest first (e.g. "gpt-4o-mini,gpt-4o"); an invoice whose result fails the
+    # local checks escalates to the next one. Empty uses AZURE_OPENAI_DEPLOYMENT alone
+    deployments = [name.strip() for name in os.getenv("LLM_CASCADE_DEPLOYMENTS", "").split(",") if name.strip()]
+    # Sampling temperature of every tier but the last, which keeps the usual sampling parameters
+    temperature = float(os.getenv("LLM_CASCADE_TEMPERATURE", "0.0"))
+    # Fields a tier's result must contain to be accepted
+    required_fields = [name.strip() for name in os.getenv("LLM_CASCADE_REQUIRED_FIELDS", "vin,make,model").split(",")
+                       if name.strip()]
+    # Prompt and completion prices per 1K tokens of each tier as "prompt/completion", in deployment order;
+    # tiers without one use the PRICE_* settings
+    prices = {}
+    for deployment, price in zip(deployments, os.getenv("LLM_CASCADE_PRICES", "").split(",")):
+        if price.strip():
+            prompt_price, completion_price = (float(value) for value in price.split("/"))
+            prices[deployment] = {"prompt_per_1k": prompt_price, "completion_per_1k": completion_price}
+
+    return deployments, temperature, required_fields, prices
+
+def load_chunking_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Documents with at least this many pages (after compaction) are extracted in page-range chunks whose
+    # records are merged locally; 0 disables chunked extraction
+    min_pages = int(os.getenv("CHUNKED_EXTRACTION_MIN_PAGES", "12"))
+    # Pages per chunk and the number of chunks extracted at the same time
+    pages_per_chunk = max(1, int(os.getenv("CHUNK_PAGES", "4")))
+    workers = max(1, int(os.getenv("CHUNK_WORKERS", "4")))
+
+    return min_pages, pages_per_chunk, workers
+
+def load_bulk_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Worker processes of the bulk runner, each with its own InvoiceProcessor
+    workers = max(1, int(os.getenv("BULK_WORKERS", "4")))
+    # Output folder, in the layout of the app's saved files, and the checkpoint manifest used to resume a run
+    output_dir = os.getenv("BULK_OUTPUT_DIR", "processed_output")
+    manifest_path = os.getenv("BULK_MANIFEST_PATH", os.path.join(output_dir, "manifest.jsonl"))
+
+    return workers, output_dir, manifest_path
+
+def load_job_queue_settings():
+    # Load environment variables from a .env file
+    load_dotenv()
+
+    # Hand uploads to standalone worker processes (queue_worker.py) through a SQLite job queue instead of
+    # processing them inside the Streamlit run
+    enabled = get_bool_env("JOB_QUEUE_ENABLED", False)
+    # Queue database and the folder the UI copies uploads to; both must be on a disk shared with the workers
+    queue_path = os.getenv("JOB_QUEUE_PATH", os.path.join("queue", "jobs.sqlite3"))
+    upload_dir = os.getenv("JOB_QUEUE_UPLOAD_DIR", os.path.join("queue", "uploads"))
+    # A job whose worker stops renewing its lease for this long is handed to another worker
+    lease_seconds = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+    # Attempts before a job is dead-lettered, and the delay before the first retry (doubled for each further one)
+    max_attempts = max(1, int(os.getenv("JOB_MAX_ATTEMPTS", "3")))
+    retry_delay_seconds = float(os.getenv("JOB_RETRY_DELAY_SECONDS", "30"))
+    # How often idle workers and the UI poll the queue
+    poll_seconds = float(os.getenv("JOB_POLL_SECONDS", "2"))
+
+    return enabled, queue_path, upload_dir, lease_seconds, max_attempts, retry_delay_seconds, poll_seconds
+
 def load_body_models(file_path: str = "body_model.txt") -> list[str]:
     # Attempt to open and read the file containing body models
     try:
@@ -0,0 +1,337 @@
+import time
+import base64
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import requests
+from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.ai.documentintelligence.models import AnalyzeResult
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from azure.core.rest import HttpRequest
+
+from rate_limiter import parse_retry_after
+from page_compaction import has_key_fields
+
+HIGH_RESOLUTION_FEATURE = "ocrHighResolution"
+KEY_VALUE_PAIRS_FEATURE = "keyValuePairs"
+API_VERSION = "2024-11-30"
+
+# prebuilt-invoice fields that fill output fields directly
+INVOICE_FIELD_MAP = {
+    "VendorName": "distributor",
+    "VendorAddress": "distributor_location",
+    "InvoiceDate": "invoice_date",
+}
+
+
+@dataclass
+class OcrPolicy:
+    # "high_resolution" always uses ocrHighResolution, "standard" never does,
+    # "adaptive" runs standard OCR and re-analyzes only low-confidence pages in high resolution
+    mode: str = "adaptive"
+    features: List[str] = field(default_factory=list)
+    min_confidence: float = 0.9
+    key_field_margin: float = 0.05
+
+    def base_features(self) -> List[str]:
+        # Features for the first pass; high resolution is only requested up front in high_resolution mode
+        features = [feature for feature in self.features if feature != HIGH_RESOLUTION_FEATURE]
+        if self.mode == "high_resolution":
+            features.append(HIGH_RESOLUTION_FEATURE)
+        return features
+
+    def escalation_features(self) -> List[str]:
+        return self.base_features() + [HIGH_RESOLUTION_FEATURE]
+
+    def cache_key(self) -> Dict[str, Any]:
+        # Everything that changes the OCR output, for the OCR cache key
+        return {
+            "mode": self.mode,
+            "features": sorted(self.features),
+            "min_confidence": self.min_confidence if self.mode == "adaptive" else None,
+            "key_field_margin": self.key_field_margin if self.mode == "adaptive" else None,
+        }
+
+
+def create_client(endpoint: str, key: str, pool_size: int = 10) -> DocumentIntelligenceClient:
+    # One client per scheduler; its session keeps up to pool_size connections alive between requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    # The SDK's own retries are disabled so throttled calls are retried only by the quota limiter
+    return DocumentIntelligenceClient(endpoint=endpoint, credential=AzureKeyCredential(key),
+                                      transport=RequestsTransport(session=session, session_owner=True),
+                                      retry_total=0)
+
+
+@dataclass
+class _Operation:
+    # A submitted analysis awaiting its result
+    url: str
+    future: Future
+    submitted_at: float
+    next_poll_at: float
+    interval: float
+    # Throttled or failed polls in a row, reset by any other response
+    poll_failures: int = 0
+
+
+class AnalysisScheduler:
+    def __init__(self, client: DocumentIntelligenceClient, limiter: Any, max_in_flight: int = 16,
+                 min_poll_interval: float = 0.5, max_poll_interval: float = 5.0, max_poll_failures: int = 5):
+        self.client = client
+        self.limiter = limiter
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        # A 429 or 5xx poll is retried with backoff until this many fail in a row, then the operation fails
+        self.max_poll_failures = max_poll_failures
+        # Submissions block once this many operations are outstanding
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._pending: List[_Operation] = []
+        self._condition = threading.Condition()
+        self._poller: Optional[threading.Thread] = None
+        # Recent operation durations, used to time the first poll of new operations
+        self._durations = deque(maxlen=50)
+        self.counters = {"submitted": 0, "succeeded": 0, "failed": 0, "polls": 0, "poll_retries": 0,
+                         "max_in_flight": 0}
+
+    def _start(self, model_id: str, data: bytes, features: List[str], pages: Optional[str]) -> tuple:
+        # Submit the analysis and return its operation URL and the service's suggested poll delay
+        params = {"api-version": API_VERSION}
+        if features:
+            params["features"] = ",".join(features)
+        if pages:
+            params["pages"] = pages
+        request = HttpRequest("POST", f"/documentModels/{model_id}:analyze", params=params,
+                              json={"base64Source": base64.b64encode(data).decode("ascii")})
+        response = self.client.send_request(request)
+        response.raise_for_status()
+        return response.headers["Operation-Location"], parse_retry_after(response.headers)
+
+    def first_poll_delay(self, retry_after: Optional[float]) -> float:
+        # Wait most of a typical operation's duration before the first poll, once durations are known
+        if self._durations:
+            expected = 0.8 * sum(self._durations) / len(self._durations)
+            return min(self.max_poll_interval, max(self.min_poll_interval, expected))
+        return max(self.min_poll_interval, retry_after or 0.0)
+
+    def submit(self, model_id: str, data: bytes, features: List[str], pages: Optional[str] = None) -> Future:
+        # Start an analysis and return a future resolved with its AnalyzeResult
+        future = Future()
+        self._slots.acquire()
+        try:
+            url, retry_after = self.limiter.call(lambda: self._start(model_id, data, features, pages))
+        except Exception as e:
+            self._slots.release()
+            future.set_exception(e)
+            return future
+
+        now = time.monotonic()
+        with self._condition:
+            self._pending.append(_Operation(url, future, now, now + self.first_poll_delay(retry_after),
+                                            self.min_poll_interval))
+            self.counters["submitted"] += 1
+            self.counters["max_in_flight"] = max(self.counters["max_in_flight"], len(self._pending))
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll_loop, name="di-poller", daemon=True)
+                self._poller.start()
+            self._condition.notify()
+        return future
+
+    def analyze(self, model_id: str, data: bytes, features: List[str], pages: Optional[str] = None) -> Any:
+        return self.submit(model_id, data, features, pages).result()
+
+    def _poll_loop(self):
+        # A single thread polls every outstanding operation when it is due
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                now = time.monotonic()
+                due = [operation for operation in self._pending if operation.next_poll_at <= now]
+                if not due:
+                    self._condition.wait(min(operation.next_poll_at for operation in self._pending) - now)
+                    continue
+            for operation in due:
+                self._poll(operation)
+
+    def _poll(self, operation: _Operation):
+        try:
+            response = self.client.send_request(HttpRequest("GET", operation.url))
+            with self._condition:
+                self.counters["polls"] += 1
+            retry_after = parse_retry_after(response.headers)
+            if response.status_code == 429 or response.status_code >= 500:
+                # Throttled polls and transient service errors just wait longer, up to a bounded number of times
+                operation.poll_failures += 1
+                if operation.poll_failures <= self.max_poll_failures:
+                    with self._condition:
+                        self.counters["poll_retries"] += 1
+                    self._reschedule(operation, retry_after)
+                    return
+            else:
+                operation.poll_failures = 0
+            response.raise_for_status()
+            body = response.json()
+            status = body.get("status")
+            if status == "succeeded":
+                self._finish(operation, result=AnalyzeResult(body["analyzeResult"]))
+            elif status in ("failed", "canceled"):
+                error = body.get("error") or {}
+                self._finish(operation, error=Exception(f"Analysis {status}: {error.get('message', error)}"))
+            else:
+                self._reschedule(operation, retry_after)
+        except Exception as e:
+            self._finish(operation, error=e)
+
+    def _reschedule(self, operation: _Operation, retry_after: Optional[float]):
+        # Back off geometrically while an operation keeps running
+        operation.interval = min(self.max_poll_interval, operation.interval * 1.5)
+        operation.next_poll_at = time.monotonic() + max(operation.interval, retry_after or 0.0)
+
+    def _finish(self, operation: _Operation, result: Any = None, error: Optional[Exception] = None):
+        with self._condition:
+            self._pending.remove(operation)
+            self.counters["succeeded" if error is None else "failed"] += 1
+            if error is None:
+                self._durations.append(time.monotonic() - operation.submitted_at)
+        self._slots.release()
+        if error is None:
+            operation.future.set_result(result)
+        else:
+            operation.future.set_exception(error)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            stats = dict(self.counters)
+            stats["in_flight"] = len(self._pending)
+            stats["mean_operation_seconds"] = round(sum(self._durations) / len(self._durations), 3) \
+                if self._durations else 0.0
+        return stats
+
+
+# Schedulers are shared per endpoint across every InvoiceProcessor in the process, so processors built on
+# each Streamlit rerun reuse one polling thread and connection pool
+_schedulers: Dict[str, AnalysisScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(endpoint: str, key: str, limiter: Any, max_in_flight: int = 16, min_poll_interval: float = 0.5,
+                  max_poll_interval: float = 5.0) -> AnalysisScheduler:
+    # Return the process-wide scheduler for an endpoint, creating its client and scheduler on first use
+    with _schedulers_lock:
+        if endpoint not in _schedulers:
+            client = create_client(endpoint, key, pool_size=max_in_flight)
+            _schedulers[endpoint] = AnalysisScheduler(client, limiter, max_in_flight=max_in_flight,
+                                                      min_poll_interval=min_poll_interval,
+                                                      max_poll_interval=max_poll_interval)
+        return _schedulers[endpoint]
+
+
+def page_texts(result: Any) -> List[str]:
+    # One string per page, one line of text per line so repeated headers and footers can be recognised
+    return ["\n".join(line.content for line in (page.lines or [])) for page in (result.pages or [])]
+
+
+def span_ranges(spans: Any) -> List[tuple]:
+    return [(item.offset, item.offset + item.length) for item in spans or []]
+
+
+def in_ranges(offset: int, ranges: List[tuple]) -> bool:
+    return any(start <= offset < end for start, end in ranges)
+
+
+def clean_cell(text: Optional[str]) -> str:
+    # Keep every row on one line and the delimiter unambiguous
+    return " ".join((text or "").replace("|", "/").split())
+
+
+def first_page_number(element: Any) -> int:
+    regions = element.bounding_regions or []
+    return regions[0].page_number if regions else 1
+
+
+def serialize_table(table: Any) -> List[str]:
+    # Pipe-delimited rows, header row first, with empty rows and columns dropped
+    grid = [["" for _ in range(table.column_count)] for _ in range(table.row_count)]
+    for cell in table.cells:
+        grid[cell.row_index][cell.column_index] = clean_cell(cell.content)
+    used_columns = [index for index in range(table.column_count) if any(row[index] for row in grid)]
+    return ["|".join(row[index] for index in used_columns) for row in grid if any(row)]
+
+
+def structured_page_texts(result: Any) -> List[str]:
+    # One string per page: the text outside tables and key-value pairs, then "key: value" lines,
+    # then each table as delimited rows, instead of the flattened layout text
+    covered = []
+    tables_by_page: Dict[int, List[Any]] = {}
+    for table in result.tables or []:
+        covered.extend(span_ranges(table.spans))
+        tables_by_page.setdefault(first_page_number(table), []).append(table)
+    pairs_by_page: Dict[int, List[str]] = {}
+    for pair in result.key_value_pairs or []:
+        key = clean_cell(pair.key.content)
+        value = clean_cell(pair.value.content) if pair.value else ""
+        if not key or not value:
+            continue
+        covered.extend(span_ranges(pair.key.spans) + span_ranges(pair.value.spans))
+        pairs_by_page.setdefault(first_page_number(pair.key), []).append(f"{key}: {value}")
+
+    texts = []
+    for page in result.pages or []:
+        lines = [line.content for line in page.lines or []
+                 if not line.spans or not in_ranges(line.spans[0].offset, covered)]
+        lines.extend(pairs_by_page.get(page.page_number, []))
+        for table in tables_by_page.get(page.page_number, []):
+            lines.extend(serialize_table(table))
+        texts.append("\n".join(lines))
+    return texts
+
+
+def format_field_value(name: str, document_field: Any) -> str:
+    # Render a DI field in the output format: "City, State ZIP" addresses and YYYY-MM-DD dates
+    if name == "VendorAddress" and document_field.value_address:
+        address = document_field.value_address
+        region = " ".join(part for part in (address.state, address.postal_code) if part)
+        return ", ".join(part for part in (address.city, region) if part)
+    if name == "InvoiceDate" and document_field.value_date:
+        return document_field.value_date.isoformat()
+    return " ".join((document_field.value_string or document_field.content or "").split())
+
+
+def invoice_fields(result: Any, min_confidence: float) -> Dict[str, str]:
+    # Output fields taken from the first analyzed invoice, keeping only confident, non-empty values
+    documents = result.documents or []
+    if not documents:
+        return {}
+    fields = {}
+    for name, output_name in INVOICE_FIELD_MAP.items():
+        document_field = (documents[0].fields or {}).get(name)
+        if document_field is None or (document_field.confidence or 0.0) < min_confidence:
+            continue
+        value = format_field_value(name, document_field)
+        if value:
+            fields[output_name] = value
+    return fields
+
+
+def page_confidences(result: Any) -> List[float]:
+    # Mean word confidence per page; pages without words count as confident (blank pages don't need a rerun)
+    confidences = []
+    for page in result.pages or []:
+        words = page.words or []
+        confidences.append(sum(word.confidence for word in words) / len(words) if words else 1.0)
+    return confidences
+
+
+def select_pages_to_escalate(texts: List[str], confidences: List[float], policy: OcrPolicy) -> List[int]:
+    # Return the 0-based indices of pages that need a high-resolution pass
+    threshold = policy.min_confidence
+    # Be stricter when the standard pass found neither a VIN-like token nor a total anywhere
+    if not has_key_fields(" ".join(texts)):
+        threshold += policy.key_field_margin
+    return [index for index, confidence in enumerate(confidences) if confidence < threshold]
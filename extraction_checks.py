@@ -0,0 +1,28 @@
+from typing import Dict, List, Optional
+
+from catalog_matcher import CatalogMatcher
+from field_extractors import VIN_YEAR_CODES, is_valid_vin
+
+
+def vin_year_matches(vin: str, model_year: str) -> bool:
+    # The year code at position 10 repeats every 30 years, so only the year modulo 30 can be checked
+    index = VIN_YEAR_CODES.find(vin[9])
+    return index >= 0 and model_year.isdigit() and (int(model_year) - 1980) % 30 == index
+
+
+def check_extraction(data: Dict, required_fields: List[str], body_model_matcher: Optional[CatalogMatcher] = None,
+                     min_score: float = 0.0) -> List[str]:
+    # Local consistency checks of an extracted record; an empty list means it can be accepted as is
+    problems = [f"{name} missing" for name in required_fields if not str(data.get(name) or "").strip()]
+    vin = str(data.get("vin") or "").strip().upper()
+    if vin:
+        if not is_valid_vin(vin):
+            problems.append("vin check digit invalid")
+        elif str(data.get("model_year") or "").strip() and not vin_year_matches(vin, str(data["model_year"]).strip()):
+            problems.append("model_year inconsistent with vin")
+    body_model = str(data.get("body_model") or "").strip()
+    if body_model and body_model_matcher is not None and body_model_matcher.entries:
+        _, score = body_model_matcher.match(body_model)
+        if score < min_score:
+            problems.append("body_model not in catalog")
+    return problems
@@ -0,0 +1,144 @@
+import re
+from datetime import date
+from typing import Dict, List, Optional
+
+# VIN transliteration values and position weights of the North American check digit (49 CFR 565)
+VIN_VALUES = {**{str(digit): digit for digit in range(10)},
+              "A": 1, "B": 2, "C": 3, "D": 4, "E": 5, "F": 6, "G": 7, "H": 8,
+              "J": 1, "K": 2, "L": 3, "M": 4, "N": 5, "P": 7, "R": 9,
+              "S": 2, "T": 3, "U": 4, "V": 5, "W": 6, "X": 7, "Y": 8, "Z": 9}
+VIN_WEIGHTS = [8, 7, 6, 5, 4, 3, 2, 10, 0, 9, 8, 7, 6, 5, 4, 3, 2]
+# Position 10 year codes; the cycle repeats every 30 years from 1980
+VIN_YEAR_CODES = "ABCDEFGHJKLMNPRSTVWXY123456789"
+# Letters never used in a VIN, as OCR usually misreads them
+VIN_OCR_FIXES = str.maketrans({"I": "1", "O": "0", "Q": "0"})
+VIN_CANDIDATE_PATTERN = re.compile(r"(?<![A-Z0-9])[A-Z0-9]{17}(?![A-Z0-9])")
+
+STOCK_NUMBER_PATTERN = re.compile(
+    r"\b(?:stock|stk)\s*(?:#|no\.?|num(?:ber)?)\s*[:#]?\s*([A-Z0-9][A-Z0-9-]{2,19})\b", re.IGNORECASE)
+
+MONTHS = {name: index for index, names in enumerate(
+    [("jan", "january"), ("feb", "february"), ("mar", "march"), ("apr", "april"), ("may",), ("jun", "june"),
+     ("jul", "july"), ("aug", "august"), ("sep", "sept", "september"), ("oct", "october"),
+     ("nov", "november"), ("dec", "december")], start=1) for name in names}
+MONTH_NAME = r"(jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sept?(?:ember)?|" \
+             r"oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\.?"
+DATE_PATTERNS = [
+    # 2024-03-05
+    (re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b"), ("year", "month", "day")),
+    # 03/05/2024, 3-5-24, 03.05.2024 (US order)
+    (re.compile(r"\b(\d{1,2})[/.-](\d{1,2})[/.-](\d{4}|\d{2})\b"), ("month", "day", "year")),
+    # March 5, 2024
+    (re.compile(MONTH_NAME + r"\s+(\d{1,2})(?:st|nd|rd|th)?,?\s+(\d{4})\b", re.IGNORECASE), ("month", "day", "year")),
+    # 05-Mar-2024, 5 March 2024
+    (re.compile(r"\b(\d{1,2})[\s-]+" + MONTH_NAME + r"[\s,-]+(\d{4}|\d{2})\b", re.IGNORECASE),
+     ("day", "month", "year")),
+]
+INVOICE_DATE_LABEL_PATTERN = re.compile(r"\binvoice\s+date\b\s*[:#]?\s*", re.IGNORECASE)
+
+
+def vin_check_digit(vin: str) -> str:
+    # Weighted sum of the transliterated characters modulo 11, with 10 written as "X"
+    remainder = sum(VIN_VALUES[char] * weight for char, weight in zip(vin, VIN_WEIGHTS)) % 11
+    return "X" if remainder == 10 else str(remainder)
+
+
+def is_valid_vin(vin: str) -> bool:
+    return (len(vin) == 17 and all(char in VIN_VALUES for char in vin)
+            and vin[8] == vin_check_digit(vin))
+
+
+def find_vins(text: str) -> List[str]:
+    # Distinct 17-character tokens that pass the check digit once misread I/O/Q are corrected, in text order
+    vins = []
+    for match in VIN_CANDIDATE_PATTERN.finditer(text.upper()):
+        candidate = match.group(0).translate(VIN_OCR_FIXES)
+        if candidate.isdigit() or candidate.isalpha():
+            continue
+        if is_valid_vin(candidate) and candidate not in vins:
+            vins.append(candidate)
+    return vins
+
+
+def decode_model_year(vin: str, today: Optional[date] = None) -> str:
+    # The year code repeats every 30 years; take the latest year no later than next year's models
+    index = VIN_YEAR_CODES.find(vin[9]) if len(vin) == 17 else -1
+    if index < 0:
+        return ""
+    latest = (today or date.today()).year + 1
+    year = 1980 + index
+    while year + 30 <= latest:
+        year += 30
+    return str(year)
+
+
+def build_date(year: int, month: int, day: int) -> str:
+    if year < 100:
+        year += 2000
+    try:
+        return date(year, month, day).isoformat()
+    except ValueError:
+        return ""
+
+
+def parse_date(text: str, search: bool = False) -> str:
+    # First date in the text (search) or the text as a whole, as YYYY-MM-DD; "" when nothing parses
+    for pattern, order in DATE_PATTERNS:
+        match = pattern.search(text) if search else pattern.fullmatch(text.strip())
+        if not match:
+            continue
+        parts = dict(zip(order, match.groups()))
+        month = parts["month"]
+        month = MONTHS.get(month.lower().rstrip(".")) if not month.isdigit() else int(month)
+        if month:
+            normalized = build_date(int(parts["year"]), month, int(parts["day"]))
+            if normalized:
+                return normalized
+    return ""
+
+
+def find_stock_numbers(text: str) -> List[str]:
+    # Distinct labeled stock numbers; a value must contain a digit to tell it apart from a following word
+    numbers = []
+    for match in STOCK_NUMBER_PATTERN.finditer(text):
+        value = match.group(1).upper()
+        if any(char.isdigit() for char in value) and value not in numbers:
+            numbers.append(value)
+    return numbers
+
+
+def find_invoice_dates(text: str) -> List[str]:
+    # Distinct dates following an "Invoice Date" label, on the same or the next line
+    dates = []
+    for match in INVOICE_DATE_LABEL_PATTERN.finditer(text):
+        value = parse_date(text[match.end():match.end() + 40], search=True)
+        if value and value not in dates:
+            dates.append(value)
+    return dates
+
+
+def extract_fast_path_fields(text: str, today: Optional[date] = None) -> Dict[str, str]:
+    # Fields found unambiguously in the OCR text; a field with several distinct candidates is left to the LLM
+    fields = {}
+    vins = find_vins(text)
+    if len(vins) == 1:
+        fields["vin"] = vins[0]
+        model_year = decode_model_year(vins[0], today)
+        if model_year:
+            fields["model_year"] = model_year
+    stock_numbers = find_stock_numbers(text)
+    if len(stock_numbers) == 1:
+        fields["stock_number"] = stock_numbers[0]
+    invoice_dates = find_invoice_dates(text)
+    if len(invoice_dates) == 1:
+        fields["invoice_date"] = invoice_dates[0]
+    return fields
+
+
+def normalize_date_fields(data: Dict, names: tuple = ("invoice_date", "inventory_arrival_date")) -> Dict:
+    # Rewrite dates returned by the LLM as YYYY-MM-DD, leaving values that do not parse untouched
+    for name in names:
+        value = data.get(name)
+        if isinstance(value, str) and value:
+            data[name] = parse_date(value) or value
+    return data
@@ -1,3 +1,5 @@
+import re
+
 guidelines = """
 GENERIC AUTOMOBILE INVOICE PARSING GUIDELINES FOR ALL VEHICLE TYPES:
 
@@ -245,4 +247,49 @@ GENERIC AUTOMOBILE INVOICE PARSING GUIDELINES FOR ALL VEHICLE TYPES:
 10. Correct VIN characters: 'O'→'0', 'I'→'1', 'Q'→'0'
 
 **RETURN ONLY VALID JSON WITH DYNAMIC STRUCTURE BASED ON ACTUAL INVOICE CONTENT**
-"""
\ No newline at end of file
+"""
+
+def section_field(section: str):
+    # A numbered section is about a single field when its first bullet defines that field in bold
+    if not re.match(r"\*\*\d+\. ", section):
+        return None
+    first_bullet = next((line for line in section.split("\n")[1:] if line.startswith("- ")), "")
+    match = re.match(r"- \*\*(\w+)\*\*:", first_bullet)
+    return match.group(1) if match else None
+
+
+def without_field_instructions(text: str, fields) -> str:
+    # Drop the guideline sections and instruction lines that only concern the given output fields
+    if not fields:
+        return text
+    field_markers = tuple(f"- **{name}**:" for name in fields) + tuple(f"- {name}:" for name in fields)
+    kept = []
+    for section in re.split(r"\n(?=\*\*)", text):
+        if section_field(section) in fields:
+            continue
+        kept.append("\n".join(line for line in section.split("\n") if not line.startswith(field_markers)))
+    return "\n".join(kept)
+
+
+def field_guidelines(fields) -> str:
+    # Only the guideline sections of the given output fields, for prompts that ask for just those
+    return "\n\n".join(section.strip() for section in re.split(r"\n(?=\*\*)", guidelines)
+                     if section_field(section) in fields)
+
+
+def without_sections(text: str, titles, line_markers=()) -> str:
+    # Drop the numbered sections with the given titles and every line containing one of the markers
+    sections = re.split(r"\n(?=\*\*)", text)
+    kept = [section for section in sections
+            if not any(re.match(rf"\*\*\d+\. {re.escape(title)}:\*\*", section) for title in titles)]
+    return "\n".join(line for line in "\n".join(kept).split("\n")
+                     if not any(marker in line for marker in line_markers))
+
+
+def split_at_sections(text: str, first_title: str, end_title: str):
+    # The text before the section titled first_title, the sections from it up to end_title, and the rest;
+    # joined back with newlines the three parts give the original text
+    sections = re.split(r"\n(?=\*\*)", text)
+    headings = [section.split("\n", 1)[0] for section in sections]
+    start, end = headings.index(f"**{first_title}:**"), headings.index(f"**{end_title}:**")
+    return "\n".join(sections[:start]), "\n".join(sections[start:end]), "\n".join(sections[end:])
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import sqlite3
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+# Job states: queued (waiting or backing off before a retry), leased (held by a worker), done, and dead
+# (out of attempts, kept for inspection and manual requeueing)
+JOB_STATUSES = ("queued", "leased", "done", "dead")
+
+
+class JobQueue:
+    def __init__(self, db_path: str, lease_seconds: float = 300.0, max_attempts: int = 3,
+                 retry_delay_seconds: float = 30.0):
+        self.db_path = db_path
+        # A worker must finish or extend its lease within this time, or the job is handed to another worker
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Delay before the first retry, doubled for every further attempt
+        self.retry_delay_seconds = retry_delay_seconds
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self._transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    batch_id TEXT NOT NULL,
+                    file_path TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    force_reextract INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    max_attempts INTEGER NOT NULL,
+                    available_at REAL NOT NULL,
+                    lease_owner TEXT,
+                    lease_expires_at REAL,
+                    result TEXT,
+                    usage TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, available_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs (batch_id)")
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never lease the same job; the connection
+        # is short-lived, as in DiskCache, so the queue is safe to share between threads and processes
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def enqueue(self, batch_id: str, file_path: str, filename: str, force_reextract: bool = False) -> int:
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (batch_id, file_path, filename, force_reextract, status, attempts, max_attempts, "
+                "available_at, created_at, updated_at) VALUES (?, ?, ?, ?, 'queued', 0, ?, ?, ?, ?)",
+                (batch_id, file_path, filename, int(force_reextract), self.max_attempts, now, now, now),
+            )
+            return cursor.lastrowid
+
+    def _expire_leases(self, conn: sqlite3.Connection, now: float):
+        # A lease that ran out means the worker died or stalled; the attempt counts as failed
+        for row in conn.execute("SELECT id, attempts, max_attempts FROM jobs "
+                                "WHERE status = 'leased' AND lease_expires_at <= ?", (now,)).fetchall():
+            status = "dead" if row["attempts"] >= row["max_attempts"] else "queued"
+            conn.execute("UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires_at = NULL, available_at = ?, "
+                         "error = 'lease expired', updated_at = ? WHERE id = ?", (status, now, now, row["id"]))
+
+    def lease(self, worker_id: str) -> Optional[Dict]:
+        # Take the oldest job that is due, or None when there is none
+        now = time.time()
+        with self._transaction() as conn:
+            self._expire_leases(conn, now)
+            row = conn.execute("SELECT id FROM jobs WHERE status = 'queued' AND available_at <= ? "
+                               "ORDER BY available_at, id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET status = 'leased', attempts = attempts + 1, lease_owner = ?, "
+                         "lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                         (worker_id, now + self.lease_seconds, now, row["id"]))
+            job = dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+        job["force_reextract"] = bool(job["force_reextract"])
+        return job
+
+    def extend_lease(self, job_id: int, worker_id: str) -> bool:
+        # Heartbeat of a worker still busy with the job; False when the lease was lost to another worker
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET lease_expires_at = ?, updated_at = ? "
+                                  "WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+                                  (now + self.lease_seconds, now, job_id, worker_id))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id: int, worker_id: str, result: Dict, usage: Optional[Dict] = None) -> bool:
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = 'done', result = ?, usage = ?, error = NULL, "
+                                  "lease_owner = NULL, lease_expires_at = NULL, updated_at = ? "
+                                  "WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+                                  (json.dumps(result), json.dumps(usage or {}), now, job_id, worker_id))
+            return cursor.rowcount == 1
+
+    def fail(self, job_id: int, worker_id: str, error: str) -> Optional[str]:
+        # Schedule a retry with exponential backoff, or dead-letter the job once it is out of attempts;
+        # returns the new status, or None when the lease was lost
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT attempts, max_attempts FROM jobs "
+                               "WHERE id = ? AND lease_owner = ? AND status = 'leased'", (job_id, worker_id)).fetchone()
+            if row is None:
+                return None
+            status = "dead" if row["attempts"] >= row["max_attempts"] else "queued"
+            available_at = now + self.retry_delay_seconds * 2 ** (row["attempts"] - 1)
+            conn.execute("UPDATE jobs SET status = ?, error = ?, available_at = ?, lease_owner = NULL, "
+                         "lease_expires_at = NULL, updated_at = ? WHERE id = ?",
+                         (status, error, available_at, now, job_id))
+            return status
+
+    def requeue_dead(self, batch_id: Optional[str] = None) -> int:
+        # Give dead-lettered jobs a fresh set of attempts
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = 'queued', attempts = 0, available_at = ?, updated_at = ? "
+                                  "WHERE status = 'dead' AND (? IS NULL OR batch_id = ?)",
+                                  (now, now, batch_id, batch_id))
+            return cursor.rowcount
+
+    def batch_jobs(self, batch_id: str) -> List[Dict]:
+        # Jobs of a batch in enqueue order, with their results decoded
+        with self._transaction() as conn:
+            self._expire_leases(conn, time.time())
+            rows = conn.execute("SELECT id, filename, file_path, status, attempts, max_attempts, result, usage, error, "
+                                "updated_at FROM jobs WHERE batch_id = ? ORDER BY id", (batch_id,)).fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            job["result"] = json.loads(job["result"]) if job["result"] else None
+            job["usage"] = json.loads(job["usage"]) if job["usage"] else None
+            jobs.append(job)
+        return jobs
+
+    def stats(self) -> Dict[str, int]:
+        # Number of jobs in each state, across all batches
+        with self._transaction() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in JOB_STATUSES}
@@ -1,14 +1,68 @@
 import os
 import json
+import time
+import uuid
+import asyncio
+import contextvars
+import threading
+from dataclasses import dataclass, field
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from openai import AzureOpenAI
-from langchain_community.document_loaders import AzureAIDocumentIntelligenceLoader
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional, Set, Tuple
 
 # Import custom configuration and utility functions
-from config import load_environment_variables
-from utils import load_body_models, clean_and_validate_json, get_minimal_data_structure
-from guidelines import guidelines
+from config import (load_environment_variables, load_body_model_settings, load_canonicalization_settings,
+                    load_ocr_cache_settings, load_llm_cache_settings, load_batch_settings,
+                    load_rate_limit_settings, load_usage_settings, load_tracing_settings,
+                    load_text_layer_settings, load_ocr_policy_settings,
+                    load_doc_intelligence_scheduler_settings, load_compaction_settings,
+                    load_content_mode_settings, load_hybrid_extraction_settings,
+                    load_fast_path_extractor_settings, load_output_format_settings,
+                    load_response_format_settings, load_packing_settings,
+                    load_prompt_settings, load_cascade_settings, load_chunking_settings)
+from utils import (load_body_models, clean_and_validate_json, get_minimal_data_structure, estimate_tokens,
+                   parse_json_response)
+from guidelines import guidelines, field_guidelines, split_at_sections, without_field_instructions, without_sections
+from body_model_index import BodyModelIndex
+from catalog_matcher import CatalogMatcher, canonicalize_body_fields
+from cache import DiskCache, hash_file, make_cache_key
+from pipeline import PipelineItem, Stage, StagePipeline
+from rate_limiter import RateLimitExceeded, get_limiter
+from usage_ledger import add_usage, get_usage_ledger, new_usage_record
+from tracing import configure_tracing, current_span, span, traced
+from page_compaction import compact_pages, select_relevant_lines
+from field_extractors import extract_fast_path_fields, normalize_date_fields
+from extraction_checks import check_extraction
+from wire_schema import (VERBOSE_LINE_MARKERS, VERBOSE_SECTION_TITLES, WIRE_FIELDS, expand_wire_data,
+                         expected_output_tokens, is_wire_object, packed_format_instructions,
+                         packed_response_json_schema, response_json_schema, wire_format_instructions)
+from packing import plan_packs, share_usage
+from chunked_extraction import merge_chunk_records, plan_chunks
+from prompt_builder import (EXTRACTION_INSTRUCTIONS, EXTRACTION_REQUEST, STRUCTURED_CONTENT_NOTE, AssembledPrompt,
+                            PromptSection, assemble_prompt, body_model_section)
+from pdf_text_layer import build_page_subset_pdf, extract_text_layer, text_layer_available
+from document_intelligence import (KEY_VALUE_PAIRS_FEATURE, OcrPolicy, get_scheduler, invoice_fields,
+                                   page_confidences, page_texts, select_pages_to_escalate, structured_page_texts)
+
+@dataclass
+class InvoiceResult:
+    # Outcome of processing one invoice in a batch
+    filename: str
+    file_path: str
+    data: Dict = field(default_factory=dict)
+    error: Optional[str] = None
+    # Set when the error is the service still throttling after every retry of the limiter
+    throttled: bool = False
+    elapsed_seconds: float = 0.0
+    usage: Dict = field(default_factory=dict)
+    # Compacted document text the data was extracted from, kept so re-extraction does not repeat the OCR
+    document_content: str = ""
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
 
 class InvoiceProcessor:
     def __init__(self):
@@ -18,174 +72,1314 @@ class InvoiceProcessor:
          self.openai_deployment, self.training_folder, self.analysis_features) = \
             load_environment_variables()
 
+        # Export timing spans for every stage of the extraction pipeline
+        configure_tracing(*load_tracing_settings())
+
         # Load predefined body models from a text file
         self.body_models = load_body_models("body_model.txt")
         if not self.body_models:
             print("Warning: No body models loaded. LLM might have reduced context for 'body_model' field.")
 
-        # Initialize the Azure OpenAI client
+        # Build the body model index once so each prompt only carries the plausible candidates
+        (self.body_model_prompt_mode, self.body_model_top_k,
+         self.body_model_min_score, self.body_model_full_list_fallback) = load_body_model_settings()
+        self.body_model_index = BodyModelIndex(self.body_models)
+
+        # Precompute the catalog matchers used to canonicalize body fields after extraction
+        (self.canonicalize_enabled, self.canonical_min_score,
+         manufacturer_catalog_path) = load_canonicalization_settings()
+        self.body_model_matcher = CatalogMatcher(self.body_models)
+        self.body_manufacturer_matcher = None
+        if manufacturer_catalog_path:
+            manufacturers = load_body_models(manufacturer_catalog_path)
+            if manufacturers:
+                self.body_manufacturer_matcher = CatalogMatcher(manufacturers)
+
+        # Open the persistent OCR result cache shared across sessions
+        self.ocr_model = "prebuilt-invoice"
+        ocr_cache_enabled, ocr_cache_path, ocr_cache_max_bytes = load_ocr_cache_settings()
+        self.ocr_cache = DiskCache(ocr_cache_path, ocr_cache_max_bytes) if ocr_cache_enabled else None
+
+        # Default OCR policy; each run may pass its own
+        ocr_mode, ocr_min_confidence, ocr_key_field_margin = load_ocr_policy_settings()
+        self.ocr_policy = OcrPolicy(mode=ocr_mode, features=list(self.analysis_features),
+                                    min_confidence=ocr_min_confidence, key_field_margin=ocr_key_field_margin)
+        self.ocr_policy_stats = {"documents": 0, "pages": 0, "escalated_pages": 0, "standard_seconds": 0.0,
+                                 "high_res_seconds": 0.0, "high_res_pages": 0, "escalation_seconds": 0.0,
+                                 "estimated_seconds_saved": 0.0}
+        self._ocr_policy_lock = threading.Lock()
+
+        # Read born-digital pages from the PDF's own text layer instead of paying for cloud OCR
+        self.text_layer_enabled, self.text_layer_min_chars = load_text_layer_settings()
+        if self.text_layer_enabled and not text_layer_available():
+            print("Warning: pypdf is not installed, every page will be sent to Document Intelligence.")
+            self.text_layer_enabled = False
+        self.text_layer_stats = {"pages": 0, "local_pages": 0, "di_pages": 0}
+        self._text_layer_lock = threading.Lock()
+
+        # How the OCR result is serialized for the prompt: "flat" page text or "structured" tables and fields
+        self.content_mode = load_content_mode_settings()
+
+        # Header fields taken from the prebuilt-invoice model when it is confident, and left out of the prompt
+        self.hybrid_extraction_enabled, self.di_field_min_confidence = load_hybrid_extraction_settings()
+        # VIN, model year, stock number and invoice date read from the OCR text by exact local rules
+        self.fast_path_extractors_enabled = load_fast_path_extractor_settings()
+
+        # Page triage between OCR and the LLM call
+        self.compaction_enabled, self.compaction_min_page_share, self.compaction_min_keywords = \
+            load_compaction_settings()
+        self.compaction_stats = {"documents": 0, "pages": 0, "dropped_pages": 0, "tokens_before": 0,
+                                 "tokens_after": 0}
+        self._compaction_lock = threading.Lock()
+
+        # Open the LLM response cache, bounded by size and age
+        llm_cache_enabled, llm_cache_path, llm_cache_max_bytes, llm_cache_ttl = load_llm_cache_settings()
+        self.llm_cache = DiskCache(llm_cache_path, llm_cache_max_bytes, llm_cache_ttl) if llm_cache_enabled else None
+
+        # Concurrency and pipeline sizing for the batch API
+        (self.processing_concurrency, self.processing_mode,
+         self.pipeline_stage_workers, self.pipeline_queue_size) = load_batch_settings()
+        self.last_pipeline_report = {}
+        self.last_batch_summary = {}
+        # Packing of small invoices into shared requests in the "packed" mode
+        (self.pack_max_document_tokens, self.pack_token_budget,
+         self.pack_max_invoices, self.pack_max_output_tokens) = load_packing_settings()
+        self.packing_stats = {"packs": 0, "packed_invoices": 0, "splits": 0, "single_invoices": 0}
+        self._packing_lock = threading.Lock()
+
+        # Sampling parameters sent with every extraction request
+        self.llm_sampling_params = {
+            "max_tokens": 5000,
+            "temperature": 1.0,
+            "top_p": 1.0,
+            "frequency_penalty": 0.0,
+            "presence_penalty": 0.0,
+        }
+
+        # Response format; compact responses are expanded locally and get a max_tokens sized to the document
+        self.output_format, self.wire_base_tokens, self.wire_tokens_per_document_token = \
+            load_output_format_settings()
+        # Constrain the response to JSON, and count how often it still had to be repaired or was cut off
+        self.response_format = load_response_format_settings()
+        self.response_stats = {"responses": 0, "parsed": 0, "salvaged": 0, "failed": 0, "truncated": 0}
+        self._response_lock = threading.Lock()
+        # Prompt assembly: the input token budget and whether pinned fields' instructions are trimmed
+        self.prompt_input_token_budget, self.trim_pinned_fields = load_prompt_settings()
+        self.prompt_stats = {"prompts": 0, "estimated_prompt_tokens": 0, "trimmed": 0, "over_budget": 0,
+                             "prompt_tokens": 0, "cached_prompt_tokens": 0}
+        self._prompt_lock = threading.Lock()
+        # Cheap-first deployment cascade, escalating invoices whose result fails the local checks
+        (self.cascade_deployments, self.cascade_temperature,
+         self.cascade_required_fields, self.cascade_prices) = load_cascade_settings()
+        self.cascade_stats: Dict[str, Dict] = {}
+        self._cascade_lock = threading.Lock()
+        # Long documents are extracted in page-range chunks merged locally
+        self.chunked_min_pages, self.chunk_pages, self.chunk_workers = load_chunking_settings()
+        self.chunking_stats = {"documents": 0, "chunks": 0, "components_merged": 0}
+        self._chunking_lock = threading.Lock()
+
+        # Per-invoice token, page and cost ledger
+        usage_ledger_path, usage_metrics_path, usage_prices = load_usage_settings()
+        self.usage_ledger = get_usage_ledger(usage_ledger_path, usage_metrics_path, usage_prices)
+
+        # Quota-aware limiters shared by every processor in this process
+        openai_limits, doc_intelligence_limits = load_rate_limit_settings()
+        self.openai_limiter = get_limiter("azure_openai", **openai_limits)
+        self.doc_intelligence_limiter = get_limiter("document_intelligence", **doc_intelligence_limits)
+
+        # One pooled Document Intelligence client per process, shared by every processor; the scheduler submits
+        # analyses as they arrive and polls every outstanding operation from a single thread
+        self.di_max_in_flight, di_min_poll, di_max_poll = load_doc_intelligence_scheduler_settings()
+        self.doc_intelligence_scheduler = get_scheduler(
+            self.doc_intelligence_endpoint, self.doc_intelligence_key, self.doc_intelligence_limiter,
+            max_in_flight=self.di_max_in_flight, min_poll_interval=di_min_poll, max_poll_interval=di_max_poll)
+
+        # Initialize the Azure OpenAI client; retries are left to the limiter so Retry-After is honoured once
         self.openai_client = AzureOpenAI(
             api_version=self.openai_api_version,
             azure_endpoint=self.openai_endpoint,
             api_key=self.openai_key,
+            max_retries=0,
         )
 
-    def load_document_intelligence_data(self, file_path: str) -> str:
-        # Use Azure AIDocumentIntelligenceLoader to extract text from a PDF document
+    def run_document_analysis(self, data: bytes, features: List[str], pages: Optional[str] = None):
+        # Analyze the PDF bytes with the prebuilt invoice model; submission is rate limited by the scheduler
+        if self.content_mode == "structured" and KEY_VALUE_PAIRS_FEATURE not in features:
+            features = features + [KEY_VALUE_PAIRS_FEATURE]
+        return self.doc_intelligence_scheduler.analyze(self.ocr_model, data, features, pages)
+
+    def serialize_pages(self, result) -> List[str]:
+        # Per-page content in the configured content mode
+        if self.content_mode == "structured":
+            return structured_page_texts(result)
+        return page_texts(result)
+
+    def analyze_with_document_intelligence(self, data: bytes, ocr_policy: OcrPolicy,
+                                           usage: Optional[Dict] = None) -> Tuple[List[str], Dict[str, str]]:
+        # Extract the text of each page, escalating only low-confidence pages to high-resolution OCR,
+        # and the confident prebuilt-invoice header fields
         try:
-            document_intelligence_loader = AzureAIDocumentIntelligenceLoader(
-                api_endpoint=self.doc_intelligence_endpoint,
-                api_key=self.doc_intelligence_key,
-                file_path=file_path,
-                api_model="prebuilt-invoice",  # Specify the prebuilt model for invoices
-                mode="page",  # Process document page by page
-                analysis_features=self.analysis_features,
-            )
-            # Load documents and concatenate page content into a single string
-            documents = document_intelligence_loader.load()
-            return "\n".join([doc.page_content for doc in documents])
+            start = time.perf_counter()
+            result = self.run_document_analysis(data, ocr_policy.base_features())
+            texts = self.serialize_pages(result)
+            fields = invoice_fields(result, self.di_field_min_confidence)
+            base_seconds = time.perf_counter() - start
+
+            escalated = []
+            high_res_seconds = 0.0
+            if ocr_policy.mode == "adaptive":
+                escalated = select_pages_to_escalate(texts, page_confidences(result), ocr_policy)
+                if escalated:
+                    start = time.perf_counter()
+                    high_res_result = self.run_document_analysis(
+                        data, ocr_policy.escalation_features(), pages=",".join(str(index + 1) for index in escalated))
+                    # Replace the escalated pages with their high-resolution text
+                    for page, text in zip(high_res_result.pages or [], self.serialize_pages(high_res_result)):
+                        texts[page.page_number - 1] = text
+                    high_res_seconds = time.perf_counter() - start
+        except RateLimitExceeded:
+            # Throttling stays distinguishable so callers can back off instead of treating it as a bad document
+            raise
         except Exception as e:
             # Raise an exception if document loading fails
             raise Exception(f"Failed to load document: {e}")
 
-    def extract_invoice_data_with_llm(self, document_content: str, filename: str) -> str:
-        # Get the current date to include in the prompt
-        current_date = datetime.now().strftime('%Y-%m-%d')
-        # Construct the user prompt with document content and guidelines
-        prompt_content = f"""
-Extract the information from the following document text and return it in the required JSON format:
+        high_res_pages = len(texts) if ocr_policy.mode == "high_resolution" else len(escalated)
+        if usage is not None:
+            # Escalated pages are analyzed, and billed, twice
+            usage["di_pages"] += len(texts) + len(escalated)
+            usage["di_high_res_pages"] += high_res_pages
+        if ocr_policy.mode == "high_resolution":
+            # The single pass was a high-resolution one
+            self.record_ocr_policy_stats(len(texts), escalated, 0.0, base_seconds, high_res_pages)
+        else:
+            self.record_ocr_policy_stats(len(texts), escalated, base_seconds, high_res_seconds, high_res_pages)
+        current_span().set_attribute("ocr_policy", ocr_policy.mode)
+        current_span().set_attribute("escalated_pages", len(escalated))
+        return texts, fields
 
-Document filename: {filename}
-Current date: {current_date}
+    def record_ocr_policy_stats(self, page_count: int, escalated: List[int], base_seconds: float,
+                                high_res_seconds: float, high_res_pages: int):
+        with self._ocr_policy_lock:
+            stats = self.ocr_policy_stats
+            stats["documents"] += 1
+            stats["pages"] += page_count
+            stats["escalated_pages"] += len(escalated)
+            stats["standard_seconds"] += base_seconds
+            stats["high_res_seconds"] += high_res_seconds
+            # Every page analyzed in high resolution, whether escalated or under the high_resolution policy
+            stats["high_res_pages"] += high_res_pages
+            stats["escalation_seconds"] += high_res_seconds if escalated else 0.0
+            # Estimate the time saved on pages that stayed at standard resolution, using the observed
+            # per-page cost of high-resolution reruns
+            if stats["escalated_pages"] and page_count and high_res_pages < page_count:
+                extra_per_page = stats["escalation_seconds"] / stats["escalated_pages"] - base_seconds / page_count
+                stats["estimated_seconds_saved"] += max(0.0, extra_per_page) * (page_count - len(escalated))
+            escalation_rate = stats["escalated_pages"] / stats["pages"] if stats["pages"] else 0.0
+        if escalated:
+            print(f"OCR escalation: {len(escalated)}/{page_count} pages re-analyzed in high resolution "
+                  f"(overall rate {escalation_rate:.1%})")
+
+    def load_pages(self, file_path: str, ocr_policy: OcrPolicy,
+                   usage: Optional[Dict] = None) -> Tuple[List[str], int, Dict[str, str]]:
+        # Return the page texts, how many of them were read from the embedded text layer and the DI header
+        # fields; born-digital invoices never reach DI, so they have no fields
+        local_pages = extract_text_layer(file_path, self.text_layer_min_chars) if self.text_layer_enabled else None
+        if local_pages and all(text is not None for text in local_pages):
+            return local_pages, len(local_pages), {}
+
+        # Only scanned or image-only pages are sent to Document Intelligence
+        missing = [index for index, text in enumerate(local_pages) if text is None] if local_pages else []
+        if not local_pages or len(missing) == len(local_pages):
+            with open(file_path, "rb") as f:
+                pages, fields = self.analyze_with_document_intelligence(f.read(), ocr_policy, usage)
+            return pages, 0, fields
+
+        di_pages, fields = self.analyze_with_document_intelligence(
+            build_page_subset_pdf(file_path, missing), ocr_policy, usage)
+        # Merge the DI results back into their original page positions
+        pages = list(local_pages)
+        for position, index in enumerate(missing):
+            pages[index] = di_pages[position] if position < len(di_pages) else ""
+        return pages, len(local_pages) - len(missing), fields
+
+    def load_document_intelligence_data(self, file_path: str, usage: Optional[Dict] = None,
+                                        ocr_policy: Optional[OcrPolicy] = None) -> str:
+        # Document content only, for callers that do not use the DI header fields
+        return self.load_document(file_path, usage, ocr_policy)[0]
+
+    def load_document(self, file_path: str, usage: Optional[Dict] = None,
+                      ocr_policy: Optional[OcrPolicy] = None) -> Tuple[str, Dict[str, str]]:
+        # Return the document content and the prebuilt-invoice fields that can be used without the LLM
+        pages, fields = self.load_document_pages(file_path, usage, ocr_policy)
+        return "\n".join(pages), fields
+
+    @traced("load_document_intelligence_data")
+    def load_document_pages(self, file_path: str, usage: Optional[Dict] = None,
+                            ocr_policy: Optional[OcrPolicy] = None) -> Tuple[List[str], Dict[str, str]]:
+        # Return the compacted page texts and the prebuilt-invoice fields
+        current_span().set_attribute("file_size_bytes", os.path.getsize(file_path))
+        ocr_policy = ocr_policy or self.ocr_policy
+        # Reuse a previous analysis of the same PDF bytes, model, OCR policy and text layer policy when available
+        cache_key = None
+        if self.ocr_cache is not None:
+            # Pages are cached line by line, as compaction needs them
+            cache_key = make_cache_key(hash_file(file_path), self.ocr_model, ocr_policy.cache_key(),
+                                       self.text_layer_enabled, self.text_layer_min_chars, "page-lines",
+                                       self.content_mode, self.di_field_min_confidence)
+            cached = self.ocr_cache.get(cache_key)
+            if cached is not None:
+                if usage is not None:
+                    usage["di_cache_hit"] = True
+                current_span().set_attribute("cache_hit", True)
+                current_span().set_attribute("pages", len(cached["pages"]))
+                return (self.compact_document(cached["pages"], os.path.basename(file_path), usage),
+                        cached.get("fields", {}))
+
+        pages, local_page_count, fields = self.load_pages(file_path, ocr_policy, usage)
 
+        # Record how many pages the local fast path handled and how many were billed by Document Intelligence
+        with self._text_layer_lock:
+            self.text_layer_stats["pages"] += len(pages)
+            self.text_layer_stats["local_pages"] += local_page_count
+            self.text_layer_stats["di_pages"] += len(pages) - local_page_count
+        current_span().set_attribute("cache_hit", False)
+        current_span().set_attribute("pages", len(pages))
+        current_span().set_attribute("local_text_pages", local_page_count)
+        if usage is not None:
+            usage["local_text_pages"] += local_page_count
+
+        # Store the per-page content so later runs skip OCR entirely
+        if cache_key is not None:
+            self.ocr_cache.set(cache_key, {"pages": pages, "fields": fields})
+        return self.compact_document(pages, os.path.basename(file_path), usage), fields
+
+    def compact_document(self, pages: List[str], filename: str, usage: Optional[Dict] = None) -> List[str]:
+        # The page texts the LLM sees, joined into a single string for a one-call extraction
+        if not self.compaction_enabled:
+            return pages
+        full_content = "\n".join(pages)
+
+        # Drop terms-and-conditions pages and repeated header/footer lines before the LLM sees them
+        compacted, report = compact_pages(pages, self.compaction_min_page_share, self.compaction_min_keywords)
+        document_content = "\n".join(compacted)
+        tokens_before, tokens_after = estimate_tokens(full_content), estimate_tokens(document_content)
+
+        with self._compaction_lock:
+            self.compaction_stats["documents"] += 1
+            self.compaction_stats["pages"] += report["pages"]
+            self.compaction_stats["dropped_pages"] += len(report["dropped_pages"])
+            self.compaction_stats["tokens_before"] += tokens_before
+            self.compaction_stats["tokens_after"] += tokens_after
+        if usage is not None:
+            usage["compaction_tokens_saved"] += tokens_before - tokens_after
+        current_span().set_attribute("compaction_tokens_saved", tokens_before - tokens_after)
+
+        reduction = (tokens_before - tokens_after) / tokens_before if tokens_before else 0.0
+        print(f"Compaction for {filename}: {len(report['dropped_pages'])}/{report['pages']} pages dropped, "
+              f"{report['repeated_lines_removed']} repeated and {report['boilerplate_lines_removed']} boilerplate "
+              f"lines removed, tokens {tokens_before} -> {tokens_after} ({reduction:.1%} smaller)")
+        return compacted
+
+    def select_body_models_for_prompt(self, document_content: str) -> List[str]:
+        # Leave the catalog out entirely when canonicalization resolves body_model locally
+        if self.body_model_prompt_mode == "none":
+            return []
+        # Inject the whole catalog when retrieval is disabled
+        if self.body_model_prompt_mode == "full" or self.body_model_top_k <= 0:
+            return self.body_models
+
+        # Retrieve the top-K catalog entries that best match the OCR text
+        candidates = self.body_model_index.search(document_content, self.body_model_top_k)
+        # Candidates are ranked by coverage, not score, so each one is checked against the threshold
+        confident = [model for model, score in candidates if score >= self.body_model_min_score]
+        if not confident and self.body_model_full_list_fallback:
+            # No confident candidate was found, fall back to the full catalog
+            return self.body_models
+        return confident
+
+    def prompt_sections(self, body_model_reference: List[str],
+                        pinned_fields: Optional[Dict[str, str]] = None) -> List[PromptSection]:
+        # The instructions, guidelines and response format shared by every extraction prompt, in prefix order;
+        # the catalog is static only in "full" mode, where it is the same for every invoice
+        trimmed_fields = pinned_fields if self.trim_pinned_fields else None
+        # Only the per-category component examples are optional; the attribute, dimension, capacity and material
+        # standards that follow them are rules
+        core, examples, rules = split_at_sections(guidelines, "COMPONENT TYPES BY VEHICLE CATEGORY",
+                                                  "ATTRIBUTE EXTRACTION STANDARDS")
+        sections = [
+            PromptSection("instructions", self.prompt_guidelines(EXTRACTION_INSTRUCTIONS, trimmed_fields)),
+            PromptSection("guidelines", self.prompt_guidelines(core, trimmed_fields)),
+            PromptSection("guideline_examples", self.prompt_guidelines(examples, trimmed_fields), drop_rank=1),
+            PromptSection("guideline_rules", self.prompt_guidelines(rules, trimmed_fields)),
+        ]
+        if self.body_model_prompt_mode == "full":
+            sections.append(PromptSection("body_models", body_model_section(body_model_reference), drop_rank=2))
+        else:
+            sections.append(PromptSection("body_models", body_model_section(body_model_reference), static=False,
+                                          drop_rank=3))
+        # Tell the model how structured content is laid out
+        if self.content_mode == "structured":
+            sections.append(PromptSection("content_note", STRUCTURED_CONTENT_NOTE))
+        if self.output_format == "compact":
+            sections.append(PromptSection("response_format", wire_format_instructions(
+                trimmed_fields or {}, all_keys_required=self.response_format == "json_schema")))
+        sections.append(PromptSection("request", EXTRACTION_REQUEST))
+        return sections
+
+    def pinned_note(self, pinned_fields: Optional[Dict[str, str]], omitted_fields: Optional[Set[str]] = None) -> str:
+        # Fields already known are given for context; they are left out of the requested JSON when their
+        # instructions are trimmed, unless omitted_fields limits which ones the response schema leaves out
+        if not pinned_fields:
+            return ""
+        omitted = set(pinned_fields if omitted_fields is None else omitted_fields) if self.trim_pinned_fields else set()
+        note = ""
+        for label, fields in (("omit these keys from the JSON", [name for name in pinned_fields if name in omitted]),
+                              ("return these values as given", [name for name in pinned_fields
+                                                                if name not in omitted])):
+            if fields:
+                values = "; ".join(f"{name} = {json.dumps(pinned_fields[name])}" for name in fields)
+                note += f"Already extracted, {label}: {values}\n"
+        return note
+
+    def packed_omitted_fields(self, documents: List[Dict]) -> Optional[Set[str]]:
+        # A strict packed schema is shared by every document, so it can only leave out the fields pinned in all
+        # of them; None lets each document omit its own pinned fields
+        if not self.trim_pinned_fields or self.response_format != "json_schema":
+            return None
+        return set.intersection(*(set(document["pinned_fields"] or {}) for document in documents))
+
+    def build_prompt(self, document_content: str, filename: str, current_date: Optional[str] = None,
+                     body_model_reference: Optional[List[str]] = None,
+                     pinned_fields: Optional[Dict[str, str]] = None) -> AssembledPrompt:
+        # Get the current date to include in the prompt
+        if current_date is None:
+            current_date = datetime.now().strftime('%Y-%m-%d')
+        if body_model_reference is None:
+            body_model_reference = self.select_body_models_for_prompt(document_content)
+        # The per-invoice values come after the static prefix
+        sections = self.prompt_sections(body_model_reference, pinned_fields)
+        sections.append(PromptSection("document", f"""Document filename: {filename}
+Current date: {current_date}
+{self.pinned_note(pinned_fields)}
 {document_content}
+""", static=False))
+        return assemble_prompt(sections, self.prompt_input_token_budget)
+
+    def build_messages(self, document_content: str, filename: str, current_date: Optional[str] = None,
+                       body_model_reference: Optional[List[str]] = None,
+                       pinned_fields: Optional[Dict[str, str]] = None) -> List[Dict]:
+        return self.build_prompt(document_content, filename, current_date, body_model_reference,
+                                 pinned_fields).messages
+
+    def record_prompt(self, prompt: AssembledPrompt, filename: str) -> None:
+        # Log sections dropped to fit the input budget and count the locally estimated prompt tokens
+        if prompt.dropped:
+            print(f"Prompt for {filename} over the {self.prompt_input_token_budget} token budget, "
+                  f"dropped: {', '.join(prompt.dropped)}")
+        if prompt.over_budget:
+            print(f"Warning: prompt for {filename} is still {prompt.tokens} tokens after dropping optional sections")
+        with self._prompt_lock:
+            self.prompt_stats["prompts"] += 1
+            self.prompt_stats["estimated_prompt_tokens"] += prompt.tokens
+            self.prompt_stats["trimmed"] += int(bool(prompt.dropped))
+            self.prompt_stats["over_budget"] += int(prompt.over_budget)
+        current_span().set_attribute("prompt_version", prompt.version)
+        current_span().set_attribute("prompt_prefix_tokens", prompt.prefix_tokens)
+        current_span().set_attribute("prompt_dropped_sections", prompt.dropped)
+
+    def get_prompt_stats(self) -> Dict:
+        # Share of the billed prompt tokens the provider served from its prompt cache
+        with self._prompt_lock:
+            stats = dict(self.prompt_stats)
+        stats["cached_ratio"] = (round(stats["cached_prompt_tokens"] / stats["prompt_tokens"], 3)
+                                 if stats["prompt_tokens"] else None)
+        stats["version"] = self.get_prompt_version()
+        return stats
 
-{guidelines}
-"""
-
-        # Define the system message for the LLM, instructing it on data extraction and formatting
-        system_message_content = f"""
-You are an expert vehicle invoice parser that extracts structured data from automobile invoices including truck bodies, equipment, and vehicle modifications.
-
-**CRITICAL: Return ONLY valid JSON - no markdown, no explanations, no additional text.**
-
-**PARSING INSTRUCTIONS:**
-
-**1. HEADER INFORMATION:**
-- distributor: Extract the body/equipment manufacturer name from invoice header (the company that built/supplied the body/equipment, NOT the dealer/sold-to)
-- distributor_location: Extract manufacturer's location from header (City, State ZIP format)
-- make: Proper case formatting (e.g., "Ford", "International", "Freightliner", "Chevrolet", "Ram")
-- model: Include dashes and proper formatting (e.g., "F-600", "MV", "Cascadia", "Silverado", "ProMaster")
-- body_type: Classify as "Box Truck", "Flatbed", "Tank Truck", "Service Body", "Pickup Truck", "Van", "Other/Specialty", etc.
-- body_line: More specific description if available (e.g., "Water Truck", "Dry Van", "Stake Bed", "Refrigerated", "Utility Body") - leave empty if not clearly specified
-- body_manufacturer: The company that manufactured the body/equipment
-- body_model: Full descriptive specification from invoice
-
-**2. INVENTORY ARRIVAL DATE:**
-- inventory_arrival_date: ONLY extract if date is hand-written on the document or explicitly labeled as "arrival date", "delivery date", or similar
-- Leave empty ("") if no hand-written or explicit arrival date is found
-- Do not use invoice date, quote date, or other standard dates
-
-**3. DYNAMIC COMPONENT EXTRACTION:**
-- Analyze invoice content to identify ALL installed components/equipment
-- Create components based on what's actually present in the invoice
-- Start component IDs from a base number (0) and increment sequentially
-- Common component types include:
-  * Body/Tank: Main structure with dimensions and materials
-  * Engine: Motor specifications
-  * Transmission: Gearbox details
-  * Pump/PTO: Power systems
-  * Hose Reel: Hose management systems
-  * Ladder: Access equipment
-  * Safety Equipment: Safety features and kits
-  * Electrical: Lighting, cameras, controls, batteries
-  * Hydraulics: Lift gates, dump systems
-  * Plumbing: Valves, fittings, tanks
-  * Storage: Toolboxes, compartments
-  * Accessories: Steps, fenders, guards, bumpers
-  * Interior: Seats, dash components, upholstery
-  * Exterior: Paint, decals, mirrors
-
-**4. ATTRIBUTE EXTRACTION RULES:**
-- Start attribute IDs from 0 and increment sequentially within each component
-- Material: Steel, Aluminum, Composite, Stainless Steel, Plastic, etc.
-- Dimensions: Use inches with quote marks (64.75", 96", 192")
-- Capacity: Include units (2,000 Gallon, 2500lb, etc.)
-- Description: Comprehensive but concise feature descriptions
-- Manufacturer/Model: When specified for components
-- Type: Functional classification
-
-**5. FLEXIBLE STRUCTURE:**
-- Extract only components that actually exist in the invoice
-- Don't force predetermined component lists
-- Adapt to different vehicle types (trucks, vans, cars, specialty vehicles)
-- Use appropriate attribute names based on component type
-
-**6. DATE AND DOCUMENT HANDLING:**
-- All dates in YYYY-MM-DD format
-- inventory_arrival_date: Only if hand-written or explicitly labeled as arrival/delivery date
-- invoice_date: Actual invoice/quote date
-- Document type: "Invoice", "Sales Quote", "Work Order", "Bill of Sale", etc.
-
-**7. MATERIAL AND SPECIFICATION PRECISION:**
-- Extract exact materials mentioned (Steel, Aluminum, Composite, etc.)
-- Convert dimensions to consistent units (inches preferred)
-- Include capacity ratings with units
-- Preserve technical specifications exactly as stated
-
-**8. DOCUMENT PATH STRUCTURE:**
-- path: "img/invoices/bodyinvoices/-/" + filename
-- date: Today's date (current date when processing)
-- type: Document type from invoice ("Invoice", "Quote", "Bill of Sale", etc.)
-
-**9. KNOWLEDGE BASE OF BODY MODELS:**
-Below is a list of known body models for reference when identifying the body_model from invoice text:
-""" + '\n'.join([f"- {model}" for model in self.body_models]) + """
-
-**CRITICAL: Return ONLY valid JSON - no markdown, no explanations, no additional text.**
-"""
-
-        # Make a chat completion request to Azure OpenAI
+    def prompt_guidelines(self, text: str, pinned_fields: Optional[Dict[str, str]]) -> str:
+        # Leave out the instructions for pinned fields, and the verbose structure when the response is compact
+        text = without_field_instructions(text, pinned_fields)
+        if self.output_format == "compact":
+            text = without_sections(text, VERBOSE_SECTION_TITLES, VERBOSE_LINE_MARKERS)
+        return text
+
+    def sampling_params_for(self, document_content: str) -> Dict:
+        # Compact responses are capped near their expected size instead of the full format's fixed limit
+        params = dict(self.llm_sampling_params)
+        if self.output_format == "compact":
+            params["max_tokens"] = expected_output_tokens(estimate_tokens(document_content), self.wire_base_tokens,
+                                                          self.wire_tokens_per_document_token, params["max_tokens"])
+        return params
+
+    def parse_llm_response(self, raw_content: str, filename: str, usage: Optional[Dict] = None) -> Dict:
+        # Parse, or salvage, the response and expand a compact one to the full structure before the usual
+        # cleaning and validation
+        data, status = parse_json_response(raw_content, filename)
+        if self.output_format == "compact" and is_wire_object(data):
+            data = expand_wire_data(data)
+        with self._response_lock:
+            self.response_stats["responses"] += 1
+            self.response_stats[status] += 1
+        if usage is not None:
+            usage["response_salvaged"] = status == "salvaged"
+        current_span().set_attribute("response_parse", status)
+        return clean_and_validate_json(data if isinstance(data, dict) else {}, filename)
+
+    def get_response_stats(self) -> Dict:
+        # Share of unparseable responses the repair parser recovered
+        with self._response_lock:
+            stats = dict(self.response_stats)
+        unparsed = stats["salvaged"] + stats["failed"]
+        stats["salvage_rate"] = round(stats["salvaged"] / unparsed, 3) if unparsed else None
+        return stats
+
+    def response_format_param(self, pinned_fields: Optional[Dict[str, str]]) -> Optional[Dict]:
+        # The response_format request parameter for the configured mode; the schema only varies with the
+        # pinned fields when their instructions are trimmed too
+        if self.response_format == "json_schema":
+            omit_fields = pinned_fields if self.trim_pinned_fields else None
+            return {"type": "json_schema",
+                    "json_schema": response_json_schema(self.output_format, omit_fields or {})}
+        if self.response_format == "json_object":
+            return {"type": "json_object"}
+        return None
+
+    def get_prompt_version(self, pinned_fields: Optional[Dict[str, str]] = None) -> str:
+        # Hash of the prompt template; the document, filename, date and catalog are left out
+        return self.build_prompt("", "", current_date="", body_model_reference=[],
+                                 pinned_fields=pinned_fields).version
+
+    def get_llm_cache_key(self, document_content: str, body_model_reference: List[str],
+                          pinned_fields: Optional[Dict[str, str]] = None, deployment: Optional[str] = None,
+                          sampling_params: Optional[Dict] = None, dropped_sections: Optional[List[str]] = None) -> str:
+        # The filename and current date only feed the "documents" block, which clean_and_validate_json
+        # rewrites on every run, so they are left out of the key to keep it reusable across days and uploads
+        parts = [
+            make_cache_key(document_content),
+            self.get_prompt_version(pinned_fields),
+            body_model_reference,
+            pinned_fields or {},
+            self.response_format,
+            deployment or self.openai_deployment,
+            sampling_params or self.llm_sampling_params,
+        ]
+        # A response to a prompt trimmed to the input budget is kept apart from one to the full prompt
+        if dropped_sections:
+            parts.append(sorted(dropped_sections))
+        return make_cache_key(*parts)
+
+    @traced()
+    def extract_invoice_data_with_llm(self, document_content: str, filename: str, bypass_cache: bool = False,
+                                      usage: Optional[Dict] = None,
+                                      pinned_fields: Optional[Dict[str, str]] = None,
+                                      deployment: Optional[str] = None, temperature: Optional[float] = None) -> str:
+        # A cascade tier overrides the deployment and temperature
+        deployment = deployment or self.openai_deployment
+        base_params = dict(self.llm_sampling_params)
+        if temperature is not None:
+            base_params["temperature"] = temperature
+        current_span().set_attribute("deployment", deployment)
+        # Serve an unchanged document, prompt, deployment and sampling configuration from the cache
+        body_model_reference = self.select_body_models_for_prompt(document_content)
+        prompt = self.build_prompt(document_content, filename, body_model_reference=body_model_reference,
+                                   pinned_fields=pinned_fields)
+        cache_key = None
+        if self.llm_cache is not None:
+            cache_key = self.get_llm_cache_key(document_content, body_model_reference, pinned_fields, deployment,
+                                               base_params, prompt.dropped)
+            if not bypass_cache:
+                cached = self.llm_cache.get(cache_key)
+                if cached is not None:
+                    if usage is not None:
+                        usage["llm_cache_hit"] = True
+                    current_span().set_attribute("cache_hit", True)
+                    return cached["content"]
+
+        # Azure counts the prompt plus max_tokens against the deployment's TPM quota
+        self.record_prompt(prompt, filename)
+        messages = prompt.messages
+        sampling_params = self.sampling_params_for(document_content)
+        sampling_params["temperature"] = base_params["temperature"]
+        estimated_tokens = prompt.tokens + sampling_params["max_tokens"]
+        current_span().set_attribute("cache_hit", False)
+        current_span().set_attribute("estimated_tokens", estimated_tokens)
+        current_span().set_attribute("max_tokens", sampling_params["max_tokens"])
+
+        # Make a chat completion request to Azure OpenAI under the shared quota
         try:
-            response = self.openai_client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": system_message_content},
-                    {"role": "user", "content": prompt_content}
-                ],
-                max_tokens=5000,
-                temperature=1.0,
-                top_p=1.0,
-                frequency_penalty=0.0,
-                presence_penalty=0.0,
-                model=self.openai_deployment
-            )
-            # Return the extracted content from the LLM response
-            return response.choices[0].message.content
+            response_format = self.response_format_param(pinned_fields)
+            response = self.request_completion(messages, sampling_params, response_format, estimated_tokens, usage,
+                                               deployment)
+            if (response.choices[0].finish_reason == "length"
+                    and sampling_params["max_tokens"] < self.llm_sampling_params["max_tokens"]):
+                # The size estimate was too low for this document; retry once with the full allowance
+                print(f"Response for {filename} hit max_tokens={sampling_params['max_tokens']}, "
+                      f"retrying with {self.llm_sampling_params['max_tokens']}")
+                estimated_tokens += self.llm_sampling_params["max_tokens"] - sampling_params["max_tokens"]
+                sampling_params["max_tokens"] = self.llm_sampling_params["max_tokens"]
+                response = self.request_completion(messages, sampling_params,
+                                                   self.response_format_param(pinned_fields), estimated_tokens, usage,
+                                                   deployment)
+            # Extract the content from the LLM response
+            content = response.choices[0].message.content
+        except RateLimitExceeded:
+            raise
         except Exception as e:
             # Raise an exception if the API call fails
             raise Exception(f"Azure OpenAI API call failed: {e}")
 
-    def process_single_invoice(self, file_path: str, filename: str) -> Dict:
-        # Process a single invoice file
+        truncated = response.choices[0].finish_reason == "length"
+        current_span().set_attribute("truncated", truncated)
+        if truncated:
+            # Report the cut-off response instead of passing it on as a complete one; it is not cached
+            print(f"Warning: response for {filename} was truncated at max_tokens={sampling_params['max_tokens']}, "
+                  f"the extracted data may be incomplete")
+            with self._response_lock:
+                self.response_stats["truncated"] += 1
+            if usage is not None:
+                usage["llm_truncated"] = True
+        # Cache the response; a forced re-extraction refreshes the stored entry
+        elif cache_key is not None and content:
+            self.llm_cache.set(cache_key, {"content": content})
+        return content
+
+    def request_completion(self, messages: List[Dict], sampling_params: Dict, response_format: Optional[Dict],
+                           estimated_tokens: int, usage: Optional[Dict] = None, deployment: Optional[str] = None):
+        extra_params = {"response_format": response_format} if response_format else {}
         try:
-            # Load document content using Azure Document Intelligence
-            document_content = self.load_document_intelligence_data(file_path)
-            # Extract raw JSON data using the LLM
-            raw_llm_response = self.extract_invoice_data_with_llm(document_content, filename)
-            # Clean, validate, and standardize the JSON response
-            processed_data = clean_and_validate_json(raw_llm_response, filename)
-            return processed_data
+            response = self.openai_limiter.call(
+                lambda: self.openai_client.chat.completions.create(
+                    messages=messages,
+                    model=deployment or self.openai_deployment,
+                    **sampling_params,
+                    **extra_params
+                ),
+                estimated_tokens=estimated_tokens,
+            )
+        except Exception as e:
+            if (response_format or {}).get("type") != "json_schema" or "response_format" not in str(e):
+                raise
+            # Deployments or API versions without structured outputs still support JSON mode
+            print(f"Warning: json_schema response format rejected ({e}), falling back to json_object")
+            self.response_format = "json_object"
+            return self.request_completion(messages, sampling_params, {"type": "json_object"}, estimated_tokens, usage,
+                                           deployment)
+        # Record billed tokens, including those served from the provider's prompt cache
+        if usage is not None:
+            self.record_llm_usage(usage, response)
+        return response
+
+    def record_llm_usage(self, usage: Dict, response) -> None:
+        usage["llm_calls"] += 1
+        if response.usage is None:
+            return
+        details = getattr(response.usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+        usage["prompt_tokens"] += response.usage.prompt_tokens or 0
+        usage["completion_tokens"] += response.usage.completion_tokens or 0
+        usage["cached_prompt_tokens"] += cached_tokens
+        with self._prompt_lock:
+            self.prompt_stats["prompt_tokens"] += response.usage.prompt_tokens or 0
+            self.prompt_stats["cached_prompt_tokens"] += cached_tokens
+        # Attach the billed token counts to the open LLM span
+        current_span().set_attribute("prompt_tokens", response.usage.prompt_tokens)
+        current_span().set_attribute("completion_tokens", response.usage.completion_tokens)
+        current_span().set_attribute("cached_prompt_tokens", cached_tokens)
+
+    def canonicalize_body_fields(self, data: Dict, filename: str) -> Dict[str, Dict]:
+        # Match body_model/body_manufacturer against the local catalogs and log the outcome
+        if not self.canonicalize_enabled:
+            return {}
+        matches = canonicalize_body_fields(data, self.body_model_matcher,
+                                           self.body_manufacturer_matcher, self.canonical_min_score)
+        for name, match in matches.items():
+            # Matches below the minimum score leave the extracted value unchanged, and a value already in its
+            # canonical form needs no log line
+            if not match["applied"] or match["canonical"] == match["original"]:
+                continue
+            print(f"Canonicalized {name} for {filename}: '{match['original']}' -> "
+                  f"'{match['canonical']}' (score {match['score']})")
+        return matches
+
+    @traced("process_invoice")
+    def run_invoice_stages(self, file_path: str, filename: str, force_reextract: bool = False,
+                           usage: Optional[Dict] = None, ocr_policy: Optional[OcrPolicy] = None) -> Tuple[Dict, str]:
+        # Return the extracted data and the document content it came from
+        current_span().set_attribute("filename", filename)
+        # Load document content using Azure Document Intelligence
+        pages, di_fields = self.load_document_pages(file_path, usage, ocr_policy)
+        document_content = "\n".join(pages)
+        return self.extract_invoice_fields(document_content, filename, force_reextract, usage, di_fields,
+                                           pages=pages), document_content
+
+    def select_pinned_fields(self, document_content: str, di_fields: Optional[Dict[str, str]],
+                             usage: Optional[Dict] = None) -> Dict[str, str]:
+        # Fields used as is instead of asking the LLM for them: the rule-based extractors' finds,
+        # overridden by the confident DI header fields
+        fast_path_fields = extract_fast_path_fields(document_content) if self.fast_path_extractors_enabled else {}
+        di_fields = di_fields if self.hybrid_extraction_enabled and di_fields else {}
+        if usage is not None:
+            usage["di_fields_used"] += len(di_fields)
+            usage["fast_path_fields_used"] += len(set(fast_path_fields) - set(di_fields))
+        current_span().set_attribute("di_fields_used", len(di_fields))
+        current_span().set_attribute("fast_path_fields", sorted(fast_path_fields))
+        return {**fast_path_fields, **di_fields}
+
+    def apply_pinned_fields(self, data: Dict, pinned_fields: Dict[str, str]) -> Dict:
+        # Normalize the dates the LLM returned, then fill in the fields resolved without it
+        normalize_date_fields(data)
+        data.update(pinned_fields)
+        return data
+
+    def extract_invoice_fields(self, document_content: str, filename: str, force_reextract: bool = False,
+                               usage: Optional[Dict] = None, di_fields: Optional[Dict[str, str]] = None,
+                               pinned_fields: Optional[Dict[str, str]] = None,
+                               pages: Optional[List[str]] = None) -> Dict:
+        # Extract raw JSON data using the LLM, asking only for what DI and the local extractors did not provide
+        if pinned_fields is None:
+            pinned_fields = self.select_pinned_fields(document_content, di_fields, usage)
+        # The cascade checks whole-document results, so a chunked document escalates as a whole
+        if len(self.cascade_deployments) > 1:
+            return self.extract_with_cascade(document_content, filename, force_reextract, usage, pinned_fields,
+                                             pages)
+        if self.should_chunk(pages):
+            return self.extract_chunked(pages, filename, force_reextract, usage, pinned_fields)
+        raw_llm_response = self.extract_invoice_data_with_llm(document_content, filename,
+                                                              bypass_cache=force_reextract, usage=usage,
+                                                              pinned_fields=pinned_fields)
+        # Clean, validate, and standardize the JSON response, then fill in the pinned fields
+        processed_data = self.apply_pinned_fields(self.parse_llm_response(raw_llm_response, filename, usage),
+                                                  pinned_fields)
+        # Snap body fields to their canonical catalog entries
+        self.canonicalize_body_fields(processed_data, filename)
+        return processed_data
+
+    def should_chunk(self, pages: Optional[List[str]]) -> bool:
+        return bool(pages) and self.chunked_min_pages > 0 and len(pages) >= self.chunked_min_pages
+
+    def extract_chunked(self, pages: List[str], filename: str, force_reextract: bool = False,
+                        usage: Optional[Dict] = None, pinned_fields: Optional[Dict[str, str]] = None,
+                        deployment: Optional[str] = None, temperature: Optional[float] = None) -> Dict:
+        # Map: extract every page-range chunk in parallel, each with a max_tokens sized to the chunk;
+        # reduce: merge the chunk records locally into one
+        ranges = plan_chunks(len(pages), self.chunk_pages)
+        chunk_usages = [new_usage_record() for _ in ranges]
+
+        def extract_chunk(index: int) -> Dict:
+            start, end = ranges[index]
+            with span("llm_chunk", first_page=start + 1, last_page=end):
+                raw_llm_response = self.extract_invoice_data_with_llm(
+                    "\n".join(pages[start:end]), f"{filename} (pages {start + 1}-{end} of {len(pages)})",
+                    bypass_cache=force_reextract, usage=chunk_usages[index], pinned_fields=pinned_fields,
+                    deployment=deployment, temperature=temperature)
+                return self.parse_llm_response(raw_llm_response, filename, chunk_usages[index])
+
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.chunk_workers, len(ranges)),
+                                    thread_name_prefix="chunk") as executor:
+                futures = [executor.submit(contextvars.copy_context().run, extract_chunk, index)
+                           for index in range(len(ranges))]
+                records = [future.result() for future in futures]
+        finally:
+            # Chunks that completed before a failure are still billed
+            if usage is not None:
+                for chunk_usage in chunk_usages:
+                    add_usage(usage, chunk_usage)
+
+        data = clean_and_validate_json(merge_chunk_records(records), filename)
+        chunk_components = sum(len(record["components"]) for record in records)
+        with self._chunking_lock:
+            self.chunking_stats["documents"] += 1
+            self.chunking_stats["chunks"] += len(ranges)
+            self.chunking_stats["components_merged"] += chunk_components - len(data["components"])
+        current_span().set_attribute("chunks", len(ranges))
+        print(f"Chunked extraction for {filename}: {len(pages)} pages in {len(ranges)} chunks, "
+              f"{chunk_components} components merged into {len(data['components'])}")
+        data = self.apply_pinned_fields(data, pinned_fields)
+        self.canonicalize_body_fields(data, filename)
+        return data
+
+    def extract_with_cascade(self, document_content: str, filename: str, force_reextract: bool = False,
+                             usage: Optional[Dict] = None, pinned_fields: Optional[Dict[str, str]] = None,
+                             pages: Optional[List[str]] = None) -> Dict:
+        # Try the deployments cheapest first and accept the first result that passes the local checks;
+        # the last tier's result is accepted as is
+        usage = usage if usage is not None else new_usage_record()
+        for index, deployment in enumerate(self.cascade_deployments):
+            last_tier = index == len(self.cascade_deployments) - 1
+            tokens_before = {name: usage[name] for name in ("prompt_tokens", "cached_prompt_tokens",
+                                                             "completion_tokens")}
+            start = time.perf_counter()
+            temperature = None if last_tier else self.cascade_temperature
+            with span("cascade_tier", deployment=deployment, tier=index):
+                if self.should_chunk(pages):
+                    # Every chunk runs on the tier; the merged record is what gets checked
+                    data = self.extract_chunked(pages, filename, force_reextract, usage, pinned_fields,
+                                                deployment, temperature)
+                else:
+                    raw_llm_response = self.extract_invoice_data_with_llm(
+                        document_content, filename, bypass_cache=force_reextract, usage=usage,
+                        pinned_fields=pinned_fields, deployment=deployment, temperature=temperature)
+                    data = self.apply_pinned_fields(self.parse_llm_response(raw_llm_response, filename, usage),
+                                                    pinned_fields)
+                    self.canonicalize_body_fields(data, filename)
+                problems = check_extraction(data, self.cascade_required_fields, self.body_model_matcher,
+                                            self.canonical_min_score)
+                current_span().set_attribute("problems", problems)
+            tier_usage = {**new_usage_record(), **{name: usage[name] - tokens_before[name] for name in tokens_before}}
+            # Each tier's tokens are priced at that tier's rates; the ledger uses this cost for the invoice
+            tier_cost = self.usage_ledger.estimate_cost(tier_usage, self.cascade_tier_prices(deployment))
+            usage["cascade_cost_usd"] += tier_cost
+            self.record_cascade_tier(deployment, time.perf_counter() - start, tier_usage, tier_cost,
+                                     accepted=not problems, escalated=bool(problems) and not last_tier)
+            if not problems or last_tier:
+                usage["cascade_tier"] = deployment
+                return data
+            usage["cascade_escalations"] += 1
+            print(f"Escalating {filename} from {deployment} to {self.cascade_deployments[index + 1]}: "
+                  f"{', '.join(problems)}")
+
+    def cascade_tier_prices(self, deployment: str) -> Dict[str, float]:
+        # The ledger prices with the tier's LLM_CASCADE_PRICES entry, if there is one
+        prices = {**self.usage_ledger.prices, **self.cascade_prices.get(deployment, {})}
+        if deployment in self.cascade_prices and self.usage_ledger.prices["prompt_per_1k"]:
+            # The provider's cached-prompt discount is taken to be the same for every deployment
+            prices["cached_prompt_per_1k"] = (prices["prompt_per_1k"] * self.usage_ledger.prices["cached_prompt_per_1k"]
+                                              / self.usage_ledger.prices["prompt_per_1k"])
+        return prices
+
+    def record_cascade_tier(self, deployment: str, seconds: float, tier_usage: Dict, tier_cost: float,
+                            accepted: bool, escalated: bool) -> None:
+        # Attempts, accepted results, latency, tokens and cost of each tier
+        with self._cascade_lock:
+            stats = self.cascade_stats.setdefault(deployment, {"attempts": 0, "accepted": 0, "escalated": 0,
+                                                               "seconds": 0.0, "prompt_tokens": 0,
+                                                               "completion_tokens": 0, "cost_usd": 0.0})
+            stats["attempts"] += 1
+            stats["accepted"] += int(accepted)
+            stats["escalated"] += int(escalated)
+            stats["seconds"] += seconds
+            stats["prompt_tokens"] += tier_usage["prompt_tokens"]
+            stats["completion_tokens"] += tier_usage["completion_tokens"]
+            stats["cost_usd"] += tier_cost
+
+    def get_cascade_stats(self) -> Dict[str, Dict]:
+        # Hit rate (accepted / attempts) and mean latency per tier
+        with self._cascade_lock:
+            stats = {deployment: dict(tier) for deployment, tier in self.cascade_stats.items()}
+        for tier in stats.values():
+            tier["hit_rate"] = round(tier["accepted"] / tier["attempts"], 3) if tier["attempts"] else None
+            tier["mean_seconds"] = round(tier["seconds"] / tier["attempts"], 3) if tier["attempts"] else None
+            tier["seconds"] = round(tier["seconds"], 3)
+            tier["cost_usd"] = round(tier["cost_usd"], 6)
+        return stats
+
+    def process_single_invoice(self, file_path: str, filename: str, force_reextract: bool = False,
+                               ocr_policy: Optional[OcrPolicy] = None) -> Dict:
+        # Process a single invoice file; throttling is raised rather than hidden behind the minimal structure,
+        # so the caller can back off and retry
+        result = self.process_invoice(file_path, filename, force_reextract, ocr_policy)
+        if result.throttled:
+            raise RateLimitExceeded(result.error)
+        return result.data
+
+    def process_invoice(self, file_path: str, filename: str, force_reextract: bool = False,
+                        ocr_policy: Optional[OcrPolicy] = None, batch_id: str = "") -> InvoiceResult:
+        # Process a single invoice file, keeping the error and usage alongside the data
+        result = InvoiceResult(filename=filename, file_path=file_path)
+        usage = new_usage_record()
+        start = time.perf_counter()
+        try:
+            result.data, result.document_content = self.run_invoice_stages(file_path, filename, force_reextract,
+                                                                           usage, ocr_policy)
         except Exception as e:
             # If processing fails, print an error and return a minimal data structure
             print(f"Error processing file {filename}: {str(e)}")
-            return get_minimal_data_structure(filename)
+            result.error = str(e)
+            result.throttled = isinstance(e, RateLimitExceeded)
+            result.data = get_minimal_data_structure(filename)
+        finally:
+            # Calls made before a failure are still billed
+            result.elapsed_seconds = time.perf_counter() - start
+            result.usage = self.usage_ledger.record(filename, batch_id, self.openai_deployment, usage)
+        return result
+
+    def build_packed_prompt(self, documents: List[Dict], current_date: Optional[str] = None) -> AssembledPrompt:
+        # One request for several documents, sharing the single-invoice prefix: the static instructions,
+        # guidelines and catalog are sent once
+        if current_date is None:
+            current_date = datetime.now().strftime('%Y-%m-%d')
+        body_model_reference = []
+        for document in documents:
+            for model in self.select_body_models_for_prompt(document["document_content"]):
+                if model not in body_model_reference:
+                    body_model_reference.append(model)
+        sections = self.prompt_sections(body_model_reference)
+        sections.append(PromptSection("multiple_documents", packed_format_instructions()))
+        omitted_fields = self.packed_omitted_fields(documents)
+        sections.append(PromptSection("documents", f"Current date: {current_date}\n\n" + "\n\n".join(
+            f"=== Document filename: {document['filename']} ===\n"
+            f"{self.pinned_note(document['pinned_fields'], omitted_fields)}"
+            f"{document['document_content']}" for document in documents) + "\n", static=False))
+        return assemble_prompt(sections, self.prompt_input_token_budget)
+
+    def build_packed_messages(self, documents: List[Dict], current_date: Optional[str] = None) -> List[Dict]:
+        return self.build_packed_prompt(documents, current_date).messages
+
+    def extract_packed_invoices(self, documents: List[Dict]) -> Dict[str, Dict]:
+        # Extract several small documents in one request; raises ValueError when the response does not hold
+        # a result for every document, so the caller can split the pack
+        pack_usage = new_usage_record()
+        with span("llm_pack", invoices=len(documents)):
+            prompt = self.build_packed_prompt(documents)
+            self.record_prompt(prompt, f"pack of {len(documents)} invoices")
+            messages = prompt.messages
+            sampling_params = dict(self.llm_sampling_params)
+            sampling_params["max_tokens"] = min(self.pack_max_output_tokens, sum(
+                self.sampling_params_for(document["document_content"])["max_tokens"] for document in documents))
+            estimated_tokens = prompt.tokens + sampling_params["max_tokens"]
+            response_format = None
+            if self.response_format == "json_schema":
+                response_format = {"type": "json_schema", "json_schema": packed_response_json_schema(
+                    self.output_format, self.packed_omitted_fields(documents) or ())}
+            elif self.response_format == "json_object":
+                response_format = {"type": "json_object"}
+            try:
+                response = self.request_completion(messages, sampling_params, response_format, estimated_tokens,
+                                                   pack_usage)
+            except RateLimitExceeded:
+                raise
+            except Exception as e:
+                raise Exception(f"Azure OpenAI API call failed: {e}")
+            finally:
+                # Each invoice carries its share of the request in the ledger
+                share_usage(pack_usage, [document["usage"] for document in documents],
+                            [estimate_tokens(document["document_content"]) for document in documents])
+
+            if response.choices[0].finish_reason == "length":
+                raise ValueError(f"packed response truncated at max_tokens={sampling_params['max_tokens']}")
+            data, status = parse_json_response(response.choices[0].message.content or "",
+                                               f"pack of {len(documents)} invoices")
+            results = data.get("results") if isinstance(data, dict) else None
+            items = {item.get("filename"): item for item in results or [] if isinstance(item, dict)}
+            missing = [document["filename"] for document in documents if document["filename"] not in items]
+            if status == "failed" or missing:
+                raise ValueError(f"packed response has no result for {', '.join(missing) or 'any invoice'}")
+
+        extracted = {}
+        for document in documents:
+            item = {key: value for key, value in items[document["filename"]].items() if key != "filename"}
+            if self.output_format == "compact" and is_wire_object(item):
+                item = expand_wire_data(item)
+            data = self.apply_pinned_fields(clean_and_validate_json(item, document["filename"]),
+                                            document["pinned_fields"])
+            self.canonicalize_body_fields(data, document["filename"])
+            extracted[document["filename"]] = data
+        with self._response_lock:
+            self.response_stats["responses"] += len(documents)
+            self.response_stats[status] += len(documents)
+        return extracted
+
+    def run_pack(self, documents: List[Dict], force_reextract: bool, finish: Callable[..., None]) -> None:
+        # Extract a pack, halving it until the halves validate; a single invoice takes the normal path
+        if len(documents) == 1:
+            document = documents[0]
+            with self._packing_lock:
+                self.packing_stats["single_invoices"] += 1
+            try:
+                data = self.extract_invoice_fields(document["document_content"], document["filename"],
+                                                   force_reextract, document["usage"],
+                                                   pinned_fields=document["pinned_fields"], pages=document["pages"])
+            except Exception as e:
+                finish(document, error=e)
+                return
+            finish(document, data=data)
+            return
+
+        try:
+            extracted = self.extract_packed_invoices(documents)
+        except ValueError as e:
+            print(f"Packed request for {len(documents)} invoices failed validation ({e}), splitting it")
+            with self._packing_lock:
+                self.packing_stats["splits"] += 1
+            middle = len(documents) // 2
+            self.run_pack(documents[:middle], force_reextract, finish)
+            self.run_pack(documents[middle:], force_reextract, finish)
+            return
+        except Exception as e:
+            for document in documents:
+                finish(document, error=e)
+            return
+        with self._packing_lock:
+            self.packing_stats["packs"] += 1
+            self.packing_stats["packed_invoices"] += len(documents)
+        for document in documents:
+            finish(document, data=extracted[document["filename"]])
+
+    def has_cached_extraction(self, document_content: str, filename: str, pinned_fields: Dict[str, str]) -> bool:
+        # Invoices with a cached single-invoice response are cheaper served from the cache than packed
+        if self.llm_cache is None:
+            return False
+        body_model_reference = self.select_body_models_for_prompt(document_content)
+        dropped = self.build_prompt(document_content, filename, body_model_reference=body_model_reference,
+                                    pinned_fields=pinned_fields).dropped
+        return self.llm_cache.get(self.get_llm_cache_key(document_content, body_model_reference, pinned_fields,
+                                                         dropped_sections=dropped)) is not None
+
+    def process_invoices_packed(self, file_paths: List[str],
+                                progress_callback: Optional[Callable[[int, int, InvoiceResult], None]] = None,
+                                force_reextract: bool = False,
+                                ocr_policy: Optional[OcrPolicy] = None) -> Dict[str, InvoiceResult]:
+        batch_id = self.new_batch_id()
+        total = len(file_paths)
+        results: Dict[str, InvoiceResult] = {}
+        results_lock = threading.Lock()
+
+        def finish(document: Dict, data: Optional[Dict] = None, error: Optional[Exception] = None):
+            filename = document["filename"]
+            result = InvoiceResult(filename=filename, file_path=document["file_path"], data=data or {},
+                                   error=None if error is None else str(error),
+                                   throttled=isinstance(error, RateLimitExceeded),
+                                   elapsed_seconds=time.perf_counter() - document["start"],
+                                   document_content=document.get("document_content", ""))
+            if error is not None:
+                # Record the failure and fall back to a minimal data structure
+                print(f"Error processing file {filename}: {error}")
+                result.data = get_minimal_data_structure(filename)
+            result.usage = self.usage_ledger.record(filename, batch_id, self.openai_deployment, document["usage"])
+            with results_lock:
+                results[filename] = result
+                completed = len(results)
+            if progress_callback is not None:
+                progress_callback(completed, total, result)
+
+        def load(file_path: str) -> Optional[Dict]:
+            document = {"file_path": file_path, "filename": os.path.basename(file_path),
+                        "usage": new_usage_record(), "start": time.perf_counter()}
+            try:
+                document["pages"], di_fields = self.load_document_pages(file_path, document["usage"], ocr_policy)
+                document["document_content"] = "\n".join(document["pages"])
+                document["pinned_fields"] = self.select_pinned_fields(document["document_content"], di_fields,
+                                                                      document["usage"])
+            except Exception as e:
+                finish(document, error=e)
+                return None
+            return document
+
+        # Packs are planned from the document sizes, so OCR runs for the whole batch first
+        with ThreadPoolExecutor(max_workers=self.di_max_in_flight, thread_name_prefix="ocr") as executor:
+            loaded = [future.result() for future in [executor.submit(contextvars.copy_context().run, load, path)
+                                                     for path in file_paths]]
+        documents = {document["filename"]: document for document in loaded if document is not None}
 
-    def process_invoices(self, file_paths: List[str]) -> Dict[str, Dict]:
-        # Process a list of invoice file paths
-        results = {}
-        for file_path in file_paths:
+        # Cached invoices, large documents and documents long enough for chunked extraction are extracted alone
+        packable = {filename: estimate_tokens(document["document_content"])
+                    for filename, document in documents.items()
+                    if not self.should_chunk(document["pages"])
+                    and (force_reextract or not self.has_cached_extraction(document["document_content"], filename,
+                                                                           document["pinned_fields"]))}
+        packs, singles = plan_packs(packable, self.pack_max_document_tokens, self.pack_token_budget,
+                                    self.pack_max_invoices)
+        singles += [filename for filename in documents if filename not in packable]
+        print(f"Packing: {sum(len(pack) for pack in packs)} invoices in {len(packs)} packs, "
+              f"{len(singles)} sent alone")
+
+        with ThreadPoolExecutor(max_workers=self.processing_concurrency, thread_name_prefix="llm") as executor:
+            requests = [[documents[filename] for filename in pack] for pack in packs]
+            requests += [[documents[filename]] for filename in singles]
+            for future in [executor.submit(contextvars.copy_context().run, self.run_pack, request,
+                                           force_reextract, finish) for request in requests]:
+                future.result()
+
+        # Key the results by filename, preserving the input order
+        ordered = {os.path.basename(file_path): results[os.path.basename(file_path)] for file_path in file_paths}
+        self.finish_batch(batch_id, ordered)
+        return ordered
+
+    def build_reextraction_messages(self, document_content: str, fields: List[str],
+                                    component: Optional[Dict] = None) -> List[Dict]:
+        # A minimal prompt asking only for the given fields and/or one component
+        keys = [f'"{name}": string' for name in fields]
+        sections = [field_guidelines(fields)] if fields else []
+        if "body_model" in fields:
+            candidates = self.select_body_models_for_prompt(document_content)
+            if candidates:
+                sections.append("Known body models:\n" + "\n".join(f"- {model}" for model in candidates))
+        if component is not None:
+            keys.append('"component": {"name": string, "attributes": [[attribute name, attribute value], ...]}')
+            current = [[attribute.get("name", ""), attribute.get("value", "")]
+                       for attribute in component.get("attributes", [])]
+            sections.append(f"Re-extract this component with all of its attributes as stated on the invoice. "
+                            f"Current values: {json.dumps({'name': component.get('name', ''), 'attributes': current})}")
+        system_message_content = ("You are an expert vehicle invoice parser. Return ONLY a JSON object with the keys "
+                                  + ", ".join(keys) + '. Use "" when a value is not present.')
+        prompt_content = "\n\n".join([document_content] + sections)
+        return [
+            {"role": "system", "content": system_message_content},
+            {"role": "user", "content": prompt_content}
+        ]
+
+    def reextract(self, document_content: str, filename: str, record: Dict, fields: Optional[List[str]] = None,
+                  component_index: Optional[int] = None) -> Dict:
+        # Ask the LLM again for some fields and/or one component of an extracted record and return the merged
+        # record; the cached document text is reused, so no OCR runs and the full prompt is not sent
+        fields = [name for name in fields or [] if name in WIRE_FIELDS.values()]
+        component = None
+        if component_index is not None:
+            if not 0 <= component_index < len(record.get("components") or []):
+                raise ValueError(f"No component {component_index} in the record for {filename}")
+            component = record["components"][component_index]
+        if not fields and component is None:
+            return record
+
+        # A component alone only needs the lines that mention it
+        if component is not None and not fields:
+            terms = [component.get("name", "")] + [str(attribute.get("value", ""))
+                                                   for attribute in component.get("attributes", [])]
+            document_content = select_relevant_lines(document_content, terms) or document_content
+
+        usage = new_usage_record()
+        try:
+            with span("reextract", filename=filename, fields=fields, component_index=component_index):
+                messages = self.build_reextraction_messages(document_content, fields, component)
+                sampling_params = dict(self.llm_sampling_params,
+                                       max_tokens=min(self.llm_sampling_params["max_tokens"],
+                                                      100 + 60 * len(fields) + (800 if component is not None else 0)))
+                estimated_tokens = (sum(estimate_tokens(message["content"]) for message in messages)
+                                    + sampling_params["max_tokens"])
+                response_format = {"type": "json_object"} if self.response_format != "none" else None
+                try:
+                    response = self.request_completion(messages, sampling_params, response_format,
+                                                       estimated_tokens, usage)
+                except RateLimitExceeded:
+                    raise
+                except Exception as e:
+                    raise Exception(f"Azure OpenAI API call failed: {e}")
+                data, _ = parse_json_response(response.choices[0].message.content or "", filename)
+        finally:
+            self.usage_ledger.record(filename, "", self.openai_deployment, usage)
+        if not isinstance(data, dict):
+            data = {}
+
+        # Merge what came back; fields the model left out keep their current values
+        updates = {name: str(data[name]) for name in fields if data.get(name) is not None}
+        normalize_date_fields(updates)
+        self.canonicalize_body_fields(updates, filename)
+        merged = {**record, **updates}
+        new_component = data.get("component")
+        if component is not None and isinstance(new_component, dict):
+            pairs = [pair for pair in new_component.get("attributes") or [] if isinstance(pair, list) and pair]
+            components = list(merged["components"])
+            components[component_index] = {
+                **component,
+                "name": str(new_component.get("name") or component.get("name", "")),
+                "attributes": [{"id": position, "name": str(pair[0]), "value": str(pair[1]) if len(pair) > 1 else ""}
+                               for position, pair in enumerate(pairs)],
+            }
+            merged["components"] = components
+        target = ", ".join(fields + ([f"component {component_index}"] if component is not None else []))
+        print(f"Re-extracted {target} for {filename}: {usage['prompt_tokens']} prompt and "
+              f"{usage['completion_tokens']} completion tokens")
+        return merged
+
+    def new_batch_id(self) -> str:
+        # Time-ordered identifier grouping the ledger entries of one batch
+        return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+    def finish_batch(self, batch_id: str, results: Dict[str, InvoiceResult]) -> Dict:
+        # Summarize the batch's usage and refresh the exported metrics
+        summary = self.usage_ledger.summarize([result.usage for result in results.values() if result.usage])
+        summary["cache"] = self.get_cache_stats()
+        self.last_batch_summary = {"batch_id": batch_id, **summary}
+        self.usage_ledger.write_metrics()
+        print(f"Batch {batch_id} usage: {summary}")
+        print(f"Text layer fast path: {self.text_layer_stats}")
+        print(f"OCR policy: {self.ocr_policy_stats}")
+        print(f"Compaction: {self.compaction_stats}")
+        print(f"Responses: {self.get_response_stats()}")
+        print(f"Prompt: {self.get_prompt_stats()}")
+        if len(self.cascade_deployments) > 1:
+            print(f"Cascade: {self.get_cascade_stats()}")
+        if self.chunking_stats["documents"]:
+            print(f"Chunked extraction: {self.chunking_stats}")
+        if self.processing_mode == "packed":
+            print(f"Packing: {self.packing_stats}")
+        print(f"Rate limits: {self.get_rate_limit_stats()}")
+        return summary
+
+    def get_cache_stats(self) -> Dict[str, Optional[Dict]]:
+        # Hit, miss and eviction counters of the OCR and LLM response caches, None for a disabled cache
+        stats = {}
+        for name, cache in (("ocr", self.ocr_cache), ("llm", self.llm_cache)):
+            if cache is None:
+                stats[name] = None
+                continue
+            stats[name] = cache.stats()
+            lookups = stats[name]["hits"] + stats[name]["misses"]
+            stats[name]["hit_rate"] = round(stats[name]["hits"] / lookups, 3) if lookups else None
+        return stats
+
+    def get_rate_limit_stats(self) -> Dict[str, Dict]:
+        # Throttle, retry and admission-wait counters used to tune concurrency against quota
+        return {
+            "azure_openai": self.openai_limiter.stats(),
+            "document_intelligence": self.doc_intelligence_limiter.stats(),
+            "document_intelligence_operations": self.doc_intelligence_scheduler.stats(),
+        }
+
+    def process_invoices_pipelined(self, file_paths: List[str],
+                                   progress_callback: Optional[Callable[[int, int, InvoiceResult], None]] = None,
+                                   force_reextract: bool = False,
+                                   ocr_policy: Optional[OcrPolicy] = None) -> Dict[str, InvoiceResult]:
+        batch_id = self.new_batch_id()
+
+        # Each stage gets its own worker pool, so OCR of later invoices overlaps the LLM call of earlier ones
+        def ocr_stage(payload: Dict) -> Dict:
+            payload["pages"], di_fields = self.load_document_pages(payload["file_path"], payload["usage"], ocr_policy)
+            payload["document_content"] = "\n".join(payload["pages"])
+            payload["pinned_fields"] = self.select_pinned_fields(payload["document_content"], di_fields,
+                                                                 payload["usage"])
+            return payload
+
+        def llm_stage(payload: Dict) -> Dict:
+            if len(self.cascade_deployments) > 1 or self.should_chunk(payload["pages"]):
+                # Escalation depends on the checked result and chunks are merged after all of them return,
+                # so these validate within this stage
+                payload["data"] = self.extract_invoice_fields(
+                    payload["document_content"], payload["filename"], force_reextract, payload["usage"],
+                    pinned_fields=payload["pinned_fields"], pages=payload["pages"])
+                return payload
+            payload["raw_llm_response"] = self.extract_invoice_data_with_llm(
+                payload["document_content"], payload["filename"], bypass_cache=force_reextract,
+                usage=payload["usage"], pinned_fields=payload["pinned_fields"])
+            return payload
+
+        def validate_stage(payload: Dict) -> Dict:
+            if "data" in payload:
+                return payload
+            payload["data"] = self.apply_pinned_fields(
+                self.parse_llm_response(payload["raw_llm_response"], payload["filename"], payload["usage"]),
+                payload["pinned_fields"])
+            self.canonicalize_body_fields(payload["data"], payload["filename"])
+            return payload
+
+        pipeline = StagePipeline([
+            Stage("ocr", ocr_stage, self.pipeline_stage_workers["ocr"]),
+            Stage("llm", llm_stage, self.pipeline_stage_workers["llm"]),
+            Stage("validate", validate_stage, self.pipeline_stage_workers["validate"]),
+        ], queue_size=self.pipeline_queue_size)
+
+        total = len(file_paths)
+        results: Dict[str, InvoiceResult] = {}
+
+        def collect(item: PipelineItem):
+            filename = item.key
+            result = InvoiceResult(filename=filename, file_path=item.payload["file_path"],
+                                   elapsed_seconds=sum(item.stage_seconds.values()),
+                                   document_content=item.payload.get("document_content", ""))
+            if item.error is None:
+                result.data = item.payload["data"]
+            else:
+                # Record the failing stage and fall back to a minimal data structure
+                print(f"Error processing file {filename} in stage {item.failed_stage}: {item.error}")
+                result.error = f"{item.failed_stage}: {item.error}"
+                result.throttled = isinstance(item.exception, RateLimitExceeded)
+                result.data = get_minimal_data_structure(filename)
+            result.usage = self.usage_ledger.record(filename, batch_id, self.openai_deployment, item.payload["usage"])
+            results[filename] = result
+            if progress_callback is not None:
+                progress_callback(len(results), total, result)
+
+        items = (PipelineItem(key=os.path.basename(file_path),
+                              payload={"file_path": file_path, "filename": os.path.basename(file_path),
+                                       "usage": new_usage_record()})
+                 for file_path in file_paths)
+        pipeline.run(items, on_result=collect)
+
+        # Report per-stage utilization and queue depth to locate the bottleneck
+        self.last_pipeline_report = pipeline.report()
+        for stage_name, stage_report in self.last_pipeline_report.items():
+            print(f"Pipeline stage {stage_name}: {stage_report}")
+
+        # Key the results by filename, preserving the input order
+        ordered = {os.path.basename(file_path): results[os.path.basename(file_path)] for file_path in file_paths}
+        self.finish_batch(batch_id, ordered)
+        return ordered
+
+    async def process_invoices_async(self, file_paths: List[str], concurrency: Optional[int] = None,
+                                     progress_callback: Optional[Callable[[int, int, InvoiceResult], None]] = None,
+                                     force_reextract: bool = False,
+                                     ocr_policy: Optional[OcrPolicy] = None) -> Dict[str, InvoiceResult]:
+        if self.processing_mode in ("pipelined", "packed"):
+            # Run the stage pipeline or the packed batch off the event loop and deliver progress back on the
+            # loop's thread
+            loop = asyncio.get_running_loop()
+
+            def forward_progress(completed: int, total: int, result: InvoiceResult):
+                if progress_callback is not None:
+                    loop.call_soon_threadsafe(progress_callback, completed, total, result)
+
+            run_batch = (self.process_invoices_pipelined if self.processing_mode == "pipelined"
+                         else self.process_invoices_packed)
+            # Callbacks are queued on the loop ahead of the thread's completion, so they all run before returning
+            return await asyncio.to_thread(run_batch, file_paths, forward_progress, force_reextract, ocr_policy)
+
+        batch_id = self.new_batch_id()
+        # OCR fans out to the whole batch up front; the DI scheduler bounds the operations in flight
+        loop = asyncio.get_running_loop()
+        ocr_executor = ThreadPoolExecutor(max_workers=self.di_max_in_flight, thread_name_prefix="ocr")
+        # Bound the number of LLM extractions in flight so Azure OpenAI stays within quota
+        semaphore = asyncio.Semaphore(concurrency or self.processing_concurrency)
+        total = len(file_paths)
+        completed = 0
+
+        async def process(file_path: str) -> InvoiceResult:
+            nonlocal completed
             # Extract filename from the file path
             filename = os.path.basename(file_path)
-            # Process each invoice and store the result with the filename as key
-            results[filename] = self.process_single_invoice(file_path, filename)
-        return results
\ No newline at end of file
+            result = InvoiceResult(filename=filename, file_path=file_path)
+            usage = new_usage_record()
+            start = time.perf_counter()
+            try:
+                with span("process_invoice", filename=filename):
+                    # Run the blocking OCR and LLM calls in worker threads, keeping the tracing context
+                    pages, di_fields = await loop.run_in_executor(
+                        ocr_executor, contextvars.copy_context().run,
+                        self.load_document_pages, file_path, usage, ocr_policy)
+                    result.document_content = "\n".join(pages)
+                    async with semaphore:
+                        result.data = await asyncio.to_thread(self.extract_invoice_fields, result.document_content,
+                                                              filename, force_reextract, usage, di_fields,
+                                                              None, pages)
+            except Exception as e:
+                # Record the failure and fall back to a minimal data structure
+                print(f"Error processing file {filename}: {str(e)}")
+                result.error = str(e)
+                result.throttled = isinstance(e, RateLimitExceeded)
+                result.data = get_minimal_data_structure(filename)
+            result.elapsed_seconds = time.perf_counter() - start
+            result.usage = self.usage_ledger.record(filename, batch_id, self.openai_deployment, usage)
+
+            # Report progress as each invoice finishes, in completion order
+            completed += 1
+            if progress_callback is not None:
+                progress_callback(completed, total, result)
+            return result
+
+        try:
+            results = await asyncio.gather(*(process(file_path) for file_path in file_paths))
+        finally:
+            ocr_executor.shutdown(wait=False)
+        # Key the results by filename, preserving the input order
+        ordered = {result.filename: result for result in results}
+        self.finish_batch(batch_id, ordered)
+        return ordered
+
+    def process_invoices(self, file_paths: List[str], force_reextract: bool = False,
+                         ocr_policy: Optional[OcrPolicy] = None) -> Dict[str, Dict]:
+        # Process a list of invoice file paths through the concurrent batch API
+        results = asyncio.run(self.process_invoices_async(file_paths, force_reextract=force_reextract,
+                                                          ocr_policy=ocr_policy))
+        # Return the extracted data with the filename as key
+        return {filename: result.data for filename, result in results.items()}
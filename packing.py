@@ -0,0 +1,45 @@
+from typing import Dict, List, Tuple
+
+# Usage counters shared out across the invoices of a packed request
+SHARED_USAGE_COUNTERS = ("prompt_tokens", "completion_tokens", "cached_prompt_tokens", "llm_calls")
+
+
+def plan_packs(document_tokens: Dict[str, int], max_document_tokens: int, token_budget: int,
+               max_documents: int) -> Tuple[List[List[str]], List[str]]:
+    # First-fit decreasing: small documents fill packs within the token budget, the others are sent alone
+    singles = [name for name, tokens in document_tokens.items() if tokens > max_document_tokens]
+    small = sorted((name for name in document_tokens if name not in singles),
+                   key=lambda name: document_tokens[name], reverse=True)
+    packs: List[List[str]] = []
+    loads: List[int] = []
+    for name in small:
+        for index, pack in enumerate(packs):
+            if len(pack) < max_documents and loads[index] + document_tokens[name] <= token_budget:
+                pack.append(name)
+                loads[index] += document_tokens[name]
+                break
+        else:
+            packs.append([name])
+            loads.append(document_tokens[name])
+    # A pack of one gains nothing over a normal request
+    singles.extend(pack[0] for pack in packs if len(pack) == 1)
+    return [pack for pack in packs if len(pack) > 1], singles
+
+
+def split_counts(total: int, weights: List[float]) -> List[int]:
+    # Largest-remainder split of an integer total in proportion to the weights
+    if not sum(weights):
+        weights = [1.0] * len(weights)
+    exact = [total * weight / sum(weights) for weight in weights]
+    counts = [int(value) for value in exact]
+    order = sorted(range(len(weights)), key=lambda index: exact[index] - counts[index], reverse=True)
+    for index in order[:total - sum(counts)]:
+        counts[index] += 1
+    return counts
+
+
+def share_usage(pack_usage: Dict, usages: List[Dict], weights: List[float]) -> None:
+    # Add a packed request's tokens and call to each invoice's usage record in proportion to its document size
+    for name in SHARED_USAGE_COUNTERS:
+        for usage, count in zip(usages, split_counts(pack_usage[name], weights)):
+            usage[name] += count
@@ -0,0 +1,130 @@
+import re
+import math
+from typing import Dict, List, Tuple
+
+# Key fields whose presence marks a page as part of the invoice proper
+VIN_LIKE_PATTERN = re.compile(r"\b[A-HJ-NPR-Z0-9]{17}\b")
+TOTAL_PATTERN = re.compile(r"\b(grand total|total due|amount due|balance due|invoice total|total)\b", re.IGNORECASE)
+AMOUNT_PATTERN = re.compile(r"\$?\b\d{1,3}(?:,\d{3})*\.\d{2}\b")
+
+# Vocabulary typical of terms-and-conditions, warranty and legal pages
+BOILERPLATE_PATTERN = re.compile(
+    r"\b(terms|conditions|warrant(?:y|ies)|liabilit(?:y|ies)|liable|hereby|herein|thereof|shall|agree(?:s|ment)?|"
+    r"arbitration|indemnif(?:y|ication)|disclaim(?:s|er)?|pursuant|merchantability|fitness|jurisdiction|"
+    r"governed|consequential|limitation|remedy|remedies|statute)\b",
+    re.IGNORECASE,
+)
+WORD_PATTERN = re.compile(r"[A-Za-z]+")
+# "Page 2", "Page 2 of 5", "Page: 2/5": the only numbers that differ between otherwise repeated header lines
+PAGE_COUNTER_PATTERN = re.compile(r"\bpage\s*:?\s*\d+(?:\s*(?:of|/)\s*\d+)?\b", re.IGNORECASE)
+# Codes mixing letters and digits, such as VINs, stock and part numbers, identify what a line describes
+LONG_CODE_PATTERN = re.compile(r"\b(?=[A-Z0-9-]*[A-Z])(?=[A-Z0-9-]*\d)[A-Z0-9-]{8,}\b")
+
+
+def has_key_fields(text: str) -> bool:
+    # An invoice page set should contain a VIN-like token or a total
+    return bool(VIN_LIKE_PATTERN.search(text.upper()) or TOTAL_PATTERN.search(text))
+
+
+def normalize_line(line: str) -> str:
+    # Compare lines ignoring case, spacing and page counters, so "PAGE: 1" and "PAGE: 2" count as the same
+    # line; any other number must match exactly, and total labels, lines with VIN-like or other long codes
+    # and lines without real words are never stripped
+    if VIN_LIKE_PATTERN.search(line.upper()) or LONG_CODE_PATTERN.search(line.upper()):
+        return ""
+    text = re.sub(r"\s+", " ", line.lower()).strip()
+    if sum(1 for char in text if char.isalpha()) < 4 or TOTAL_PATTERN.search(text):
+        return ""
+    return PAGE_COUNTER_PATTERN.sub("page #", text)
+
+
+def find_repeated_lines(pages: List[List[str]], min_page_share: float) -> set:
+    # Normalized lines that appear on at least min_page_share of the pages (and on two pages at least)
+    if len(pages) < 2:
+        return set()
+    min_pages = max(2, math.ceil(min_page_share * len(pages)))
+    page_counts: Dict[str, int] = {}
+    for lines in pages:
+        for key in {normalize_line(line) for line in lines}:
+            if key:
+                page_counts[key] = page_counts.get(key, 0) + 1
+    return {key for key, count in page_counts.items() if count >= min_pages}
+
+
+def prose_ratio(tokens: List[str]) -> float:
+    # Share of tokens that are plain words rather than numbers, codes or amounts
+    words = sum(1 for token in tokens if WORD_PATTERN.fullmatch(token.strip(".,;:()\"'")))
+    return words / len(tokens) if tokens else 0.0
+
+
+def is_boilerplate_line(line: str) -> bool:
+    # A long sentence of legal wording, such as a terms-and-conditions paragraph in the page header
+    tokens = line.split()
+    return (len(tokens) >= 12 and len(BOILERPLATE_PATTERN.findall(line)) >= 2
+            and not AMOUNT_PATTERN.search(line) and prose_ratio(tokens) >= 0.8)
+
+
+def is_boilerplate_page(text: str, min_keywords: int) -> bool:
+    # Prose full of legal vocabulary with no VIN and hardly any amounts is terms, conditions or warranty text
+    if not text.strip() or VIN_LIKE_PATTERN.search(text.upper()):
+        return False
+    if len(AMOUNT_PATTERN.findall(text)) > 2:
+        return False
+    return len(BOILERPLATE_PATTERN.findall(text)) >= min_keywords and prose_ratio(text.split()) >= 0.75
+
+
+def compact_pages(pages: List[str], min_page_share: float = 0.6,
+                  min_boilerplate_keywords: int = 8) -> Tuple[List[str], Dict]:
+    # Drop boilerplate pages and lines, and every repeat of a header/footer line after its first occurrence
+    page_lines = [[line for line in page.splitlines() if line.strip()] for page in pages]
+    repeated = find_repeated_lines(page_lines, min_page_share)
+
+    first_page: Dict[str, int] = {}
+    compacted = []
+    dropped_pages = []
+    repeated_removed = 0
+    boilerplate_removed = 0
+    for index, lines in enumerate(page_lines):
+        # Classify the page on its own content, without the header/footer block it shares with other pages;
+        # the first page always stays, since it carries the invoice header
+        own_lines = [line for line in lines if normalize_line(line) not in repeated]
+        if index > 0 and is_boilerplate_page("\n".join(own_lines), min_boilerplate_keywords):
+            dropped_pages.append(index)
+            continue
+        kept = []
+        for line in lines:
+            if is_boilerplate_line(line):
+                boilerplate_removed += 1
+                continue
+            key = normalize_line(line)
+            if key in repeated:
+                # Keep every occurrence on the page where the line first appears
+                if first_page.setdefault(key, index) < index:
+                    repeated_removed += 1
+                    continue
+            kept.append(line)
+        if kept:
+            compacted.append("\n".join(kept))
+        elif lines:
+            # Every line was a repeat or boilerplate, so the page is gone from the compacted document
+            dropped_pages.append(index)
+
+    report = {
+        "pages": len(pages),
+        "dropped_pages": dropped_pages,
+        "repeated_lines_removed": repeated_removed,
+        "boilerplate_lines_removed": boilerplate_removed,
+    }
+    return compacted, report
+
+
+def select_relevant_lines(text: str, terms: List[str], context: int = 2) -> str:
+    # Lines mentioning any word of the terms, with a few lines of context around each; "" when none match
+    words = {word.lower() for term in terms for word in WORD_PATTERN.findall(term) if len(word) >= 3}
+    lines = text.split("\n")
+    keep = set()
+    for index, line in enumerate(lines):
+        lowered = line.lower()
+        if any(word in lowered for word in words):
+            keep.update(range(max(0, index - context), min(len(lines), index + context + 1)))
+    return "\n".join(lines[index] for index in sorted(keep))
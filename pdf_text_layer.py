@@ -0,0 +1,57 @@
+import io
+from typing import List, Optional
+
+# pypdf is optional; without it every page goes to Document Intelligence
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = None
+    PdfWriter = None
+
+
+def text_layer_available() -> bool:
+    return PdfReader is not None
+
+
+def is_usable_text(text: str, min_chars: int) -> bool:
+    # A usable layer has enough visible characters and is mostly real words rather than glyph garbage
+    visible = [char for char in text if not char.isspace()]
+    if len(visible) < min_chars:
+        return False
+    if text.count("�") + text.count("(cid:") * 5 > len(visible) * 0.02:
+        return False
+    readable = sum(1 for char in visible if char.isalnum() or char in ".,:;-/#$%&()'\"@+*")
+    return readable / len(visible) >= 0.85
+
+
+def normalize_page_text(text: str) -> str:
+    # Match the Document Intelligence page texts: one trimmed line per line, blank lines dropped
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+
+def extract_text_layer(file_path: str, min_chars: int) -> Optional[List[Optional[str]]]:
+    # Return the embedded text of every page, None for pages without a usable layer,
+    # or None overall when the PDF can't be read locally
+    if PdfReader is None:
+        return None
+    try:
+        reader = PdfReader(file_path)
+        pages = []
+        for page in reader.pages:
+            text = page.extract_text() or ""
+            pages.append(normalize_page_text(text) if is_usable_text(text, min_chars) else None)
+        return pages
+    except Exception as e:
+        print(f"Text layer extraction failed for {file_path}: {e}")
+        return None
+
+
+def build_page_subset_pdf(file_path: str, page_indices: List[int]) -> bytes:
+    # Write a new PDF holding only the given pages, in order, for a partial DI analysis
+    reader = PdfReader(file_path)
+    writer = PdfWriter()
+    for index in page_indices:
+        writer.add_page(reader.pages[index])
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
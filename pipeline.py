@@ -0,0 +1,180 @@
+import time
+import queue
+import threading
+import contextvars
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from tracing import span
+
+# Marker pushed through the queues to tell workers that no more items will arrive
+_END_OF_STREAM = object()
+
+
+@dataclass
+class PipelineItem:
+    # One unit of work travelling through the stages
+    key: str
+    payload: Any
+    error: Optional[str] = None
+    # The exception behind error, for callers that handle some failures differently
+    exception: Optional[Exception] = None
+    failed_stage: Optional[str] = None
+    stage_seconds: Dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class Stage:
+    # A named processing step with its own worker pool
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+
+
+class StageStats:
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self.queue_depth_samples = 0
+        self.queue_depth_total = 0
+        self._lock = threading.Lock()
+
+    def record_queue_depth(self, depth: int):
+        # Sample the input queue depth each time an item is enqueued
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+            self.queue_depth_samples += 1
+            self.queue_depth_total += depth
+
+    def record_item(self, seconds: float, failed: bool):
+        with self._lock:
+            self.processed += 1
+            self.failed += int(failed)
+            self.busy_seconds += seconds
+
+    def as_dict(self, wall_seconds: float) -> Dict[str, Any]:
+        # Utilization is the share of the pool's available worker time spent busy
+        capacity = self.workers * wall_seconds
+        return {
+            "workers": self.workers,
+            "processed": self.processed,
+            "failed": self.failed,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "utilization": round(self.busy_seconds / capacity, 3) if capacity else 0.0,
+            "max_queue_depth": self.max_queue_depth,
+            "mean_queue_depth": round(self.queue_depth_total / self.queue_depth_samples, 2)
+            if self.queue_depth_samples else 0.0,
+        }
+
+
+class StagePipeline:
+    def __init__(self, stages: List[Stage], queue_size: int = 4):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = {stage.name: StageStats(stage.name, stage.workers) for stage in stages}
+        self.wall_seconds = 0.0
+
+    def _run_worker(self, stage: Stage, inbox: queue.Queue, outbox: queue.Queue, next_stats: Optional[StageStats],
+                    finished_workers: List[int], lock: threading.Lock):
+        stats = self.stats[stage.name]
+        while True:
+            item = inbox.get()
+            if item is _END_OF_STREAM:
+                break
+
+            # Items that failed upstream pass straight through to the output
+            if item.error is None:
+                start = time.perf_counter()
+                try:
+                    with span(f"pipeline.{stage.name}", key=item.key):
+                        item.payload = stage.func(item.payload)
+                except Exception as e:
+                    item.error = str(e)
+                    item.exception = e
+                    item.failed_stage = stage.name
+                elapsed = time.perf_counter() - start
+                item.stage_seconds[stage.name] = elapsed
+                stats.record_item(elapsed, item.error is not None)
+
+            # A bounded outbox blocks this worker when the next stage falls behind
+            outbox.put(item)
+            if next_stats is not None:
+                next_stats.record_queue_depth(outbox.qsize())
+
+        # The last worker of the stage closes the stream for every worker of the next stage
+        with lock:
+            finished_workers[0] += 1
+            last_worker = finished_workers[0] == stage.workers
+        if last_worker:
+            downstream_workers = 1 if next_stats is None else next_stats.workers
+            for _ in range(downstream_workers):
+                outbox.put(_END_OF_STREAM)
+
+    def run(self, items: Iterable[PipelineItem],
+            on_result: Optional[Callable[[PipelineItem], None]] = None) -> List[PipelineItem]:
+        start = time.perf_counter()
+        # One bounded queue in front of each stage, plus an unbounded queue for finished items
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages] + [queue.Queue()]
+
+        threads = []
+        for index, stage in enumerate(self.stages):
+            next_stats = self.stats[self.stages[index + 1].name] if index + 1 < len(self.stages) else None
+            finished_workers, lock = [0], threading.Lock()
+            for worker in range(stage.workers):
+                # Each worker runs in its own copy of the caller's context, so stage spans nest under the open span
+                thread = threading.Thread(
+                    target=contextvars.copy_context().run,
+                    args=(self._run_worker, stage, queues[index], queues[index + 1], next_stats, finished_workers,
+                          lock),
+                    name=f"pipeline-{stage.name}-{worker}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        # Feed the first stage from a separate thread so results can be consumed as they arrive
+        feed_errors: List[BaseException] = []
+
+        def feed():
+            first_stats = self.stats[self.stages[0].name]
+            try:
+                for item in items:
+                    queues[0].put(item)
+                    first_stats.record_queue_depth(queues[0].qsize())
+            except BaseException as e:
+                # Kept for run() to re-raise once the items already fed have drained
+                feed_errors.append(e)
+            finally:
+                # Always close the stream, or the workers and run() would wait forever
+                for _ in range(self.stages[0].workers):
+                    queues[0].put(_END_OF_STREAM)
+
+        feeder = threading.Thread(target=contextvars.copy_context().run, args=(feed,), name="pipeline-feeder",
+                                  daemon=True)
+        feeder.start()
+
+        # Collect finished items in the calling thread so callbacks run where the caller expects
+        results = []
+        while True:
+            item = queues[-1].get()
+            if item is _END_OF_STREAM:
+                break
+            results.append(item)
+            if on_result is not None:
+                on_result(item)
+
+        feeder.join()
+        for thread in threads:
+            thread.join()
+        self.wall_seconds = time.perf_counter() - start
+        if feed_errors:
+            raise feed_errors[0]
+        return results
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        # Per-stage counters; the stage with the highest utilization is the bottleneck
+        return {name: stats.as_dict(self.wall_seconds) for name, stats in self.stats.items()}
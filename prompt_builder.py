@@ -0,0 +1,126 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from cache import make_cache_key
+from utils import estimate_tokens
+
+# Parsing instructions at the start of every extraction prompt; field-level rules, component and attribute
+# formats, dates and the documents block are described once, in guidelines.py
+EXTRACTION_INSTRUCTIONS = """
+You are an expert vehicle invoice parser that extracts structured data from automobile invoices including truck bodies, equipment, and vehicle modifications.
+
+**CRITICAL: Return ONLY valid JSON - no markdown, no explanations, no additional text.**
+
+**PARSING INSTRUCTIONS:**
+
+**1. HEADER INFORMATION:**
+- distributor: Extract the body/equipment manufacturer name from invoice header (the company that built/supplied the body/equipment, NOT the dealer/sold-to)
+- distributor_location: Extract manufacturer's location from header (City, State ZIP format)
+- make: Proper case formatting (e.g., "Ford", "International", "Freightliner", "Chevrolet", "Ram")
+- model: Include dashes and proper formatting (e.g., "F-600", "MV", "Cascadia", "Silverado", "ProMaster")
+- body_type: Classify as "Box Truck", "Flatbed", "Tank Truck", "Service Body", "Pickup Truck", "Van", "Other/Specialty", etc.
+- body_line: More specific description if available (e.g., "Water Truck", "Dry Van", "Stake Bed", "Refrigerated", "Utility Body") - leave empty if not clearly specified
+- body_manufacturer: The company that manufactured the body/equipment
+- body_model: Full descriptive specification from invoice
+
+**2. DYNAMIC COMPONENT EXTRACTION:**
+- Analyze invoice content to identify ALL installed components/equipment
+- Create components based on what's actually present in the invoice
+- Common component types include:
+  * Body/Tank: Main structure with dimensions and materials
+  * Engine: Motor specifications
+  * Transmission: Gearbox details
+  * Pump/PTO: Power systems
+  * Hose Reel: Hose management systems
+  * Ladder: Access equipment
+  * Safety Equipment: Safety features and kits
+  * Electrical: Lighting, cameras, controls, batteries
+  * Hydraulics: Lift gates, dump systems
+  * Plumbing: Valves, fittings, tanks
+  * Storage: Toolboxes, compartments
+  * Accessories: Steps, fenders, guards, bumpers
+  * Interior: Seats, dash components, upholstery
+  * Exterior: Paint, decals, mirrors
+
+**3. ATTRIBUTE EXTRACTION RULES:**
+- Material: Steel, Aluminum, Composite, Stainless Steel, Plastic, etc.
+- Description: Comprehensive but concise feature descriptions
+- Manufacturer/Model: When specified for components
+- Type: Functional classification
+- Preserve technical specifications exactly as stated
+"""
+# Closes the static prefix; the document itself follows in the user message
+EXTRACTION_REQUEST = """
+Extract the information from the document text in the user message and return it in the required JSON format.
+"""
+# Content notes for the document layouts of CONTENT_MODE
+STRUCTURED_CONTENT_NOTE = ("Tables are given as pipe-delimited rows with the header row first; "
+                           "labelled values are given as \"key: value\" lines.")
+
+
+def body_model_section(body_models: List[str]) -> str:
+    # Known body models the model can match body_model against
+    if not body_models:
+        return ""
+    return ("**KNOWLEDGE BASE OF BODY MODELS:**\n"
+            "Below is a list of known body models for reference when identifying the body_model from invoice text:\n"
+            + "\n".join(f"- {model}" for model in body_models) + "\n")
+
+
+@dataclass
+class PromptSection:
+    # One part of a prompt; static sections make up the system message, the others the user message
+    name: str
+    text: str
+    static: bool = True
+    # Optional sections are dropped, lowest rank first, while the prompt is over the input budget
+    drop_rank: Optional[int] = None
+
+
+@dataclass
+class AssembledPrompt:
+    messages: List[Dict]
+    # Identifies the template: the static text and the order of the variable sections
+    version: str
+    tokens: int
+    # Tokens of the system message, the part the provider can serve from its prompt cache
+    prefix_tokens: int
+    dropped: List[str] = field(default_factory=list)
+    over_budget: bool = False
+
+
+def prompt_version(sections: List[PromptSection]) -> str:
+    # The variable sections contribute their name only, so every invoice built from a template shares its version
+    return make_cache_key([(section.name, section.text if section.static else None)
+                           for section in sections])[:16]
+
+
+def assemble_prompt(sections: List[PromptSection], token_budget: int = 0) -> AssembledPrompt:
+    # Static sections go first, in a system message that is byte-identical across invoices, so the provider's
+    # prompt cache covers it; per-invoice content comes last
+    sections = [section for section in sections if section.text]
+    sections = [section for section in sections if section.static] + [section for section in sections
+                                                                       if not section.static]
+
+    section_tokens = {section.name: estimate_tokens(section.text) for section in sections}
+    total = sum(section_tokens.values())
+    dropped = []
+    if token_budget > 0:
+        for section in sorted((section for section in sections if section.drop_rank is not None),
+                              key=lambda section: section.drop_rank):
+            if total <= token_budget:
+                break
+            dropped.append(section.name)
+            total -= section_tokens[section.name]
+
+    kept = [section for section in sections if section.name not in dropped]
+    # A trimmed prompt is a different template, so its version is hashed from the sections actually sent
+    version = prompt_version(kept)
+    messages = [
+        {"role": "system", "content": "\n".join(section.text for section in kept if section.static)},
+        {"role": "user", "content": "\n".join(section.text for section in kept if not section.static)},
+    ]
+    tokens = sum(estimate_tokens(message["content"]) for message in messages)
+    return AssembledPrompt(messages=messages, version=version, tokens=tokens,
+                           prefix_tokens=estimate_tokens(messages[0]["content"]), dropped=dropped,
+                           over_budget=token_budget > 0 and tokens > token_budget)
@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+from multiprocessing import Process
+from typing import Dict
+
+from config import load_job_queue_settings
+from job_queue import JobQueue
+
+
+def open_queue() -> JobQueue:
+    _, queue_path, _, lease_seconds, max_attempts, retry_delay_seconds, _ = load_job_queue_settings()
+    return JobQueue(queue_path, lease_seconds, max_attempts, retry_delay_seconds)
+
+
+def keep_lease(queue: JobQueue, job_id: int, worker_id: str, stop: threading.Event) -> None:
+    # Renew the lease while the invoice is processed, so long documents are not handed to a second worker
+    while not stop.wait(queue.lease_seconds / 3):
+        if not queue.extend_lease(job_id, worker_id):
+            print(f"[{worker_id}] Lost the lease on job {job_id}")
+            return
+
+
+def run_job(processor, queue: JobQueue, job: Dict, worker_id: str) -> None:
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=keep_lease, args=(queue, job["id"], worker_id, stop), daemon=True)
+    heartbeat.start()
+    try:
+        result = processor.process_invoice(job["file_path"], job["filename"], job["force_reextract"],
+                                           batch_id=job["batch_id"])
+    except Exception as e:
+        # Unexpected failures are retried like extraction errors
+        result = None
+        error = str(e)
+    finally:
+        stop.set()
+        heartbeat.join()
+
+    if result is not None and result.succeeded:
+        if not queue.complete(job["id"], worker_id, result.data, result.usage):
+            print(f"[{worker_id}] Job {job['id']} was reassigned before it finished; result discarded")
+            return
+        print(f"[{worker_id}] {job['filename']}: done in {result.elapsed_seconds:.1f}s")
+        return
+
+    if result is not None:
+        error = result.error
+    status = queue.fail(job["id"], worker_id, error)
+    print(f"[{worker_id}] {job['filename']}: attempt {job['attempts']} failed ({error}); {status or 'lease lost'}")
+
+
+def work(exit_when_idle: bool = False) -> None:
+    # Imported here so the launcher process never builds the Azure clients
+    from main import InvoiceProcessor
+
+    poll_seconds = load_job_queue_settings()[6]
+    queue = open_queue()
+    processor = InvoiceProcessor()
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    print(f"[{worker_id}] Waiting for jobs in {queue.db_path}")
+
+    while True:
+        job = queue.lease(worker_id)
+        if job is None:
+            if exit_when_idle:
+                return
+            time.sleep(poll_seconds)
+            continue
+        run_job(processor, queue, job, worker_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process invoices queued by the app (JOB_QUEUE_ENABLED).")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes on this machine")
+    parser.add_argument("--exit-when-idle", action="store_true", help="Stop once no job is due")
+    parser.add_argument("--requeue-dead", action="store_true",
+                        help="Give dead-lettered jobs a fresh set of attempts and exit")
+    parser.add_argument("--stats", action="store_true", help="Print the number of jobs in each state and exit")
+    args = parser.parse_args()
+
+    if args.requeue_dead:
+        print(f"Requeued {open_queue().requeue_dead()} dead job(s)")
+        return
+    if args.stats:
+        print(json.dumps(open_queue().stats(), indent=2))
+        return
+
+    if args.workers <= 1:
+        work(args.exit_when_idle)
+        return
+    # Each worker is a separate process with its own InvoiceProcessor; more can be started on other machines
+    # that share the queue database and upload folder
+    processes = [Process(target=work, args=(args.exit_when_idle,)) for _ in range(args.workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
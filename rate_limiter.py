@@ -0,0 +1,162 @@
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Optional
+
+from tracing import span
+
+# HTTP statuses that mean "slow down and try again"
+THROTTLE_STATUS_CODES = {429, 503}
+
+
+class RateLimitExceeded(Exception):
+    # Raised when a call is still throttled after every retry
+    pass
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        # A bucket holding up to one minute of quota, refilled continuously
+        self.capacity = float(per_minute)
+        self.refill_per_second = float(per_minute) / 60.0
+        self.available = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def wait_seconds(self, amount: float) -> float:
+        # Time until the bucket holds the requested amount (requests larger than the bucket wait for a full one)
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.refill_per_second
+
+
+def get_status_code(error: Exception) -> Optional[int]:
+    # OpenAI and Azure SDK errors expose the status code either directly or on the response
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    # Read the service-provided delay from the failed response's headers
+    return parse_retry_after(getattr(getattr(error, "response", None), "headers", None))
+
+
+def parse_retry_after(headers: Optional[Any]) -> Optional[float]:
+    # Read the service-provided delay from the Retry-After family of headers
+    if not headers:
+        return None
+    for name, scale in (("retry-after-ms", 0.001), ("x-ms-retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return max(0.0, float(value) * scale)
+        except ValueError:
+            # Retry-After may also be an HTTP date
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                continue
+    return None
+
+
+class QuotaLimiter:
+    def __init__(self, name: str, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.name = name
+        # A limit of 0 disables the corresponding bucket
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Set when the service asks every caller to back off
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "admission_waits": 0,
+            "admission_wait_seconds": 0.0,
+            "throttled": 0,
+            "retries": 0,
+            "failures": 0,
+        }
+
+    def acquire(self, estimated_tokens: int = 0):
+        # Block until both the request and token buckets can admit this call
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = max(0.0, self.paused_until - now)
+                for bucket, amount in ((self.request_bucket, 1), (self.token_bucket, estimated_tokens)):
+                    if bucket is not None:
+                        bucket.refill(now)
+                        wait = max(wait, bucket.wait_seconds(amount))
+                if wait <= 0:
+                    if self.request_bucket is not None:
+                        self.request_bucket.available -= 1
+                    if self.token_bucket is not None:
+                        self.token_bucket.available -= min(estimated_tokens, self.token_bucket.capacity)
+                    self.counters["requests"] += 1
+                    if waited:
+                        self.counters["admission_waits"] += 1
+                        self.counters["admission_wait_seconds"] += waited
+                    return
+            time.sleep(wait)
+            waited += wait
+
+    def backoff_delay(self, attempt: int, retry_after: Optional[float]) -> float:
+        # Honour the service's Retry-After, otherwise use exponential backoff with full jitter
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def call(self, func: Callable[[], Any], estimated_tokens: int = 0) -> Any:
+        # Run the call under the quota, retrying throttled attempts
+        for attempt in range(self.max_retries + 1):
+            with span(f"{self.name}.admission", estimated_tokens=estimated_tokens):
+                self.acquire(estimated_tokens)
+            try:
+                with span(f"{self.name}.request", attempt=attempt + 1):
+                    return func()
+            except Exception as e:
+                if get_status_code(e) not in THROTTLE_STATUS_CODES:
+                    raise
+                with self._lock:
+                    self.counters["throttled"] += 1
+                    if attempt == self.max_retries:
+                        self.counters["failures"] += 1
+                        raise RateLimitExceeded(
+                            f"{self.name} still throttled after {self.max_retries} retries: {e}") from e
+                    self.counters["retries"] += 1
+                    delay = self.backoff_delay(attempt, get_retry_after(e))
+                    # Pause every caller sharing this quota, not just the one that was throttled
+                    self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                print(f"{self.name} throttled (attempt {attempt + 1}), retrying in {delay:.1f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.counters)
+        stats["admission_wait_seconds"] = round(stats["admission_wait_seconds"], 3)
+        return stats
+
+
+# Limiters are shared per service across every InvoiceProcessor in the process
+_limiters: Dict[str, QuotaLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name: str, **settings) -> QuotaLimiter:
+    # Return the process-wide limiter for a service, creating it on first use
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = QuotaLimiter(name, **settings)
+        return _limiters[name]
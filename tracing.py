@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import pstats
+import cProfile
+import argparse
+import threading
+import contextvars
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# The span currently open in this thread or task; copied into asyncio.to_thread workers automatically
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional["Span"], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes)
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms = 0.0
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def end(self):
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": round(self.start_time, 6),
+            "duration_ms": round(self.duration_ms, 3),
+            "thread": threading.current_thread().name,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    # Stand-in returned when tracing is disabled so callers can set attributes unconditionally
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = True
+        self.export_path = ""
+        # Recently finished spans kept in memory for the summary view
+        self.finished: deque = deque(maxlen=10000)
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: bool, export_path: str):
+        self.enabled = enabled
+        self.export_path = export_path
+        directory = os.path.dirname(export_path) if export_path else ""
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def export(self, finished_span: Span):
+        record = finished_span.as_dict()
+        with self._lock:
+            self.finished.append(record)
+            # Append to the local JSONL exporter
+            if self.export_path:
+                with open(self.export_path, "a") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+
+tracer = Tracer()
+
+
+def configure_tracing(enabled: bool, export_path: str):
+    tracer.configure(enabled, export_path)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Any]:
+    # Time a block as a span nested under the currently open span
+    if not tracer.enabled:
+        yield _NoopSpan()
+        return
+    current = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.set_attribute("error", str(e))
+        raise
+    finally:
+        current.end()
+        _current_span.reset(token)
+        tracer.export(current)
+
+
+def current_span() -> Any:
+    # The innermost open span, or a no-op stand-in outside any span
+    return _current_span.get() or _NoopSpan()
+
+
+def traced(name: Optional[str] = None) -> Callable:
+    # Decorator form of span() for whole functions
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize_spans(records: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    # p50/p95/p99 duration per span name
+    durations = defaultdict(list)
+    for record in records:
+        durations[record["name"]].append(record["duration_ms"])
+
+    summary = {}
+    for name, values in sorted(durations.items()):
+        values.sort()
+        summary[name] = {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.50), 1),
+            "p95_ms": round(percentile(values, 0.95), 1),
+            "p99_ms": round(percentile(values, 0.99), 1),
+            "total_ms": round(sum(values), 1),
+        }
+    return summary
+
+
+def load_span_records(path: str) -> List[Dict[str, Any]]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def format_summary(summary: Dict[str, Dict[str, float]]) -> str:
+    # Render the per-stage summary as a fixed-width table
+    lines = [f"{'span':<32}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}{'total ms':>14}"]
+    for name, stats in summary.items():
+        lines.append(f"{name:<32}{stats['count']:>8}{stats['p50_ms']:>12}{stats['p95_ms']:>12}"
+                     f"{stats['p99_ms']:>12}{stats['total_ms']:>14}")
+    return "\n".join(lines)
+
+
+class StackSampler:
+    # Samples the stacks of every thread to produce folded stacks for flamegraph tools
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.counts: Dict[str, int] = defaultdict(int)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                    frame = frame.f_back
+                self.counts[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def write_folded(self, path: str):
+        # One "frame;frame;frame count" line per distinct stack, as expected by flamegraph.pl/speedscope
+        with open(path, "w") as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write(f"{stack} {count}\n")
+
+
+def profile_single_invoice(file_path: str, output_dir: str = "traces/profile") -> Dict[str, str]:
+    # Run one invoice under cProfile and the stack sampler, writing .prof, folded stacks and a text report
+    from main import InvoiceProcessor
+
+    os.makedirs(output_dir, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    processor = InvoiceProcessor()
+
+    profiler = cProfile.Profile()
+    with StackSampler() as sampler:
+        profiler.enable()
+        try:
+            processor.process_single_invoice(file_path, os.path.basename(file_path), force_reextract=True)
+        finally:
+            profiler.disable()
+
+    outputs = {
+        "cprofile": os.path.join(output_dir, f"{base_name}.prof"),
+        "folded_stacks": os.path.join(output_dir, f"{base_name}.folded"),
+        "report": os.path.join(output_dir, f"{base_name}.txt"),
+    }
+    profiler.dump_stats(outputs["cprofile"])
+    sampler.write_folded(outputs["folded_stacks"])
+    with open(outputs["report"], "w") as f:
+        pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(40)
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize extraction traces or profile a single invoice.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="Print p50/p95/p99 per span from a JSONL trace file")
+    summary_parser.add_argument("path", nargs="?", default="traces/spans.jsonl")
+    profile_parser = subparsers.add_parser("profile", help="Profile one invoice run with cProfile and stack sampling")
+    profile_parser.add_argument("file_path")
+    profile_parser.add_argument("--output-dir", default="traces/profile")
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        print(format_summary(summarize_spans(load_span_records(args.path))))
+    else:
+        for kind, path in profile_single_invoice(args.file_path, args.output_dir).items():
+            print(f"{kind}: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import os
+import re
+import json
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# Counters exported in Prometheus text format, with their help text
+PROMETHEUS_COUNTERS = {
+    "invoices": "Invoices recorded in the usage ledger",
+    "llm_calls": "Chat completion calls made (cache hits excluded)",
+    "llm_cache_hits": "Extractions served from the LLM response cache",
+    "prompt_tokens": "Prompt tokens billed by Azure OpenAI",
+    "cached_prompt_tokens": "Prompt tokens served from the provider prompt cache",
+    "completion_tokens": "Completion tokens billed by Azure OpenAI",
+    "di_pages": "Pages analyzed by Document Intelligence (cache hits excluded)",
+    "di_high_res_pages": "Pages analyzed with the ocrHighResolution add-on",
+    "local_text_pages": "Pages read from the PDF's embedded text layer instead of Document Intelligence",
+    "di_cache_hits": "Documents served from the OCR result cache",
+    "compaction_tokens_saved": "Estimated document tokens removed by page compaction before the LLM call",
+    "cost_usd": "Estimated cost in US dollars",
+}
+
+
+def new_usage_record() -> Dict:
+    # Empty usage record filled in by the OCR and LLM stages of one invoice
+    return {
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "cached_prompt_tokens": 0,
+        "llm_calls": 0,
+        "llm_cache_hit": False,
+        "di_pages": 0,
+        "di_high_res_pages": 0,
+        "local_text_pages": 0,
+        "di_cache_hit": False,
+        "compaction_tokens_saved": 0,
+        "di_fields_used": 0,
+        "fast_path_fields_used": 0,
+        "llm_truncated": False,
+        "response_salvaged": False,
+        "cascade_tier": "",
+        "cascade_escalations": 0,
+        # LLM cost of the cascade tiers, each priced at its own deployment's rates
+        "cascade_cost_usd": 0.0,
+    }
+
+
+def metric_value(value: float) -> str:
+    # Counters keep full precision: integers as integers, floats in their shortest exact form
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def process_metrics_path(metrics_path: str) -> str:
+    # One metrics file per process, so the app, bulk runner workers and queue workers do not overwrite each
+    # other's totals; a textfile collector reads every *.prom file in the folder
+    if not metrics_path:
+        return metrics_path
+    root, extension = os.path.splitext(metrics_path)
+    return f"{root}-{os.getpid()}{extension}"
+
+
+def process_alive(pid: int) -> bool:
+    # Signal 0 only checks that the process exists; PermissionError means it exists under another user
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def remove_stale_metrics_files(metrics_path: str) -> List[str]:
+    # Delete the per-process metrics files of processes that are gone, so their totals are not scraped forever
+    if not metrics_path or os.name != "posix":
+        # os.kill(pid, 0) would terminate the process on Windows
+        return []
+    root, extension = os.path.splitext(metrics_path)
+    directory = os.path.dirname(root) or "."
+    if not os.path.isdir(directory):
+        return []
+    pattern = re.compile(re.escape(os.path.basename(root)) + r"-(\d+)" + re.escape(extension) + "$")
+    removed = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match is None or int(match.group(1)) == os.getpid() or process_alive(int(match.group(1))):
+            continue
+        try:
+            os.remove(os.path.join(directory, name))
+            removed.append(name)
+        except FileNotFoundError:
+            # Another process cleaned it up first
+            pass
+    return removed
+
+
+def add_usage(total: Dict, usage: Dict) -> None:
+    # Add the counters of one usage record to another; flags are set when either record has them
+    for name, value in usage.items():
+        if isinstance(value, bool):
+            total[name] = total[name] or value
+        elif isinstance(value, (int, float)):
+            total[name] += value
+        elif value and not total[name]:
+            total[name] = value
+
+
+class UsageLedger:
+    def __init__(self, ledger_path: str, metrics_path: str, prices: Dict[str, float]):
+        self.ledger_path = ledger_path
+        self.metrics_path = process_metrics_path(metrics_path)
+        self.prices = prices
+        self._lock = threading.Lock()
+        # Totals per deployment, accumulated since this process started
+        self.totals: Dict[str, Dict[str, float]] = {}
+
+        for path in (ledger_path, metrics_path):
+            directory = os.path.dirname(path) if path else ""
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+    def estimate_cost(self, usage: Dict, prices: Optional[Dict[str, float]] = None) -> float:
+        # Cached prompt tokens are billed at the discounted rate, DI per analyzed page plus the high-res add-on
+        prices = prices or self.prices
+        if usage.get("cascade_tier"):
+            # The cascade priced its LLM calls per tier as they were made
+            cost = usage["cascade_cost_usd"]
+        else:
+            uncached_prompt = usage["prompt_tokens"] - usage["cached_prompt_tokens"]
+            cost = (uncached_prompt / 1000 * prices["prompt_per_1k"]
+                    + usage["cached_prompt_tokens"] / 1000 * prices["cached_prompt_per_1k"]
+                    + usage["completion_tokens"] / 1000 * prices["completion_per_1k"])
+        cost += (usage["di_pages"] * prices["di_per_page"]
+                 + usage["di_high_res_pages"] * prices["di_high_res_per_page"])
+        return round(cost, 6)
+
+    def record(self, filename: str, batch_id: str, deployment: str, usage: Dict) -> Dict:
+        # Append one invoice's usage to the JSONL ledger and update the running totals; an invoice extracted
+        # by the cascade is recorded under the tier that produced its result
+        deployment = usage.get("cascade_tier") or deployment
+        entry = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "batch_id": batch_id,
+            "filename": filename,
+            "deployment": deployment,
+            **usage,
+            "cost_usd": self.estimate_cost(usage),
+        }
+        with self._lock:
+            if self.ledger_path:
+                with open(self.ledger_path, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+
+            totals = self.totals.setdefault(deployment, {name: 0 for name in PROMETHEUS_COUNTERS})
+            totals["invoices"] += 1
+            totals["llm_calls"] += usage["llm_calls"]
+            totals["llm_cache_hits"] += int(usage["llm_cache_hit"])
+            totals["prompt_tokens"] += usage["prompt_tokens"]
+            totals["cached_prompt_tokens"] += usage["cached_prompt_tokens"]
+            totals["completion_tokens"] += usage["completion_tokens"]
+            totals["di_pages"] += usage["di_pages"]
+            totals["di_high_res_pages"] += usage["di_high_res_pages"]
+            totals["local_text_pages"] += usage["local_text_pages"]
+            totals["di_cache_hits"] += int(usage["di_cache_hit"])
+            totals["compaction_tokens_saved"] += usage["compaction_tokens_saved"]
+            totals["cost_usd"] += entry["cost_usd"]
+        return entry
+
+    def summarize(self, entries: List[Dict]) -> Dict:
+        # Aggregate a batch of ledger entries into totals and per-invoice averages
+        summary = {name: 0 for name in ("prompt_tokens", "cached_prompt_tokens", "completion_tokens",
+                                        "di_pages", "di_high_res_pages", "local_text_pages",
+                                        "compaction_tokens_saved")}
+        for entry in entries:
+            for name in summary:
+                summary[name] += entry[name]
+        summary["invoices"] = len(entries)
+        # Share of the prompt tokens served from the provider's prompt cache
+        summary["cached_prompt_ratio"] = (round(summary["cached_prompt_tokens"] / summary["prompt_tokens"], 3)
+                                          if summary["prompt_tokens"] else None)
+        summary["cost_usd"] = round(sum(entry["cost_usd"] for entry in entries), 6)
+        summary["cost_per_invoice_usd"] = round(summary["cost_usd"] / len(entries), 6) if entries else 0.0
+        return summary
+
+    def prometheus_text(self) -> str:
+        # Render the running totals in the Prometheus text exposition format
+        lines = []
+        with self._lock:
+            for name, help_text in PROMETHEUS_COUNTERS.items():
+                metric = f"invoice_{name}_total"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} counter")
+                # The pid label keeps the series of different processes apart when the collector merges the files
+                for deployment, totals in sorted(self.totals.items()):
+                    lines.append(f'{metric}{{deployment="{deployment}",pid="{os.getpid()}"}} '
+                                 f'{metric_value(totals[name])}')
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self) -> Optional[str]:
+        # Write the metrics file atomically so a textfile collector never reads a partial file
+        if not self.metrics_path:
+            return None
+        temp_path = f"{self.metrics_path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_path, self.metrics_path)
+        return self.metrics_path
+
+
+_ledgers: Dict[tuple, UsageLedger] = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_usage_ledger(ledger_path: str, metrics_path: str, prices: Dict[str, float]) -> UsageLedger:
+    # Return the process-wide ledger, creating it on first use, so the running totals survive Streamlit reruns
+    # that build a new InvoiceProcessor; stale metrics files of dead processes are removed at the same time
+    with _ledgers_lock:
+        # Keyed by pid too, so a forked worker never writes to its parent's metrics file
+        key = (os.getpid(), ledger_path, metrics_path)
+        if key not in _ledgers:
+            remove_stale_metrics_files(metrics_path)
+            _ledgers[key] = UsageLedger(ledger_path, metrics_path, prices)
+        _ledgers[key].prices = prices
+        return _ledgers[key]
@@ -1,5 +1,17 @@
+import os
+import re
 import json
 from datetime import datetime
+from typing import Any, Optional, Tuple
+
+from tracing import traced
+
+# tiktoken is optional; without it token counts fall back to a character-based estimate
+try:
+    import tiktoken
+    _TOKEN_ENCODING = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _TOKEN_ENCODING = None
 
 def load_body_models(file_path: str = "body_model.txt") -> list[str]:
     # Attempt to open and read the file
@@ -16,7 +28,70 @@ def load_body_models(file_path: str = "body_model.txt") -> list[str]:
         print(f"Error loading body models from {file_path}: {str(e)}")
         return []
 
-def clean_and_validate_json(raw_content: str, filename: str) -> dict:
+def estimate_tokens(text: str) -> int:
+    # Count tokens with tiktoken when available, otherwise approximate at ~4 characters per token
+    if not text:
+        return 0
+    if _TOKEN_ENCODING is not None:
+        return len(_TOKEN_ENCODING.encode(text))
+    return max(1, len(text) // 4)
+
+def scan_json(text: str) -> Tuple[list, bool, int]:
+    # Open containers, whether the text ends inside a string, and where the first top-level value ends (-1 if open)
+    stack, in_string, escaped = [], False, False
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+            if not stack:
+                return stack, False, index
+    return stack, in_string, -1
+
+def load_lenient(text: str) -> Optional[Any]:
+    # json.loads after dropping trailing commas before a closing bracket
+    try:
+        return json.loads(re.sub(r",\s*([}\]])", r"\1", text))
+    except json.JSONDecodeError:
+        return None
+
+def repair_json(text: str, max_attempts: int = 500) -> Optional[Any]:
+    # Salvage a JSON value from model output: skip leading prose, cut trailing prose, fix trailing commas and,
+    # for output cut off mid-way, close the open arrays and objects after the last complete value. The value
+    # being written when the output stopped is dropped, not completed: a cut-off string, number or literal
+    # may be a prefix of the real one (a partial VIN, 12 for 1250), so '[1,2' gives [1], and '{"a": "hel' has
+    # no complete value left and gives None
+    starts = [index for index in (text.find("{"), text.find("[")) if index >= 0]
+    if not starts:
+        return None
+    text = text[min(starts):]
+    stack, _, end = scan_json(text)
+    if end >= 0:
+        return load_lenient(text[:end + 1])
+
+    # Truncated: try cut points from the end backwards until the closed prefix parses
+    cut_points = [index for index, char in enumerate(text) if char in ',}]"']
+    for index in reversed(cut_points[-max_attempts:]):
+        prefix = text[:index] if text[index] == "," else text[:index + 1]
+        stack, in_string, _ = scan_json(prefix)
+        prefix = prefix.rstrip().rstrip(",")
+        if in_string or prefix.endswith(":"):
+            continue
+        repaired = load_lenient(prefix + "".join(reversed(stack)))
+        if repaired is not None:
+            return repaired
+    return None
+
+def strip_json_fences(raw_content: str) -> str:
     # Remove leading/trailing whitespace from the raw content
     cleaned_content = raw_content.strip()
     # Remove common markdown JSON fences if they exist
@@ -27,19 +102,32 @@ def clean_and_validate_json(raw_content: str, filename: str) -> dict:
     if cleaned_content.endswith("```"):
         cleaned_content = cleaned_content[:-3]
     # Re-strip after fence removal
-    cleaned_content = cleaned_content.strip()
+    return cleaned_content.strip()
 
-    data = {}
-    # Attempt to parse the cleaned content as JSON
+def parse_json_response(raw_content: str, filename: str) -> Tuple[Any, str]:
+    # Parse the model output; returns the data and "parsed", "salvaged" or "failed"
+    cleaned_content = strip_json_fences(raw_content)
     try:
         data = json.loads(cleaned_content)
         print(f"Successfully parsed JSON for {filename}")
+        return data, "parsed"
     except json.JSONDecodeError as e:
         # Log JSON parsing errors and provide a snippet of the problematic content
         print(f"JSON parsing error for {filename}: {e}")
         print(f"Raw content (first 500 chars): {cleaned_content[:500]}...")
-        # Continue with an empty data dictionary to apply default validations
-        pass
+
+    # Salvage what the model did write before giving up on the paid call
+    repaired = repair_json(cleaned_content)
+    if isinstance(repaired, dict):
+        print(f"Salvaged partial JSON for {filename}")
+        return repaired, "salvaged"
+    # Continue with an empty data dictionary to apply default validations
+    return {}, "failed"
+
+@traced()
+def clean_and_validate_json(raw_content, filename: str) -> dict:
+    # Accept the raw model output or data that was already parsed
+    data = raw_content if isinstance(raw_content, dict) else parse_json_response(raw_content, filename)[0]
 
     # Define a list of required fields for the JSON data
     required_fields = ["inventory_arrival_date", "stock_number", "vin", "condition",
@@ -131,4 +219,51 @@ def get_minimal_data_structure(filename: str) -> dict:
             "type": "Invoice",
             "path": document_path
         }]
-    }
\ No newline at end of file
+    }
+
+# Define the desired order of fields for the output JSON
+JSON_FIELD_ORDER = [
+    "inventory_arrival_date",
+    "stock_number",
+    "vin",
+    "condition",
+    "model_year",
+    "make",
+    "model",
+    "body_type",
+    "body_line",
+    "body_manufacturer",
+    "body_model",
+    "distributor",
+    "distributor_location",
+    "invoice_date",
+    "components",
+    "documents"
+]
+
+@traced()
+def enforce_json_structure(data):
+    # Create a new dictionary to enforce the predefined JSON field order
+    structured_data = {}
+    for field in JSON_FIELD_ORDER:
+        # Populate fields, providing default empty string or list for missing ones
+        structured_data[field] = data.get(field, "" if field != "components" else [])
+    
+    # Ensure the "documents" array is properly structured with current date and path
+    current_date = datetime.now().strftime('%Y-%m-%d')
+    if "documents" not in structured_data or not structured_data["documents"]:
+        structured_data["documents"] = [{
+            "date": current_date,
+            "type": "Invoice",
+            "path": f"img/invoices/bodyinvoices/-/{data.get('filename', '')}"
+        }]
+    
+    return structured_data
+
+def save_output(output_dir: str, filename: str, data: dict) -> str:
+    # Write a record as <output_dir>/<name>.json in the saved field order and return the path
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, f"{os.path.splitext(filename)[0]}.json")
+    with open(output_path, "w") as f:
+        json.dump(enforce_json_structure({**data, "filename": filename}), f, indent=2)
+    return output_path
@@ -0,0 +1,117 @@
+from typing import Dict, Iterable
+
+# Short response keys and the output fields they expand to
+WIRE_FIELDS = {
+    "ad": "inventory_arrival_date",
+    "sn": "stock_number",
+    "vin": "vin",
+    "cd": "condition",
+    "my": "model_year",
+    "mk": "make",
+    "md": "model",
+    "bt": "body_type",
+    "bl": "body_line",
+    "bf": "body_manufacturer",
+    "bm": "body_model",
+    "ds": "distributor",
+    "dl": "distributor_location",
+    "ivd": "invoice_date",
+}
+# Server-assigned component IDs start here, as in clean_and_validate_json
+BASE_COMPONENT_ID = 3167729
+# Prompt sections and lines describing the verbose structure, replaced by the wire format description
+VERBOSE_SECTION_TITLES = ("COMPONENTS", "DOCUMENTS", "DOCUMENT PATH STRUCTURE")
+VERBOSE_LINE_MARKERS = ("component IDs", "Component IDs", "attribute IDs", "Attribute IDs")
+
+
+def wire_format_instructions(omit_fields: Iterable[str] = (), all_keys_required: bool = False) -> str:
+    # Description of the compact response format, listing only the fields the model is asked for
+    omitted = set(omit_fields)
+    keys = ", ".join(f"{key}={name}" for key, name in WIRE_FIELDS.items() if name not in omitted)
+    empty_values = "use \"\" for empty values" if all_keys_required else "leaving out keys whose value is empty"
+    return f"""**RESPONSE FORMAT (compact):**
+Return one JSON object with these short keys, {empty_values}: {keys}, dt=document type.
+Components go under "c" as [name, [[attribute name, attribute value], ...]] pairs, without IDs, e.g.
+{{"mk":"Ford","md":"F-600","dt":"Invoice","c":[["Body",[["Material","Aluminum"],["Length","192\\""]]]]}}
+"""
+
+
+def expand_wire_data(wire: Dict) -> Dict:
+    # Expand a compact response into the full output structure; IDs, the document date and path are
+    # assigned locally
+    data = {name: wire.get(key, "") for key, name in WIRE_FIELDS.items()}
+    components = []
+    for component in wire.get("c") or []:
+        if not isinstance(component, list) or not component:
+            continue
+        attributes = component[1] if len(component) > 1 and isinstance(component[1], list) else []
+        pairs = [pair for pair in attributes if isinstance(pair, list) and pair]
+        components.append({
+            "id": BASE_COMPONENT_ID + len(components),
+            "name": str(component[0]),
+            "attributes": [{"id": position, "name": str(pair[0]), "value": str(pair[1]) if len(pair) > 1 else ""}
+                           for position, pair in enumerate(pairs)],
+        })
+    data["components"] = components
+    data["documents"] = [{"type": wire.get("dt") or "Invoice"}]
+    return data
+
+
+# Keys that appear in only one of the two formats; "vin" is shared, so it identifies neither
+WIRE_ONLY_KEYS = {key for key, name in WIRE_FIELDS.items() if key != name} | {"c", "dt"}
+FULL_ONLY_KEYS = {name for key, name in WIRE_FIELDS.items() if key != name} | {"components", "documents"}
+
+
+def is_wire_object(data) -> bool:
+    # A compact response has a wire-only key and none of the full-format ones, so a full-format response
+    # returned in compact mode is not expanded (and emptied) as a wire object
+    return isinstance(data, dict) and bool(set(data) & WIRE_ONLY_KEYS) and not set(data) & FULL_ONLY_KEYS
+
+
+def strict_object(properties: Dict) -> Dict:
+    # Structured outputs in strict mode need every property required and no additional ones
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+
+def response_json_schema(output_format: str, omit_fields: Iterable[str] = ()) -> Dict:
+    # JSON schema of the requested response, without the fields resolved locally
+    omitted = set(omit_fields)
+    string = {"type": "string"}
+    if output_format == "compact":
+        properties = {key: string for key, name in WIRE_FIELDS.items() if name not in omitted}
+        properties["dt"] = string
+        # Positional [name, [[attribute, value], ...]] components; strict mode has no tuple schemas
+        attribute_pairs = {"type": "array", "items": {"type": "array", "items": string}}
+        properties["c"] = {"type": "array", "items": {"type": "array", "items": {"anyOf": [string, attribute_pairs]}}}
+    else:
+        properties = {name: string for name in WIRE_FIELDS.values() if name not in omitted}
+        attribute = strict_object({"id": {"type": "integer"}, "name": string, "value": string})
+        component = strict_object({"id": {"type": "integer"}, "name": string,
+                                   "attributes": {"type": "array", "items": attribute}})
+        properties["components"] = {"type": "array", "items": component}
+        properties["documents"] = {"type": "array",
+                                   "items": strict_object({"date": string, "type": string, "path": string})}
+    return {"name": f"invoice_{output_format}", "strict": True, "schema": strict_object(properties)}
+
+
+def packed_format_instructions() -> str:
+    # Response shape when several documents share one request
+    return """**MULTIPLE DOCUMENTS:**
+Several documents are given, each introduced by its filename. Extract each one separately and return
+{"results": [...]} with one entry per document, in the order given. Each entry is the JSON object described
+above for that document plus a "filename" key holding its filename.
+"""
+
+
+def packed_response_json_schema(output_format: str, omit_fields: Iterable[str] = ()) -> Dict:
+    # The single-document schema, with a filename, as the items of a "results" array
+    single = response_json_schema(output_format, omit_fields)["schema"]
+    item = strict_object({"filename": {"type": "string"}, **single["properties"]})
+    return {"name": f"invoice_pack_{output_format}", "strict": True,
+            "schema": strict_object({"results": {"type": "array", "items": item}})}
+
+
+def expected_output_tokens(document_tokens: int, base_tokens: int, tokens_per_document_token: float,
+                           max_tokens: int) -> int:
+    # Header fields cost a fixed amount; the component list grows with the document
+    return min(max_tokens, base_tokens + int(tokens_per_document_token * document_tokens))